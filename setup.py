@@ -7,7 +7,12 @@ setup(
     py_modules=['typediff'],
     install_requires=[
         'flask',
+        'numpy>=1.17',
+        'scipy>=1.4',
     ],
+    extras_require={
+        'aio': ['aiohttp'],
+    },
     packages=find_packages(),
     include_package_data=True,
     package_data={'typediff': ['bin/*']},
@@ -17,5 +22,8 @@ setup(
         'type-stats=typediff.type_stats:main',
         'parseit=typediff.parseit:main',
         'queryex=typediff.queryex:main',
+        'typediff-aio=typediff.aioserver:main',
+        'typediff-bench=typediff.bench.run:main',
+        'typediff-bench-compare=typediff.bench.compare:main',
     ]}
 )
@@ -0,0 +1,38 @@
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+
+from typediff.bench import run
+from typediff.bench.fixtures import hierarchy_xml
+
+
+"""Shared set up for the tests.
+
+Modules such as type_stats read the grammars and programs they use from
+typediff.settings when imported, so unless the tests are run with real
+settings, the benchmark stand-in settings are installed here, with a
+small type hierarchy, before any test module imports them.
+"""
+
+
+def install_settings():
+    if 'typediff.settings' in sys.modules or 'typediff.config' in sys.modules:
+        return
+    try:
+        import typediff.settings
+        return
+    except ImportError:
+        pass
+
+    workdir = tempfile.mkdtemp(prefix='typediff-tests-')
+    atexit.register(shutil.rmtree, workdir, True)
+    fixtures_dir = os.path.join(workdir, 'fixtures')
+    os.makedirs(fixtures_dir)
+    with open(os.path.join(fixtures_dir, 'grammar.xml'), 'w') as f:
+        f.write(hierarchy_xml(['a_type', 'b_type']))
+    run.install_settings(os.path.join(workdir, 'run'), fixtures_dir, [])
+
+
+install_settings()
@@ -0,0 +1,103 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from typediff.bitsets import TypeBitsets, diff_bitsets
+from typediff.delphin import get_symbols
+
+
+GRAMMAR = 'test-bitsets'
+
+
+def make_item(*readings):
+    """An item whose readings use the named types, as parsed."""
+    symbols = get_symbols(GRAMMAR)
+    return SimpleNamespace(readings=[
+        SimpleNamespace(type_ids=[symbols.intern(name) for name in names])
+        for names in readings])
+
+
+def make_opts(**kwargs):
+    opts = dict(grammar=GRAMMAR, all=False, d=True, i=False, u=False,
+                min_pos=None, max_neg=None)
+    opts.update(kwargs)
+    return SimpleNamespace(**opts)
+
+
+# enough types to span more than one word
+FILLER = ['filler_{}'.format(i) for i in range(100)]
+for name in FILLER:
+    get_symbols(GRAMMAR).intern(name)
+
+POS = [
+    make_item(['a', 'b', 'c'], ['z']),
+    make_item(['a', 'c', 'filler_70']),
+    make_item(['a', 'd']),
+]
+NEG = [
+    make_item(['b', 'c']),
+    make_item(['c', 'e'] + FILLER[:3]),
+]
+
+
+def names(bitsets, bitset):
+    return set(bitsets.names(bitsets.ids(bitset)))
+
+
+def test_set_algebra():
+    bitsets = TypeBitsets(POS + NEG, GRAMMAR)
+    assert bitsets.matrix.shape[1] * 64 >= len(get_symbols(GRAMMAR)) > 64
+    assert names(bitsets, bitsets.union([0, 1, 2])) == {'a', 'b', 'c', 'd', 'filler_70'}
+    assert names(bitsets, bitsets.intersection([0, 1, 2])) == {'a'}
+    assert names(bitsets, bitsets.intersection([0, 1, 3, 4])) == {'c'}
+    difference = bitsets.union([0, 1, 2]) & ~bitsets.union([3, 4])
+    assert names(bitsets, difference) == {'a', 'd', 'filler_70'}
+
+
+def test_counts():
+    bitsets = TypeBitsets(POS + NEG, GRAMMAR)
+    symbols = get_symbols(GRAMMAR)
+    counts = bitsets.counts([0, 1, 2, 3, 4])
+    assert len(counts) == bitsets.width
+    expected = {'a': 3, 'b': 2, 'c': 4, 'd': 1, 'e': 1, 'z': 0, 'filler_70': 1}
+    for name, count in expected.items():
+        assert counts[symbols.intern(name)] == count
+    assert names(bitsets, bitsets.at_least([0, 1, 2, 3, 4], 3)) == {'a', 'c'}
+
+
+def test_all_readings():
+    bitsets = TypeBitsets(POS, GRAMMAR, all_readings=True)
+    assert 'z' in names(bitsets, bitsets.union([0]))
+    bitsets = TypeBitsets(POS, GRAMMAR)
+    assert 'z' not in names(bitsets, bitsets.union([0]))
+
+
+def test_pack_round_trip():
+    bitsets = TypeBitsets(POS, GRAMMAR)
+    flags = np.zeros(bitsets.width, dtype=bool)
+    flags[[0, 5, 64, bitsets.width - 1]] = True
+    assert list(bitsets.ids(bitsets.pack(flags))) == [0, 5, 64, bitsets.width - 1]
+
+
+def diff_names(pos, neg, **kwargs):
+    bitsets, ids, pos_counts, neg_counts = diff_bitsets(pos, neg, make_opts(**kwargs))
+    return dict(zip(bitsets.names(ids), zip(pos_counts, neg_counts)))
+
+
+def test_diff_bitsets():
+    assert diff_names(POS, NEG) == {'a': (3, 0), 'd': (1, 0), 'filler_70': (1, 0)}
+    assert diff_names(POS, NEG, d=False, i=True) == {'b': (1, 1), 'c': (2, 2)}
+    union = diff_names(POS, NEG, d=False, u=True)
+    assert set(union) == {'a', 'b', 'c', 'd', 'e', 'filler_70'} | set(FILLER[:3])
+    assert union['c'] == (2, 2)
+
+
+def test_diff_bitsets_thresholds():
+    # types of at least two positive items, and of more than one negative
+    assert diff_names(POS, NEG, min_pos=2, max_neg=1) == {'a': (3, 0)}
+    assert diff_names(POS, NEG, min_pos=2) == {'a': (3, 0)}
+
+
+def test_diff_bitsets_one_side():
+    assert set(diff_names(POS, [])) == {'a', 'b', 'c', 'd', 'filler_70'}
+    assert set(diff_names([], NEG)) == {'b', 'c', 'e'} | set(FILLER[:3])
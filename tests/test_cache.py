@@ -0,0 +1,67 @@
+import os
+
+from typediff.cache import ResultCache, cache_key
+
+
+def test_memory_eviction():
+    cache = ResultCache(10)
+    cache.put('a', 'aaaa')
+    cache.put('b', 'bbbb')
+    assert cache.get('a') == 'aaaa'
+    # b is now the least recently used
+    cache.put('c', 'cccc')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'aaaa'
+    assert cache.get('c') == 'cccc'
+    assert cache.size == 8
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_oversized_values():
+    cache = ResultCache(4)
+    cache.put('a', 'aaa')
+    cache.put('a', 'too long')
+    assert cache.get('a') is None
+    assert cache.size == 0
+
+
+def test_unicode_size():
+    cache = ResultCache(4)
+    cache.put('a', 'éé')
+    assert cache.size == 4
+    assert cache.get('a') == 'éé'
+
+
+def test_disk_spill(tmp_path):
+    cache = ResultCache(5, cache_dir=str(tmp_path))
+    cache.put('a', 'aaaa')
+    cache.put('b', 'bbbb')
+    assert set(os.listdir(tmp_path)) == {'a.json', 'b.json'}
+    assert (tmp_path / 'a.json').read_text() == 'aaaa'
+    assert 'a' not in cache.entries
+    # reloaded from disk, and remembered again
+    assert cache.get('a') == 'aaaa'
+    assert 'a' in cache.entries
+
+    # shared with other caches using the same directory
+    other = ResultCache(100, cache_dir=str(tmp_path))
+    assert other.get('b') == 'bbbb'
+    assert other.get('c') is None
+
+
+def test_disk_eviction(tmp_path):
+    cache = ResultCache(100, cache_dir=str(tmp_path), max_disk_bytes=8)
+    (tmp_path / 'old.pickle').write_bytes(b'left over')
+    cache.put('a', 'aaaa')
+    os.utime(tmp_path / 'a.json', (1, 1))
+    cache.put('b', 'bbbb')
+    os.utime(tmp_path / 'b.json', (2, 2))
+    # reading b marks it as recently used
+    assert ResultCache(100, cache_dir=str(tmp_path)).get('b') == 'bbbb'
+    cache.put('c', 'cccc')
+    assert set(os.listdir(tmp_path)) == {'b.json', 'c.json'}
+
+
+def test_cache_key():
+    assert cache_key('a', 1, [2]) == cache_key('a', 1, [2])
+    assert cache_key('a', 1) != cache_key('a', '1')
@@ -0,0 +1,186 @@
+import sys
+import time
+import threading
+import subprocess
+
+import pytest
+
+from typediff import limits
+
+
+@pytest.fixture
+def configure(tmp_path, monkeypatch):
+    """Configure the limits for a test, restoring them afterwards."""
+    for name in ('SLOTS', 'QUEUE', 'WAIT', 'LOCK_DIR', 'RETRY_AFTER'):
+        monkeypatch.setattr(limits, name, getattr(limits, name))
+
+    def configure(slots, queue, wait):
+        limits.configure(slots, queue, wait, str(tmp_path / 'locks'), retry_after=3)
+    return configure
+
+
+class Holder:
+    """Holds a process slot in another thread until released."""
+
+    def __init__(self):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+        assert self.entered.wait(10)
+
+    def run(self):
+        with limits.slot('holder'):
+            self.entered.set()
+            self.release.wait(10)
+
+    def stop(self):
+        self.release.set()
+        self.thread.join(10)
+
+
+def test_unconfigured():
+    assert limits.SLOTS is None
+    with limits.slot('prog'):
+        assert limits.usage() == (0, 0)
+
+
+def test_busy_when_queue_full(configure):
+    configure(1, 1, 5)
+    holder = Holder()
+    queued = []
+
+    def wait():
+        with limits.slot('prog'):
+            queued.append(limits.usage())
+
+    try:
+        assert limits.usage() == (1, 0)
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        time.sleep(0.1)
+        assert limits.usage() == (1, 1)
+        start = time.time()
+        with pytest.raises(limits.BusyError) as error:
+            with limits.slot('prog'):
+                pass
+        assert time.time() - start < 1
+        assert error.value.retry_after == 3
+    finally:
+        holder.stop()
+    waiter.join(10)
+    # the queued request got the slot once it was free
+    assert queued == [(1, 0)]
+    assert limits.usage() == (0, 0)
+
+
+def test_busy_after_wait(configure):
+    configure(1, 1, 0.3)
+    holder = Holder()
+    queued = threading.Event()
+    errors = []
+
+    def wait():
+        queued.set()
+        try:
+            with limits.slot('prog'):
+                pass
+        except limits.BusyError as e:
+            errors.append(e)
+
+    try:
+        thread = threading.Thread(target=wait)
+        thread.start()
+        queued.wait(10)
+        time.sleep(0.1)
+        assert limits.usage() == (1, 1)
+        # the queue is full
+        with pytest.raises(limits.BusyError):
+            with limits.slot('prog'):
+                pass
+        thread.join(10)
+        assert len(errors) == 1
+        assert limits.usage() == (1, 0)
+    finally:
+        holder.stop()
+
+
+def test_queued_until_free(configure):
+    configure(1, 1, 5)
+    holder = Holder()
+    timer = threading.Timer(0.2, holder.stop)
+    timer.start()
+    start = time.time()
+    with limits.slot('prog'):
+        assert time.time() - start >= 0.15
+    timer.join()
+
+
+def test_patient(configure):
+    configure(1, 1, 0)
+    holder = Holder()
+    timer = threading.Timer(0.2, holder.stop)
+    timer.start()
+    # patient work neither queues nor gives up
+    with limits.patient(), limits.slot('prog'):
+        pass
+    timer.join()
+
+
+def test_deadline_while_waiting(configure):
+    configure(1, 1, 5)
+    holder = Holder()
+    try:
+        with limits.deadline(0.2):
+            with pytest.raises(limits.Timeout):
+                with limits.slot('prog'):
+                    pass
+    finally:
+        holder.stop()
+
+
+def test_deadline():
+    assert limits.remaining() is None
+    with limits.deadline(10):
+        assert 9 < limits.remaining() <= 10
+        with limits.deadline(None):
+            assert limits.remaining() is None
+    assert limits.remaining() is None
+
+
+def test_communicate_timeout(configure):
+    configure(1, 1, 5)
+    code, out, err = limits.communicate(['cat'], input=b'input')
+    assert (code, out) == (0, b'input')
+
+    start = time.time()
+    with limits.deadline(0.3):
+        with pytest.raises(limits.Timeout):
+            limits.communicate(['sleep', '10'])
+    assert time.time() - start < 5
+    # the slot is released again
+    assert limits.usage() == (0, 0)
+
+
+def test_running_timeout(configure):
+    configure(1, 1, 5)
+    start = time.time()
+    with limits.deadline(0.3):
+        with pytest.raises(limits.Timeout):
+            with limits.running(['sleep', '10']) as process:
+                process.wait()
+    assert time.time() - start < 5
+    assert process.returncode != 0
+    assert limits.usage() == (0, 0)
+
+
+def test_held_by_dead_process(configure, tmp_path):
+    configure(1, 1, 5)
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    with open(limits.lock_path('slot', 0), 'w') as f:
+        f.write('{}\n'.format(process.pid))
+    assert not limits.alive(process.pid)
+    assert limits.usage() == (0, 0)
+    with limits.slot('prog'):
+        assert limits.usage() == (1, 0)
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+from typediff import schedule
+from typediff.schedule import CostModel, derivation_key
+
+
+def derivation(nodes):
+    return '(root' + ' (node' * (nodes - 1) + ')' * nodes
+
+
+def test_derivation_nodes():
+    assert schedule.derivation_nodes(derivation(7)) == 7
+
+
+def test_unfitted_estimates_order_by_size():
+    costs = CostModel()
+    assert costs.coefficients() == (0.0, 1.0)
+    assert costs.estimate(derivation(3)) == 3
+    costs.record(derivation(3), 2.0)
+    # a single cost is not enough to fit, nor to be trusted
+    assert costs.estimate(derivation(3)) == 3
+
+
+def test_fit():
+    costs = CostModel()
+    for nodes in (2, 5, 10, 20):
+        costs.record(derivation(nodes), 0.5 + 0.25 * nodes)
+    intercept, slope = costs.coefficients()
+    assert intercept == pytest.approx(0.5)
+    assert slope == pytest.approx(0.25)
+    assert costs.estimate(derivation(40)) == pytest.approx(10.5)
+    # costs of derivations seen before are remembered as recorded
+    costs.record(derivation(8), 9.0)
+    assert costs.estimate(derivation(8)) == 9.0
+
+
+def test_fit_without_slope():
+    costs = CostModel()
+    costs.record(derivation(2), 3.0)
+    costs.record(derivation(10), 1.0)
+    assert costs.coefficients() == (2.0, 0.0)
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'costs.json')
+    costs = CostModel(path)
+    costs.record(derivation(2), 1.0)
+    costs.record(derivation(4), 2.0)
+    # saves are throttled unless forced
+    costs.save()
+    assert not (tmp_path / 'costs.json').exists()
+    costs.save(force=True)
+
+    loaded = CostModel(path)
+    assert loaded.known == costs.known
+    assert loaded.coefficients() == pytest.approx(costs.coefficients())
+
+
+def test_save_merges(tmp_path):
+    path = str(tmp_path / 'costs.json')
+    first = CostModel(path)
+    second = CostModel(path)
+    first.record(derivation(2), 1.0)
+    second.record(derivation(6), 3.0)
+    second.record(derivation(8), 4.0)
+    first.save(force=True)
+    second.save(force=True)
+
+    with open(path) as f:
+        state = json.load(f)
+    assert set(state['known']) == {derivation_key(derivation(n)) for n in (2, 6, 8)}
+    assert state['fit'][0] == 3
+    # the model saving last adopts the costs saved by the other
+    assert second.n == 3
+    assert second.coefficients() == pytest.approx((0.0, 0.5))
+
+    # nothing new has been recorded, so the file is left alone
+    first.save(force=True)
+    with open(path) as f:
+        assert json.load(f) == state
+
+
+def test_max_known(tmp_path, monkeypatch):
+    monkeypatch.setattr(schedule, 'MAX_KNOWN', 2)
+    costs = CostModel()
+    for nodes in (2, 3, 4):
+        costs.record(derivation(nodes), nodes)
+    assert len(costs.known) == 2
+    assert costs.n == 3
@@ -0,0 +1,131 @@
+import os
+import time
+import threading
+
+import pytest
+
+from typediff import limits
+from typediff.cache import ResultCache
+from typediff.singleflight import SingleFlight, request_key
+
+
+def make_flights(tmp_path, **kwargs):
+    store = ResultCache(2**20, cache_dir=str(tmp_path / 'cache'))
+    return SingleFlight(store, lock_dir=str(tmp_path / 'locks'), **kwargs)
+
+
+def run_threads(target, n):
+    results = [None] * n
+    def run(i):
+        results[i] = target()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def test_followers_share_result(tmp_path):
+    flights = make_flights(tmp_path)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'result'
+
+    results = run_threads(lambda: flights.do('key', compute), 5)
+    assert results == ['result'] * 5
+    assert len(calls) == 1
+    # the lock files are removed by their holders
+    assert os.listdir(tmp_path / 'locks') == []
+    assert flights.locks == {}
+
+
+def test_followers_in_other_processes(tmp_path):
+    # flights with their own thread locks only share the lock files and
+    # the store, as in separate processes
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'result'
+
+    results = run_threads(lambda: make_flights(tmp_path).do('key', compute), 4)
+    assert results == ['result'] * 4
+    assert len(calls) == 1
+
+
+def test_leader_failure(tmp_path):
+    flights = make_flights(tmp_path)
+    with pytest.raises(ValueError):
+        with flights.flight('key') as result:
+            assert result is None
+            raise ValueError
+    # the next caller leads in its place
+    assert flights.do('key', lambda: 'retried') == 'retried'
+
+
+def test_keys_do_not_block(tmp_path):
+    flights = make_flights(tmp_path)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        entered.set()
+        release.wait(10)
+        return 'slow'
+
+    thread = threading.Thread(target=flights.do, args=('a', slow))
+    thread.start()
+    try:
+        entered.wait(10)
+        start = time.time()
+        assert flights.do('b', lambda: 'fast') == 'fast'
+        assert time.time() - start < 1
+    finally:
+        release.set()
+        thread.join(10)
+
+
+def test_waiter_timeout(tmp_path):
+    flights = make_flights(tmp_path)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        entered.set()
+        release.wait(10)
+        return 'slow'
+
+    thread = threading.Thread(target=flights.do, args=('a', slow))
+    thread.start()
+    try:
+        entered.wait(10)
+        # once waiting on the thread lock, and once on the lock file
+        for waiter in (flights, make_flights(tmp_path)):
+            with limits.deadline(0.2):
+                with pytest.raises(limits.Timeout):
+                    waiter.do('a', lambda: 'waited')
+    finally:
+        release.set()
+        thread.join(10)
+    assert flights.do('a', lambda: 'again') == 'slow'
+
+
+def test_ttl(tmp_path):
+    flights = make_flights(tmp_path, ttl=0.2)
+    assert flights.do('key', lambda: 'first\nline') == 'first\nline'
+    assert flights.do('key', lambda: 'second') == 'first\nline'
+    time.sleep(0.3)
+    assert flights.do('key', lambda: 'second') == 'second'
+
+
+def test_request_key():
+    form = {'input': ' a sentence \n another\n', 'other': 'x'}
+    same = {'input': 'a sentence\nanother', 'other': 'y'}
+    assert request_key('parse', form, ['input']) == request_key('parse', same, ['input'])
+    assert request_key('parse', form, ['input']) != request_key('diff', form, ['input'])
+    assert request_key('parse', form, ['input', 'other']) != request_key('parse', same, ['input', 'other'])
@@ -0,0 +1,155 @@
+import math
+from collections import Counter
+
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.spatial.distance import jensenshannon
+from scipy.stats import chi2_contingency
+
+from typediff import stats
+
+
+COUNTS = np.array([
+    [4, 0, 1, 5],
+    [1, 1, 1, 1],
+    [0, 3, 0, 2],
+    [2, 2, 0, 0],
+    [0, 0, 0, 0],
+], dtype=float)
+
+
+def test_js_divergence_matrix_matches_pairwise():
+    result = stats.js_divergence_matrix(sparse.csr_matrix(COUNTS))
+    counters = [Counter({j: c for j, c in enumerate(row) if c}) for row in COUNTS[:4]]
+
+    for i in range(4):
+        for j in range(4):
+            expected = 0 if i == j else stats.js_divergence(
+                *stats.counts2dist(counters[i], counters[j]))
+            assert result[i, j] == pytest.approx(expected, abs=1e-12)
+
+
+def test_js_divergence_matrix_matches_scipy():
+    result = stats.js_divergence_matrix(COUNTS[:4])
+    dists = COUNTS[:4] / COUNTS[:4].sum(axis=1, keepdims=True)
+
+    for i in range(4):
+        for j in range(4):
+            # scipy returns the square root of the divergence
+            assert result[i, j] == pytest.approx(jensenshannon(dists[i], dists[j])**2, abs=1e-12)
+
+
+def test_js_divergence_matrix_chunks():
+    rng = np.random.default_rng(0)
+    counts = rng.integers(0, 5, size=(30, 12))
+    whole = stats.js_divergence_matrix(counts)
+    # a chunk of a single row at a time
+    chunked = stats.js_divergence_matrix(counts, chunk_bytes=1)
+    assert np.allclose(whole, chunked)
+    assert np.allclose(whole, whole.T)
+    assert (whole >= 0).all()
+    assert (np.diag(whole) == 0).all()
+
+
+def test_js_divergence_matrix_empty_rows():
+    # an item without counts has no distribution, and is compared as if
+    # all its probabilities were zero rather than producing NaNs
+    result = stats.js_divergence_matrix(COUNTS)
+    assert np.isfinite(result).all()
+    assert np.allclose(result[:4, :4], stats.js_divergence_matrix(COUNTS[:4]))
+
+
+def test_bootstrap_compare_identical():
+    matrix = sparse.csr_matrix(COUNTS[:4])
+    kls, jss, pvalues = stats.bootstrap_compare(matrix, matrix, resamples=200, seed=1)
+    assert kls.shape == jss.shape == (200,)
+    assert pvalues.shape == (4,)
+    assert (jss >= -1e-12).all()
+    assert (jss <= math.log(2) + 1e-12).all()
+    # collections drawn from the same items are not significantly different
+    assert (pvalues > 0.05).all()
+
+
+def test_bootstrap_compare_different():
+    a = np.tile([[10, 0, 1]], (20, 1))
+    b = np.tile([[0, 10, 1]], (20, 1))
+    kls, jss, pvalues = stats.bootstrap_compare(a, b, resamples=100, seed=1)
+    assert jss == pytest.approx(np.full(100, stats.js_divergence([10/11, 0, 1/11], [0, 10/11, 1/11])))
+    assert pvalues[0] == 0
+    assert pvalues[1] == 0
+
+
+def test_bootstrap_compare_seeded():
+    a = sparse.csr_matrix(COUNTS[:3])
+    b = sparse.csr_matrix(COUNTS[1:4])
+    first = stats.bootstrap_compare(a, b, resamples=150, seed=7, batch=40)
+    second = stats.bootstrap_compare(a, b, resamples=150, seed=7, batch=40)
+    for x, y in zip(first, second):
+        assert np.array_equal(x, y)
+
+
+def test_bootstrap_compare_empty():
+    empty = sparse.csr_matrix((0, 4))
+    kls, jss, pvalues = stats.bootstrap_compare(sparse.csr_matrix(COUNTS), empty, resamples=10)
+    assert kls.shape == jss.shape == (10,)
+    assert pvalues.shape == (4,)
+    assert np.isnan(kls).all() and np.isnan(jss).all() and np.isnan(pvalues).all()
+
+
+def test_bootstrap_totals():
+    # items with identical counts always resample to the same totals
+    matrix = sparse.csr_matrix(np.tile([[1, 0, 2]], (6, 1)))
+    rng = np.random.default_rng(3)
+    batches = list(stats.bootstrap_totals(matrix, 25, rng, batch=10))
+    assert [len(b) for b in batches] == [10, 10, 5]
+    for totals in batches:
+        assert (totals == [6, 0, 12]).all()
+
+
+def g_squared(k1, n1, k2, n2):
+    table = [[k1, n1 - k1], [k2, n2 - k2]]
+    result = 0
+    for row in range(2):
+        for col in range(2):
+            expected = sum(table[row]) * (table[0][col] + table[1][col]) / (n1 + n2)
+            observed = table[row][col]
+            if observed:
+                result += observed * math.log(observed / expected)
+    return 2 * result
+
+
+def test_log_likelihood_ratio():
+    k1, n1, k2, n2 = [10, 0, 5, 30], 40, [2, 6, 5, 10], 60
+    result = stats.log_likelihood_ratio(k1, n1, k2, n2)
+    for i, score in enumerate(result):
+        assert abs(score) == pytest.approx(g_squared(k1[i], n1, k2[i], n2))
+    assert result[0] > 0
+    assert result[1] < 0
+    # equal proportions in both collections score nothing
+    assert stats.log_likelihood_ratio([2], 10, [4], 20)[0] == pytest.approx(0)
+
+
+def test_chi_square():
+    k1, n1, k2, n2 = [10, 0, 30], 40, [2, 6, 10], 60
+    result = stats.chi_square(k1, n1, k2, n2)
+    for i, score in enumerate(result):
+        table = [[k1[i], n1 - k1[i]], [k2[i], n2 - k2[i]]]
+        expected = chi2_contingency(table, correction=False)[0]
+        assert abs(score) == pytest.approx(expected)
+    assert list(np.sign(result)) == [1, -1, 1]
+
+
+def test_chi_square_absent_feature():
+    # a feature in neither collection has no expected counts
+    assert stats.chi_square([0], 10, [0], 10)[0] == 0
+    assert stats.log_likelihood_ratio([0], 10, [0], 10)[0] == 0
+
+
+def test_tf_idf():
+    counts = [3, 1, 0]
+    doc_freqs = [0, 9, 4]
+    result = stats.tf_idf(counts, doc_freqs, 10)
+    expected = [3/4 * math.log(10/1), 1/4 * math.log(10/10), 0]
+    assert result == pytest.approx(expected)
+    assert (stats.tf_idf([0, 0], [1, 1], 10) == 0).all()
@@ -0,0 +1,103 @@
+import json
+import pickle
+import argparse
+
+import pytest
+
+from typediff import type_stats
+from typediff.delphin import TypeStats
+
+
+def type_stats_of(items, counts):
+    stats = TypeStats()
+    stats.items = items
+    stats.counts = counts
+    return stats
+
+
+def write_partial(path, shard, trees, stats, postings=None, treebank='wsj 08'):
+    with open(path, 'wb') as f:
+        pickle.dump({
+            'grammar': 'erg',
+            'treebank': treebank,
+            'shard': shard,
+            'trees': trees,
+            'stats': {name: type_stats_of(*s) for name, s in stats.items()},
+            'postings': postings,
+        }, f)
+    return str(path)
+
+
+@pytest.fixture
+def partials(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return [
+        write_partial(tmp_path / 'a.pickle', (1, 2), 3,
+                      {'a_type': (2, 5), 'b_type': (1, 1)},
+                      {'a_type': [('wsj08a', '1'), ('wsj08a', '20')], 'b_type': [('wsj08a', '1')]}),
+        write_partial(tmp_path / 'b.pickle', (2, 2), 2,
+                      {'a_type': (1, 2), 'c_type': (2, 3)},
+                      {'a_type': [('wsj08a', '3')], 'c_type': [('wsj08a', '3'), ('wsj08a', '4')]}),
+    ]
+
+
+def test_merge(partials, tmp_path):
+    type_stats.merge(partials)
+    with open(tmp_path / 'erg--wsj_08--5.pickle', 'rb') as f:
+        stats = pickle.load(f)
+    assert {name: (t.items, t.counts) for name, t in stats.items()} == {
+        'a_type': (3, 7), 'b_type': (1, 1), 'c_type': (2, 3)}
+    assert not (tmp_path / 'erg--wsj_08--5--postings.json').exists()
+
+
+def test_merge_postings(partials, tmp_path):
+    type_stats.merge(partials, postings=True)
+    with open(tmp_path / 'erg--wsj_08--5--postings.json') as f:
+        postings = json.load(f)
+    assert postings == {
+        'a_type': [['wsj08a', '1'], ['wsj08a', '3'], ['wsj08a', '20']],
+        'b_type': [['wsj08a', '1']],
+        'c_type': [['wsj08a', '3'], ['wsj08a', '4']],
+    }
+
+
+def test_merge_missing_shard(partials, tmp_path, capsys):
+    type_stats.merge(partials[:1])
+    assert 'without shards 2 of 2' in capsys.readouterr().err
+    assert (tmp_path / 'erg--wsj_08--3.pickle').exists()
+
+
+def test_merge_errors(partials, tmp_path):
+    with pytest.raises(type_stats.MergeError):
+        type_stats.merge([])
+    with pytest.raises(type_stats.MergeError, match='more than once'):
+        type_stats.merge([partials[0], partials[0]])
+
+    other = write_partial(tmp_path / 'c.pickle', (2, 2), 1, {}, treebank='other')
+    with pytest.raises(type_stats.MergeError, match='treebank'):
+        type_stats.merge([partials[0], other])
+
+    three = write_partial(tmp_path / 'd.pickle', (2, 3), 1, {})
+    with pytest.raises(type_stats.MergeError, match='one of 3 shards'):
+        type_stats.merge([partials[0], three])
+
+    unposted = write_partial(tmp_path / 'e.pickle', (2, 2), 1, {})
+    with pytest.raises(type_stats.MergeError, match='without --postings'):
+        type_stats.merge([partials[0], unposted], postings=True)
+
+
+def test_shards_partition_items():
+    n = 3
+    sizes = [0] * n
+    for iid in range(300):
+        owners = [k for k in range(1, n + 1) if type_stats.in_shard((k, n), 'wsj08a', iid)]
+        assert len(owners) == 1
+        sizes[owners[0] - 1] += 1
+    assert all(size > 50 for size in sizes)
+
+
+def test_parse_shard():
+    assert type_stats.parse_shard('2/5') == (2, 5)
+    for value in ('0/2', '3/2', 'x', '1'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            type_stats.parse_shard(value)
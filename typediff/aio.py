@@ -0,0 +1,219 @@
+import os
+import sys
+import time
+import asyncio
+import itertools
+import weakref
+
+from . import delphin
+from .delphin import (Fragment, Reading, ProfileItem, AceError, TsdbError,
+                      ace_command, profile_query, split_result)
+
+
+"""Asynchronous versions of the functions in delphin that run ACE, the
+typifier and tsdb, for multiplexing many parses within one event loop.
+
+Subprocesses are run with asyncio.create_subprocess_exec. At most
+CONCURRENCY of them run at once within an event loop, and each can be
+given a timeout in seconds, after which it is killed and an AceError
+or TsdbError is raised. Subprocesses are also killed if the task
+awaiting them is cancelled.
+"""
+
+
+CONCURRENCY = os.cpu_count() or 1
+
+LIMITERS = weakref.WeakKeyDictionary()
+
+
+def limiter():
+    """Return the semaphore limiting the subprocesses of the running
+    event loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in LIMITERS:
+        LIMITERS[loop] = asyncio.Semaphore(CONCURRENCY)
+    return LIMITERS[loop]
+
+
+class SubprocessTimeout(Exception):
+    def __init__(self, args, timeout):
+        self.msg = "{} timed out after {}s.".format(args[0], timeout)
+
+    def __str__(self):
+        return self.msg
+
+
+async def gather(*aws):
+    """Like asyncio.gather, but if one of aws fails, the others are
+    cancelled, killing their subprocesses, before the error is raised."""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def run(args, input=None, env=None, timeout=None):
+    """Run the command args with input, returning its return code and
+    decoded stdout and stderr."""
+    async with limiter():
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env
+        )
+        data = input.encode('utf8') if input is not None else None
+        try:
+            out, err = await asyncio.wait_for(process.communicate(data), timeout)
+        except asyncio.TimeoutError:
+            await kill(process)
+            raise SubprocessTimeout(args, timeout)
+        except asyncio.CancelledError:
+            await kill(process)
+            raise
+
+    return process.returncode, out.decode('utf8'), err.decode('utf8')
+
+
+async def kill(process):
+    if process.returncode is None:
+        process.kill()
+        await process.wait()
+
+
+async def ace_parse(input_str, ace_path, grammar, count, yy_input=False,
+                    fragments=False, tnt=False, short_labels=False,
+                    timeout=None):
+    """Asynchronous version of delphin.ace_parse."""
+    args, env = ace_command(grammar, ace_path, count, yy_input=yy_input,
+                            fragments=fragments, tnt=tnt,
+                            short_labels=short_labels)
+    try:
+        returncode, out, err = await run(args, input_str, env, timeout)
+    except SubprocessTimeout as e:
+        raise AceError('ACE', e.msg, input=input_str)
+
+    if returncode != 0 or out.startswith('SKIP'):
+        raise AceError('ACE', ''.join([out, err]), input=input_str)
+
+    return out, err
+
+
+async def reconstruct(reading, derivation, typifier_path, timeout=None):
+    """Asynchronous version of Reading._reconstruct."""
+    args, env = reading.typifier_command(typifier_path)
+    start = time.time()
+    try:
+        returncode, out, err = await run(args, derivation, env, timeout)
+    except SubprocessTimeout as e:
+        raise AceError('typifier', e.msg)
+    reading.typifier_time += time.time() - start
+
+    if returncode != 0:
+        raise AceError('typifier', err)
+
+    reading.add_typifier_output(out, err)
+
+
+async def tsdb_query(query, profile, timeout=None):
+    """Asynchronous version of delphin.tsdb_query."""
+    env = dict(os.environ)
+    env['LC_ALL'] = 'en_US.UTF-8'
+    args = ['tsdb', '-home', profile, '-query', query]
+    try:
+        returncode, out, err = await run(args, env=env, timeout=timeout)
+    except SubprocessTimeout as e:
+        raise TsdbError(e.msg)
+
+    if returncode != 0:
+        raise TsdbError(err)
+
+    return out
+
+
+async def parse(text, grammar, count=None, ace_path=None, typifier=None,
+                fragments=False, tnt=False, logpath=None, timeout=None):
+    """Asynchronous equivalent of creating a Fragment, reconstructing its
+    readings concurrently."""
+    if ace_path is None:
+        ace_path = delphin.ACEBIN
+
+    item = Fragment(text, grammar, ace_path=ace_path, count=count, tnt=tnt,
+                    fragments=fragments, logpath=logpath, parse=False)
+    input_str, yy_input = item.ace_input
+
+    try:
+        out, err = await ace_parse(input_str, ace_path, item.grammar, count,
+                                   yy_input=yy_input, fragments=fragments,
+                                   tnt=tnt, timeout=timeout)
+    except AceError as error:
+        item.log_lines.append(error.msg + '\n\n' + input_str)
+        item.write_log()
+        raise error
+
+    item.log_lines.append(out)
+    item.stderr = err
+    derivations = []
+
+    for i, line in enumerate(out.strip().splitlines()[1:]):
+        mrs, derivation = line.split(';', 1)
+        derivations.append(derivation.strip())
+        item.readings.append(Reading(derivations[-1], resultid=i,
+                                     grammar=item.grammar, mrs=mrs.strip()))
+
+    if typifier is not None:
+        await gather(*(reconstruct(r, d, typifier, timeout)
+                       for r, d in zip(item.readings, derivations)))
+    return item
+
+
+async def process_sentences(inputs, grammar, **kwargs):
+    """Parse inputs concurrently with parse, returning their Fragments
+    in order."""
+    return await gather(*(parse(i, grammar, **kwargs) for i in inputs))
+
+
+async def profile_items(path, grammar, best=1, gold=False, condition=None,
+                        typifier=None, logpath=None, timeout=None):
+    """Asynchronous equivalent of delphin.iter_profile_results for a
+    single profile, returning a list of ProfileItems. Phenomenon spans
+    are not supported. Readings which could not be reconstructed are
+    reported and skipped."""
+    query = profile_query(best=best, gold=gold, condition=condition)
+    results = await tsdb_query(query, path, timeout=timeout)
+    keys = []
+    readings = []
+    derivations = []
+
+    for result in results.splitlines():
+        iid, resultid, mrs, ptokens, derivation, iinput = split_result(result)
+        keys.append((iid, iinput))
+        derivations.append(derivation)
+        readings.append(Reading(derivation, iid=iid, resultid=resultid,
+                                mrs=mrs, grammar=grammar, ptokens=ptokens))
+
+    if typifier is not None:
+        outcomes = await asyncio.gather(
+            *(reconstruct(r, d, typifier, timeout)
+              for r, d in zip(readings, derivations)),
+            return_exceptions=True
+        )
+    else:
+        outcomes = [None] * len(readings)
+
+    pairs = []
+    for key, reading, outcome in zip(keys, readings, outcomes):
+        if isinstance(outcome, AceError):
+            sys.stderr.write(outcome.msg)
+        elif isinstance(outcome, BaseException):
+            raise outcome
+        else:
+            pairs.append((key, reading))
+
+    return [ProfileItem(iinput, grammar, [r for _key, r in group], logpath=logpath)
+            for (iid, iinput), group in itertools.groupby(pairs, key=lambda x:x[0])]
@@ -0,0 +1,201 @@
+import sys
+import json
+import asyncio
+import argparse
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+from . import aio
+from .config import (TYPIFIERBIN, LOGPATH, TREEBANKLIST, PROFILELIST,
+                     FANGORNPATH)
+from .gram import get_grammars
+from .delphin import (JSONEncoder, Treebank, Profile, dotdict, AceError,
+                      TsdbError, dump_items, load_items)
+from .typediff import typediff_web, typediff_compact, parse_profile_query
+from .server import (PROFILE_CACHE, FormError, sentence_opts, diff_opts,
+                     profile_queries, profile_cache_key)
+
+
+"""An asynchronous server for the typediff web interface, using
+aiohttp. It serves the same requests as typediff.server for parsing
+sentences and processing profiles, but runs ACE, the typifier and tsdb
+within a single event loop using typediff.aio, rather than tying up a
+server process or thread for each request.
+"""
+
+
+def json_response(data):
+    return web.Response(text=json.dumps(data, cls=JSONEncoder),
+                        content_type='application/json')
+
+
+async def form_errors(request, handler):
+    """Middleware responding to requests with invalid parameters with an
+    error, as typediff.server does."""
+    try:
+        return await handler(request)
+    except FormError as e:
+        return json_response({'success': False, 'error': e.msg})
+
+
+async def run_blocking(func, *args):
+    """Run the blocking func, such as computing a diff or reading the
+    cache, in a thread so as not to block the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+
+async def parse_types(request):
+    form = await request.post()
+    opts = sentence_opts(form)
+    pos_inputs = form.get('pos-items', '').strip().splitlines()
+    neg_inputs = form.get('neg-items', '').strip().splitlines()
+
+    try:
+        items = await aio.process_sentences(
+            pos_inputs + neg_inputs,
+            opts.grammar,
+            count=opts.count,
+            tnt=opts.tnt,
+            fragments=opts.fragments,
+            typifier=TYPIFIERBIN,
+            logpath=LOGPATH,
+            timeout=request.app['timeout']
+        )
+    except AceError as e:
+        return json_response({'success': False, 'error': e.msg})
+
+    pos_items, neg_items = items[:len(pos_inputs)], items[len(pos_inputs):]
+    data = await run_blocking(typediff_web, pos_items, neg_items, opts)
+    data['success'] = True
+    return json_response(data)
+
+
+async def cached_profile(query, opts, timeout=None):
+    """Asynchronous version of server.cached_profile, returning a list
+    of the items of a profile query."""
+    # the key digests the grammar image, which is large
+    key = await run_blocking(profile_cache_key, query, opts.grammar)
+    data = await run_blocking(PROFILE_CACHE.get, key)
+
+    if data is not None:
+        return await run_blocking(load_items, data, opts.grammar)
+
+    path, condition = parse_profile_query(query)
+    items = await aio.profile_items(path, opts.grammar, gold=True,
+                                    condition=condition,
+                                    typifier=TYPIFIERBIN, timeout=timeout)
+
+    def store():
+        PROFILE_CACHE.put(key, dump_items(items))
+
+    await run_blocking(store)
+    return items
+
+
+async def profile_items(request, opts, form):
+    """Asynchronous version of server.profile_items."""
+    queries = profile_queries(opts, form)
+    results = await aio.gather(
+        *(cached_profile(query, opts, request.app['timeout'])
+          for _polarity, query in queries))
+    items = {'pos': [], 'neg': []}
+
+    for (polarity, _query), result in zip(queries, results):
+        items[polarity] = result
+    return items['pos'], items['neg']
+
+
+async def process_profiles(request):
+    form = await request.post()
+    opts = dotdict({
+        'desc': form.get('load-descendants') == 'true',
+    })
+
+    try:
+        pos_items, neg_items = await profile_items(request, opts, form)
+    except (AceError, TsdbError) as e:
+        return json_response({'success': False, 'error': str(e)})
+
+    diff_opts(opts, form)
+    data = await run_blocking(typediff_web, pos_items, neg_items, opts)
+    data['success'] = True
+    return json_response(data)
+
+
+async def diff_profiles(request):
+    form = await request.post()
+    opts = dotdict({})
+
+    try:
+        pos_items, neg_items = await profile_items(request, opts, form)
+    except (AceError, TsdbError) as e:
+        return json_response({'success': False, 'error': str(e)})
+
+    diff_opts(opts, form)
+    data = await run_blocking(typediff_compact, pos_items, neg_items, opts)
+    data['success'] = True
+    return json_response(data)
+
+
+async def load_data(request):
+    return json_response({
+        'grammars'    : get_grammars(),
+        'treebanks'   : [Treebank(t) for t in TREEBANKLIST],
+        'fangornpath' : FANGORNPATH,
+        'profiles' : [Profile(p) for p in PROFILELIST]
+    })
+
+
+async def index(request):
+    return web.HTTPFound('/index.html')
+
+
+def make_app(timeout=None, static=None):
+    """Create the aiohttp application. Subprocesses are killed after
+    timeout seconds, if given. If static is given, files in that
+    directory are also served."""
+    app = web.Application(middlewares=[web.middleware(form_errors)])
+    app['timeout'] = timeout
+    app.router.add_post('/parse-types', parse_types)
+    app.router.add_post('/process-profiles', process_profiles)
+    app.router.add_post('/diff-profiles', diff_profiles)
+    app.router.add_post('/load-data', load_data)
+
+    if static is not None:
+        app.router.add_get('/', index)
+        app.router.add_static('/', static)
+    return app
+
+
+def argparser():
+    ap = argparse.ArgumentParser(description="Run the asynchronous typediff server.")
+    ap.add_argument("--host", default='0.0.0.0', help="Host to listen on.")
+    ap.add_argument("--port", type=int, default=5050, help="Port to listen on.")
+    ap.add_argument("--timeout", type=float, metavar="SECONDS",
+                    help="Kill ACE, typifier and tsdb processes after SECONDS.")
+    ap.add_argument("--concurrency", type=int, default=aio.CONCURRENCY,
+                    help="Maximum number of concurrent subprocesses.")
+    ap.add_argument("--static", metavar="DIR",
+                    help="Also serve the web interface from DIR, eg www.")
+    return ap
+
+
+def main():
+    arg = argparser().parse_args()
+
+    if web is None:
+        sys.stderr.write("The asynchronous server requires aiohttp. "
+                         "Install typediff[aio].\n")
+        return 1
+
+    aio.CONCURRENCY = arg.concurrency
+    app = make_app(timeout=arg.timeout, static=arg.static)
+    web.run_app(app, host=arg.host, port=arg.port)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import math
+import socket
+import argparse
+import platform
+import statistics
+import subprocess
+
+from scipy.stats import mannwhitneyu
+
+
+"""Comparison of benchmark results against a baseline, to catch
+performance regressions before they are merged.
+
+A benchmark has regressed if its median time per unit of work is more
+than the threshold slower than the baseline's and a one-sided
+Mann-Whitney U test across the timed repeats finds the current times
+to be larger with a p-value below alpha, so that noise in a handful of
+repeats is not reported as a regression. Results record the
+environment they were produced in, and differences between the
+environments of the baseline and current results are reported, as
+times from different machines are not comparable. With too few repeats
+no p-value can be below alpha, so such comparisons are reported as
+errors rather than passing.
+"""
+
+
+THRESHOLD = 0.10
+ALPHA = 0.05
+
+ROOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+# environment fields that make results incomparable if they differ
+ENVIRONMENT_FIELDS = ('hostname', 'machine', 'processor', 'cpus', 'python',
+                      'implementation', 'packages')
+
+
+def package_versions(names=('numpy', 'scipy', 'flask', 'lxml')):
+    from importlib import metadata
+
+    versions = {}
+    for name in names:
+        try:
+            versions[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def git_revision():
+    """The commit of the typediff checkout and whether it has local
+    changes, or None if it is not a git checkout."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_PATH,
+                                         stderr=subprocess.DEVNULL)
+        status = subprocess.check_output(['git', 'status', '--porcelain', '-uno'],
+                                         cwd=ROOT_PATH, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return {'commit': commit.decode().strip(), 'dirty': bool(status.strip())}
+
+
+def environment():
+    """Describe the environment benchmarks are run in."""
+    return {
+        'hostname': socket.gethostname(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'packages': package_versions(),
+        'git': git_revision(),
+    }
+
+
+def per_unit(result):
+    units = result['units'] or 1
+    return [s / units for s in result['seconds']]
+
+
+def min_pvalue(n1, n2):
+    """The smallest p-value the exact one-sided Mann-Whitney U test can
+    give for samples of n1 and n2 values."""
+    return 1 / math.comb(n1 + n2, n1)
+
+
+def compare(baseline, current, threshold=THRESHOLD, alpha=ALPHA):
+    """Compare the benchmarks found in both the baseline and current
+    results, returning a list of dicts describing each, with
+    'regression' set for those that have regressed and 'testable' unset
+    for those with too few repeats to find a significant difference."""
+    rows = []
+
+    for name, result in current['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        before = per_unit(baseline['benchmarks'][name])
+        after = per_unit(result)
+        before_median = statistics.median(before)
+        after_median = statistics.median(after)
+        change = after_median / before_median - 1 if before_median else 0
+
+        if len(before) > 1 and len(after) > 1 and set(before) != set(after):
+            p = mannwhitneyu(after, before, alternative='greater').pvalue
+        else:
+            p = None
+
+        rows.append({
+            'benchmark': name,
+            'unit': result['unit'],
+            'baseline': before_median,
+            'current': after_median,
+            'change': change,
+            'p': p,
+            'regression': change > threshold and p is not None and p < alpha,
+            'testable': min_pvalue(len(after), len(before)) < alpha,
+        })
+    return rows
+
+
+def environment_differences(baseline, current):
+    """The environment fields which differ between two results."""
+    before = baseline.get('environment') or {}
+    after = current.get('environment') or {}
+    return [(field, before.get(field), after.get(field))
+            for field in ENVIRONMENT_FIELDS if before.get(field) != after.get(field)]
+
+
+def report(rows, differences=(), threshold=THRESHOLD, alpha=ALPHA):
+    """Format the comparison rows as a text report."""
+    lines = ['{:<18}{:>14}{:>14}{:>9}{:>9}'.format(
+        'benchmark', 'baseline', 'current', 'change', 'p')]
+
+    for row in rows:
+        p = '-' if row['p'] is None else '{:.3f}'.format(row['p'])
+        if row['regression']:
+            flag = '  REGRESSION'
+        elif not row['testable']:
+            flag = '  TOO FEW REPEATS'
+        else:
+            flag = ''
+        lines.append('{:<18}{:>12.1f}us{:>12.1f}us{:>+8.1%}{:>9}{}'.format(
+            row['benchmark'], row['baseline'] * 1e6, row['current'] * 1e6,
+            row['change'], p, flag))
+
+    lines.append('')
+    lines.append('Times are medians per unit of work. Regressions are slowdowns of '
+                 'more than {:.0%} with p < {}.'.format(threshold, alpha))
+
+    for field, before, after in differences:
+        lines.append('Warning: {} differs from the baseline: {} != {}'.format(
+            field, before, after))
+
+    untestable = [row['benchmark'] for row in rows if not row['testable']]
+    if untestable:
+        repeats = 1
+        while min_pvalue(repeats, repeats) >= alpha:
+            repeats += 1
+        lines.append('Error: too few repeats for any p-value to be below {}, so '
+                     'regressions cannot be detected in: {}. Use --repeat {} or '
+                     'more in both runs.'.format(alpha, ', '.join(untestable), repeats))
+
+    regressions = [row['benchmark'] for row in rows if row['regression']]
+    if regressions:
+        lines.append('{} regression(s): {}'.format(len(regressions), ', '.join(regressions)))
+    elif not untestable:
+        lines.append('No regressions.')
+    return '\n'.join(lines) + '\n'
+
+
+def check(baseline_path, current, threshold=THRESHOLD, alpha=ALPHA, output=sys.stderr):
+    """Compare current results with those saved in baseline_path,
+    writing a report to output. Returns 1 if any benchmark has
+    regressed, otherwise 2 if any has too few repeats to be tested,
+    otherwise 0."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    rows = compare(baseline, current, threshold=threshold, alpha=alpha)
+    differences = environment_differences(baseline, current)
+    output.write(report(rows, differences, threshold=threshold, alpha=alpha))
+    if any(row['regression'] for row in rows):
+        return 1
+    if not all(row['testable'] for row in rows):
+        return 2
+    return 0
+
+
+def argparser():
+    ap = argparse.ArgumentParser(
+        description="Compare typediff-bench results with a baseline, exiting "
+        "with status 1 if any benchmark has regressed, or 2 if any has too few "
+        "repeats to tell.")
+    ap.add_argument("baseline", metavar="BASELINE", help="Baseline results.")
+    ap.add_argument("current", metavar="CURRENT", help="Results to check.")
+    ap.add_argument("--threshold", type=float, default=THRESHOLD,
+                    help="Smallest slowdown, as a fraction, that is a regression.")
+    ap.add_argument("--alpha", type=float, default=ALPHA,
+                    help="Significance level of the Mann-Whitney U test.")
+    return ap
+
+
+def main():
+    arg = argparser().parse_args()
+    with open(arg.current) as f:
+        current = json.load(f)
+    return check(arg.baseline, current, threshold=arg.threshold, alpha=arg.alpha,
+                 output=sys.stdout)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
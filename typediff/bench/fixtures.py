@@ -0,0 +1,315 @@
+import os
+import re
+import sys
+import gzip
+import json
+import hashlib
+import argparse
+from collections import Counter
+
+from ..delphin import parse_derivation, Token
+
+
+"""Build the fixtures replayed by the benchmark stand-ins for ACE, the
+typifier and tsdb from [incr tsdb()] profiles and type count files,
+such as the profiles in data/wsj08a and data/handp12_rels and the
+counts in tests/*_counts.
+
+The fixtures directory contains:
+
+    tsdb/PROFILE.json  -- the results of each profile joined with their
+                          parse, item and tree records
+    ace/DIGEST.txt     -- the ACE output for each input, keyed by the
+                          digest of the input
+    ace/index.json     -- the inputs with recorded ACE output
+    typifier/DIGEST.json -- the json tree and number of types for each
+                          derivation, keyed by the digest of the derivation
+    types.json         -- the names and counts of types and lexical
+                          types, from which typifier output is drawn
+    grammar.xml        -- a type hierarchy covering all the type names
+
+No typifier output is recorded in the repository, so the stand-in
+typifier draws the types of each derivation from the recorded type
+counts, in proportion to the size of the derivation and seeded by its
+digest, so that the same derivation always yields the same types.
+"""
+
+
+ROOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+DEFAULT_PROFILES = [
+    os.path.join(ROOT_PATH, 'data', 'wsj08a', 'wsj08a'),
+    os.path.join(ROOT_PATH, 'data', 'wsj08a', 'wsj08a_20140605'),
+    os.path.join(ROOT_PATH, 'data', 'handp12_rels', 'handp12_rels-20171108'),
+]
+
+DEFAULT_COUNTS = os.path.join(ROOT_PATH, 'tests')
+
+# fields of the joined profile records available to the tsdb stand-in
+RECORD_FIELDS = ('i-id', 'result-id', 'mrs', 'p-tokens', 'derivation',
+                 'i-input', 'readings', 't-active', 'i-length')
+
+# the supertypes that typediff groups types under, from config.TYPES
+KINDS = ('sign', 'synsem', 'head', 'cat', 'relation', 'predsort')
+
+ESCAPES = {'\\\\': '\\', '\\s': '@', '\\n': '\n'}
+ESCAPE_RE = re.compile(r'\\[\\sn]')
+
+
+def digest(text):
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+
+def read_relations(path):
+    """Map the name of each relation of a profile onto its field names."""
+    relations = {}
+    name = None
+
+    with open(os.path.join(path, 'relations')) as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            if not line[0].isspace():
+                name = line.strip().rstrip(':')
+                relations[name] = []
+            else:
+                relations[name].append(line.split()[0])
+    return relations
+
+
+def read_relation(path, name, fields):
+    """Yield the records of a relation of a profile as dictionaries,
+    reading the relation's file whether gzipped or not."""
+    filename = os.path.join(path, name)
+    if os.path.exists(filename + '.gz'):
+        f = gzip.open(filename + '.gz', 'rt', encoding='utf8')
+    elif os.path.exists(filename):
+        f = open(filename, encoding='utf8')
+    else:
+        return
+
+    with f:
+        for line in f:
+            values = line.rstrip('\n').split('@')
+            yield {field: ESCAPE_RE.sub(lambda m: ESCAPES[m.group()], value)
+                   for field, value in zip(fields, values)}
+
+
+def int_or(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def profile_records(path):
+    """Return the results of a profile joined with their parse, item and
+    tree records, as a list of dictionaries with RECORD_FIELDS."""
+    relations = read_relations(path)
+    items = {r['i-id']: r for r in read_relation(path, 'item', relations['item'])}
+    parses = {r['parse-id']: r for r in read_relation(path, 'parse', relations['parse'])}
+    active = {r['parse-id']: int_or(r['t-active'], 0)
+              for r in read_relation(path, 'tree', relations.get('tree', []))}
+    records = []
+
+    for result in read_relation(path, 'result', relations['result']):
+        parse = parses.get(result['parse-id'])
+        if parse is None or parse['i-id'] not in items:
+            continue
+        item = items[parse['i-id']]
+        records.append({
+            'i-id': int(item['i-id']),
+            'result-id': int_or(result['result-id'], 0),
+            'mrs': result.get('mrs', '').replace('\n', ' '),
+            'p-tokens': parse.get('p-tokens', ''),
+            'derivation': result['derivation'].replace('\n', ' '),
+            'i-input': item['i-input'],
+            'readings': int_or(parse.get('readings'), 0),
+            't-active': active.get(result['parse-id'], 0),
+            'i-length': int_or(item.get('i-length'), 0),
+        })
+    return records
+
+
+def read_counts(path):
+    """Read a file of lines of the form 'COUNT NAME' into a Counter."""
+    counts = Counter()
+    with open(path) as f:
+        for line in f:
+            bits = line.split()
+            if len(bits) == 2:
+                counts[bits[1]] += int(bits[0])
+    return counts
+
+
+def json_tree(tree, lextypes):
+    """Convert a Tree into the json tree output by the typifier. Lexical
+    nodes are labelled with a lexical type drawn from lextypes."""
+    child = tree.children[0]
+    if isinstance(child, Token):
+        index = int(digest(tree.label), 16) % len(lextypes)
+        return {'label': lextypes[index], 'shortlabel': tree.label.upper(),
+                'rule': False, 'from': child.from_char, 'to': child.to_char,
+                'lexident': child.string, 'daughters': []}
+
+    daughters = [json_tree(c, lextypes) for c in tree.children]
+    return {'label': tree.label, 'shortlabel': tree.label.split('_')[0].upper(),
+            'rule': tree.label, 'from': daughters[0]['from'],
+            'to': daughters[-1]['to'], 'daughters': daughters}
+
+
+def count_nodes(tree):
+    nodes = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        nodes += 1
+        if not isinstance(node.children[0], Token):
+            stack.extend(node.children)
+    return nodes
+
+
+def hierarchy_xml(names):
+    """Return a type hierarchy in the XML format of types-to-xml covering
+    names. Each type is placed under one of KINDS, by way of one of a
+    few glb types per kind, and some also under a second kind."""
+    parents = {kind: ['*top*'] for kind in KINDS}
+
+    for kind in KINDS:
+        for i in range(4):
+            parents['glbtype_{}_{}'.format(kind, i)] = [kind]
+
+    for name in names:
+        if name in parents or name == '*top*':
+            continue
+        n = int(digest(name), 16)
+        kind = KINDS[n % len(KINDS)]
+        parents[name] = ['glbtype_{}_{}'.format(kind, (n >> 8) % 4)]
+        if n % 5 == 0:
+            parents[name].append(KINDS[(n >> 16) % len(KINDS)])
+
+    children = {name: [] for name in parents}
+    children['*top*'] = []
+    for name, ps in parents.items():
+        for p in ps:
+            children[p].append(name)
+
+    def element(name):
+        return '<type name="{}"><parents>{}</parents><children>{}</children></type>'.format(
+            escape_xml(name),
+            ''.join('<type name="{}"/>'.format(escape_xml(p)) for p in parents.get(name, [])),
+            ''.join('<type name="{}"/>'.format(escape_xml(c)) for c in children[name]))
+
+    return '\n'.join(element(name) for name in ['*top*'] + list(parents)) + '\n'
+
+
+def escape_xml(name):
+    return (name.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;'))
+
+
+def write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def build(output, profiles=None, counts=None):
+    """Build fixtures in the directory output from the profile
+    directories profiles and the type count files found in the directory
+    counts, returning a summary of what was built."""
+    profiles = DEFAULT_PROFILES if profiles is None else profiles
+    counts = DEFAULT_COUNTS if counts is None else counts
+
+    for subdir in ('tsdb', 'ace', 'typifier'):
+        os.makedirs(os.path.join(output, subdir), exist_ok=True)
+
+    types = Counter()
+    lextypes = Counter()
+    for name in sorted(os.listdir(counts)):
+        if not name.endswith('_counts'):
+            continue
+        file_counts = read_counts(os.path.join(counts, name))
+        if 'lextype' in name:
+            lextypes.update(file_counts)
+        # counts files overlap, so take the largest count of each type
+        for t, count in file_counts.items():
+            types[t] = max(types[t], count)
+
+    lextype_names = sorted(lextypes) or ['lex_item']
+    outputs = {}
+    derivations = {}
+    summary = {'profiles': {}, 'inputs': 0, 'derivations': 0}
+
+    recorded = []
+    for path in profiles:
+        profile = os.path.basename(os.path.normpath(path))
+        records = profile_records(path)
+        write_json(os.path.join(output, 'tsdb', profile + '.json'), records)
+        summary['profiles'][profile] = len(records)
+        recorded.append(records)
+
+        for record in records:
+            outputs.setdefault(record['i-input'], []).append(record)
+            derivations.setdefault(digest(record['derivation']), record['derivation'])
+
+    # the number of types produced per derivation node, estimated from
+    # the active trees of the first treebanked profile, as the counts
+    # files were collected from active trees
+    nodes = 0
+    for records in recorded:
+        seen = set()
+        for record in records:
+            if record['t-active'] > 0 and record['i-id'] not in seen:
+                seen.add(record['i-id'])
+                nodes += count_nodes(parse_derivation(record['derivation']))
+        if nodes:
+            break
+    per_node = sum(types.values()) / nodes if nodes else 30
+
+    for key, derivation in derivations.items():
+        tree = parse_derivation(derivation)
+        write_json(os.path.join(output, 'typifier', key + '.json'), {
+            'tree': json_tree(tree, lextype_names),
+            'size': int(round(count_nodes(tree) * per_node)),
+        })
+
+    inputs = sorted(outputs)
+    for text in inputs:
+        records = sorted(outputs[text], key=lambda r: r['result-id'])
+        lines = ['SENT: {}'.format(text)]
+        lines.extend('{} ; {}'.format(r['mrs'], r['derivation']) for r in records)
+        with open(os.path.join(output, 'ace', digest(text) + '.txt'), 'w') as f:
+            f.write('\n'.join(lines) + '\n\n')
+    write_json(os.path.join(output, 'ace', 'index.json'), inputs)
+
+    names = sorted(types)
+    write_json(os.path.join(output, 'types.json'), {
+        'names': names,
+        'counts': [types[n] for n in names],
+    })
+    with open(os.path.join(output, 'grammar.xml'), 'w') as f:
+        f.write(hierarchy_xml(names))
+
+    summary['inputs'] = len(inputs)
+    summary['derivations'] = len(derivations)
+    summary['types'] = len(names)
+    summary['per_node'] = round(per_node, 3)
+    return summary
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Build benchmark fixtures.")
+    ap.add_argument("output", metavar="DIR", help="Directory to write fixtures to.")
+    ap.add_argument("--profile", action='append', dest='profiles', metavar="PATH",
+                    help="Profile to record; may be repeated. Defaults to the "
+                    "wsj08a and handp12_rels profiles in data.")
+    ap.add_argument("--counts", metavar="DIR",
+                    help="Directory of *_counts files. Defaults to tests.")
+    arg = ap.parse_args()
+    summary = build(arg.output, profiles=arg.profiles, counts=arg.counts)
+    json.dump(summary, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == "__main__":
+    sys.exit(main())
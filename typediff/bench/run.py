@@ -0,0 +1,388 @@
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import tempfile
+import itertools
+import statistics
+from datetime import datetime
+from collections import defaultdict
+
+from . import compare
+from . import fixtures
+from . import standins
+from .. import timing
+
+
+"""Benchmarks of the stages of processing typediff requests, run against
+stand-ins for ACE, the typifier and tsdb that replay recorded outputs,
+so that results reflect the cost of typediff's own code and can be
+compared between machines and revisions without a grammar installed.
+
+The benchmarks run against a configuration of their own, installed as
+the typediff.settings module before typediff is configured, with the
+stand-ins in place of the real programs and the result caches turned
+off, so that each repeat does the same work. Results are written as
+JSON, along with the environment they were produced in and the time
+taken by each stage within a benchmark, and can be checked against a
+baseline with --baseline (see bench.compare).
+"""
+
+
+STANDIN_SCRIPT = '#!/bin/sh\nexec "{python}" "{script}" {program} "{fixtures}" "$@"\n'
+
+
+def install_settings(workdir, fixtures_dir, profiles):
+    """Write the stand-in programs and grammar data to workdir and
+    install settings using them, returning the settings module."""
+    bindir = os.path.join(workdir, 'bin')
+    datapath = os.path.join(workdir, 'data')
+    os.makedirs(bindir, exist_ok=True)
+    os.makedirs(datapath, exist_ok=True)
+
+    for program in ('ace', 'typifier', 'tsdb'):
+        path = os.path.join(bindir, program)
+        with open(path, 'w') as f:
+            f.write(STANDIN_SCRIPT.format(python=sys.executable,
+                                          script=os.path.abspath(standins.__file__),
+                                          program=program,
+                                          fixtures=os.path.abspath(fixtures_dir)))
+        os.chmod(path, 0o755)
+    os.environ['PATH'] = bindir + os.pathsep + os.environ.get('PATH', '')
+
+    shutil.copy(os.path.join(fixtures_dir, 'grammar.xml'),
+                os.path.join(datapath, 'erg.xml'))
+    for name in ('erg.dat', 'english.tdl'):
+        open(os.path.join(datapath, name), 'w').close()
+
+    settings = types.ModuleType('typediff.settings')
+    settings.DATAPATH = datapath
+    settings.LOGONROOT = None
+    settings.FANGORNPATH = None
+    settings.LTDBPATH = None
+    settings.ACEBIN = os.path.join(bindir, 'ace')
+    settings.LOGPATH = None
+    settings.GRAMMARLIST = ({
+        'alias': 'erg',
+        'shortname': 'ERG',
+        'longname': 'Benchmark stand-in for the ERG',
+        'aceconfig': '',
+        'tdlfile': os.path.join(datapath, 'english.tdl'),
+    },)
+    settings.TREEBANKLIST = ()
+    settings.PROFILELIST = tuple({
+        'alias': name,
+        'name': name,
+        'home': os.path.join(workdir, 'profiles', name),
+        'grammar': 'erg',
+        'treebank': name,
+    } for name in profiles)
+    settings.JOBSPATH = os.path.join(workdir, 'jobs.sqlite')
+    settings.CACHEPATH = None
+    settings.CACHEMEMORY = 0
+    settings.CACHEDISK = 0
+    settings.LOCKPATH = os.path.join(workdir, 'locks')
+    settings.TIMINGPATH = None
+    settings.METRICSPATH = None
+
+    if 'typediff.config' in sys.modules:
+        raise RuntimeError("typediff was configured before the benchmark settings "
+                           "could be installed")
+    sys.modules['typediff.settings'] = settings
+
+    from .. import config
+    config.TYPIFIERBIN = os.path.join(bindir, 'typifier')
+    return settings
+
+
+class Context:
+    """The fixtures and prepared inputs shared by the benchmarks."""
+
+    def __init__(self, fixtures_dir, arg):
+        from ..gram import get_grammar
+
+        self.fixtures = fixtures_dir
+        self.arg = arg
+        self.grammar = get_grammar('erg')
+        self.profiles = {}
+
+        for name in sorted(os.listdir(os.path.join(fixtures_dir, 'tsdb'))):
+            with open(os.path.join(fixtures_dir, 'tsdb', name)) as f:
+                self.profiles[os.path.splitext(name)[0]] = json.load(f)
+
+        records = list(itertools.chain.from_iterable(self.profiles.values()))
+        self.records = records[:arg.limit] if arg.limit else records
+
+        types = standins.load_types(fixtures_dir)
+        self.outputs = [standins.typifier_output(fixtures_dir, r['derivation'], types)
+                        for r in self.records]
+        self.readings = [self.make_reading(r, out)
+                         for r, out in zip(self.records, self.outputs)]
+        self.items = self.make_items(self.readings)
+        half = len(self.items) // 2
+        self.pos_items, self.neg_items = self.items[:half], self.items[half:]
+
+    def make_reading(self, record, output):
+        from ..delphin import Reading
+
+        reading = Reading(record['derivation'], iid=record['i-id'],
+                          resultid=record['result-id'], mrs=record['mrs'],
+                          grammar=self.grammar, ptokens=record['p-tokens'] or None)
+        reading.add_typifier_output(output, '')
+        return reading
+
+    def make_items(self, readings):
+        from ..delphin import ProfileItem
+
+        inputs = {r['i-id']: r['i-input'] for r in self.records}
+        return [ProfileItem(inputs[iid], self.grammar, list(group))
+                for iid, group in itertools.groupby(readings, key=lambda r: r.iid)]
+
+
+def bench_derivation(ctx):
+    from ..delphin import parse_derivation
+
+    for record in ctx.records:
+        parse_derivation(record['derivation'])
+    return len(ctx.records), 'derivations'
+
+
+def bench_reading(ctx):
+    for record, output in zip(ctx.records, ctx.outputs):
+        ctx.make_reading(record, output)
+    return len(ctx.records), 'readings'
+
+
+def bench_hierarchy_load(ctx):
+    from ..delphin import load_hierarchy, get_symbols
+
+    hierarchy = load_hierarchy(ctx.grammar.types_path, symbols=get_symbols(ctx.grammar))
+    return len(hierarchy.types), 'types'
+
+
+def bench_supers(ctx):
+    from ..typediff import get_hierarchy
+
+    hierarchy = get_hierarchy(ctx.grammar)
+    for item in ctx.items:
+        item.load_supers(hierarchy)
+    return len(ctx.readings), 'readings'
+
+
+def bench_stats(ctx):
+    from ..delphin import TypeStats
+
+    stats = defaultdict(TypeStats)
+    for reading in ctx.readings:
+        for i, count in zip(reading.type_ids, reading.type_counts):
+            stats[i].update(count)
+    return len(ctx.readings), 'readings'
+
+
+def bench_rank(ctx):
+    from ..delphin import dotdict
+    from ..typediff import rank_types
+
+    opts = dotdict({'grammar': ctx.grammar, 'rank': 'llr', 'all': False,
+                    'min_pos': 1, 'max_neg': 0, 'd': True})
+    rank_types(ctx.pos_items, ctx.neg_items, opts)
+    return len(ctx.items), 'items'
+
+
+def bench_json(ctx):
+    from ..delphin import JSONEncoder, item_dict
+
+    data = {
+        'pos-items': [item_dict(x, 'web') for x in ctx.pos_items],
+        'neg-items': [item_dict(x, 'web') for x in ctx.neg_items],
+    }
+    json.dumps(data, cls=JSONEncoder)
+    return len(ctx.items), 'items'
+
+
+def post(ctx, path, form):
+    from ..server import app
+
+    with app.test_client() as client:
+        response = client.post(path, data=form)
+    body = response.get_data(as_text=True)
+    if response.status_code != 200:
+        raise RuntimeError("{} failed with status {}: {}".format(
+            path, response.status_code, body))
+    data = json.loads(body)
+    if not data.get('success'):
+        raise RuntimeError("{} failed: {}".format(path, data.get('error', '')))
+    return data
+
+
+def bench_parse_types(ctx):
+    inputs = []
+    for record in ctx.records:
+        if record['i-input'] not in inputs:
+            inputs.append(record['i-input'])
+        if len(inputs) == ctx.arg.sentences:
+            break
+    half = len(inputs) // 2
+    data = post(ctx, '/parse-types', {
+        'pos-items': '\n'.join(inputs[:half]),
+        'neg-items': '\n'.join(inputs[half:]),
+        'grammar-name': 'erg',
+        'count': ctx.arg.count,
+        'supers': 'true',
+    })
+    return len(data['pos-items']) + len(data['neg-items']), 'items'
+
+
+def profile_filter(records, n):
+    """A tsql condition selecting the first n items of records."""
+    iids = sorted(set(r['i-id'] for r in records))[:n]
+    if not iids:
+        return ''
+    return 'i-id >= {} and i-id <= {}'.format(iids[0], iids[-1])
+
+
+def bench_process_profiles(ctx):
+    names = list(ctx.profiles)
+    pos, neg = names[0], names[-1]
+    data = post(ctx, '/process-profiles', {
+        'pos-profile': pos,
+        'pos-profile-filter': profile_filter(ctx.profiles[pos], ctx.arg.profile_items),
+        'neg-profile': neg,
+        'neg-profile-filter': profile_filter(ctx.profiles[neg], ctx.arg.profile_items),
+        'rank': 'llr',
+    })
+    return len(data['pos-items']) + len(data['neg-items']), 'items'
+
+
+BENCHMARKS = (
+    ('derivation', bench_derivation),
+    ('reading', bench_reading),
+    ('hierarchy-load', bench_hierarchy_load),
+    ('supers', bench_supers),
+    ('stats', bench_stats),
+    ('rank', bench_rank),
+    ('json', bench_json),
+    ('parse-types', bench_parse_types),
+    ('process-profiles', bench_process_profiles),
+)
+
+
+def measure(func, ctx, repeat, warmup):
+    """Run func repeat times after warmup runs, returning the result of
+    the benchmark."""
+    for _i in range(warmup):
+        func(ctx)
+
+    seconds = []
+    for _i in range(repeat):
+        with timing.recording(func.__name__) as recorder:
+            start = time.perf_counter()
+            units, unit = func(ctx)
+            seconds.append(time.perf_counter() - start)
+
+    median = statistics.median(seconds)
+    return {
+        'unit': unit,
+        'units': units,
+        'seconds': [round(s, 6) for s in seconds],
+        'min': round(min(seconds), 6),
+        'median': round(median, 6),
+        'mean': round(statistics.mean(seconds), 6),
+        'per_second': round(units / median, 3) if median else None,
+        'stages': recorder.summary()['stages'],
+    }
+
+
+def argparser():
+    ap = argparse.ArgumentParser(
+        description="Benchmark typediff against stand-ins for ACE, the typifier "
+        "and tsdb that replay recorded outputs.")
+    ap.add_argument("--output", default='-', metavar="PATH",
+                    help="Write the results as JSON to PATH, or stdout if '-'.")
+    ap.add_argument("--only", action='append', metavar="NAME",
+                    choices=[name for name, _func in BENCHMARKS],
+                    help="Run only the named benchmark; may be repeated.")
+    ap.add_argument("--repeat", type=int, default=5,
+                    help="Number of timed runs of each benchmark.")
+    ap.add_argument("--warmup", type=int, default=1,
+                    help="Number of untimed runs of each benchmark.")
+    ap.add_argument("--limit", type=int, default=200,
+                    help="Number of recorded results to use, or 0 for all.")
+    ap.add_argument("--sentences", type=int, default=8,
+                    help="Number of sentences to send to /parse-types.")
+    ap.add_argument("--count", type=int, default=5,
+                    help="Number of readings to request per sentence.")
+    ap.add_argument("--profile-items", type=int, default=20,
+                    help="Number of items of each profile to send to /process-profiles.")
+    ap.add_argument("--fixtures", metavar="DIR",
+                    help="Use fixtures previously built in DIR.")
+    ap.add_argument("--profile", action='append', dest='profiles', metavar="PATH",
+                    help="Profile to build fixtures from; may be repeated.")
+    ap.add_argument("--counts", metavar="DIR",
+                    help="Directory of *_counts files to build fixtures from.")
+    ap.add_argument("--workdir", metavar="DIR",
+                    help="Directory for fixtures and stand-ins. Defaults to a "
+                    "temporary directory.")
+    ap.add_argument("--baseline", metavar="PATH",
+                    help="Compare the results with those saved in PATH, exiting "
+                    "with status 1 if any benchmark has regressed.")
+    ap.add_argument("--threshold", type=float, default=compare.THRESHOLD,
+                    help="Smallest slowdown, as a fraction, that is a regression.")
+    ap.add_argument("--alpha", type=float, default=compare.ALPHA,
+                    help="Significance level of the Mann-Whitney U test.")
+    return ap
+
+
+def main():
+    arg = argparser().parse_args()
+    workdir = arg.workdir or tempfile.mkdtemp(prefix='typediff-bench-')
+    os.makedirs(workdir, exist_ok=True)
+
+    fixtures_dir = arg.fixtures
+    if fixtures_dir is None:
+        fixtures_dir = os.path.join(workdir, 'fixtures')
+        summary = fixtures.build(fixtures_dir, profiles=arg.profiles, counts=arg.counts)
+    else:
+        summary = None
+
+    profiles = sorted(os.path.splitext(name)[0]
+                      for name in os.listdir(os.path.join(fixtures_dir, 'tsdb')))
+    install_settings(workdir, fixtures_dir, profiles)
+    ctx = Context(fixtures_dir, arg)
+
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'environment': compare.environment(),
+        'options': {k: v for k, v in vars(arg).items()
+                    if k not in ('output', 'baseline', 'threshold', 'alpha')},
+        'fixtures': summary,
+        'benchmarks': {},
+    }
+
+    for name, func in BENCHMARKS:
+        if arg.only and name not in arg.only:
+            continue
+        sys.stderr.write("running {}\n".format(name))
+        results['benchmarks'][name] = measure(func, ctx, arg.repeat, arg.warmup)
+
+    text = json.dumps(results, indent=2) + '\n'
+    if arg.output == '-':
+        sys.stdout.write(text)
+    else:
+        with open(arg.output, 'w') as f:
+            f.write(text)
+
+    if arg.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if arg.baseline is not None:
+        return compare.check(arg.baseline, results, threshold=arg.threshold,
+                             alpha=arg.alpha)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import os
+import re
+import sys
+import json
+import random
+import hashlib
+
+
+"""Stand-ins for the ace, typifier and tsdb programs, which replay the
+output recorded in a fixtures directory built by bench.fixtures. They
+are run as scripts, with the name of the program to stand in for and
+the fixtures directory preceding the program's usual arguments:
+
+    standins.py ace FIXTURES -g GRAMMAR.dat -n 5 < sentence
+    standins.py typifier FIXTURES GRAMMAR.dat < derivation
+    standins.py tsdb FIXTURES -home PROFILE -query QUERY
+
+This module only uses the standard library and is not imported by
+typediff, so that the stand-ins start as quickly as possible.
+"""
+
+
+CONDITION_RE = re.compile(r'^\s*([\w-]+)\s*(<=|>=|!=|=|<|>)\s*(\S+)\s*$')
+
+OPERATORS = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '>': lambda a, b: a > b,
+    '<=': lambda a, b: a <= b,
+    '>=': lambda a, b: a >= b,
+}
+
+# fields which vary across the results of an item
+RESULT_FIELDS = ('result-id', 'mrs', 'derivation')
+
+
+def digest(text):
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+
+def option(args, name, default=None):
+    if name in args and args.index(name) + 1 < len(args):
+        return args[args.index(name) + 1]
+    return default
+
+
+def ace(fixtures, args):
+    """Replay the ACE output recorded for the input on stdin. Inputs
+    without a recording are given that of a recorded input chosen by
+    their digest."""
+    text = sys.stdin.read().strip()
+    count = int(option(args, '-n', 0))
+    path = os.path.join(fixtures, 'ace', digest(text) + '.txt')
+
+    if not os.path.exists(path):
+        with open(os.path.join(fixtures, 'ace', 'index.json')) as f:
+            inputs = json.load(f)
+        if not inputs:
+            sys.stdout.write('SKIP: {}\n'.format(text))
+            return 0
+        recorded = inputs[int(digest(text), 16) % len(inputs)]
+        path = os.path.join(fixtures, 'ace', digest(recorded) + '.txt')
+
+    with open(path) as f:
+        lines = f.read().strip().splitlines()
+
+    results = lines[1:count + 1] if count else lines[1:]
+    sys.stdout.write('SENT: {}\n'.format(text))
+    for line in results:
+        sys.stdout.write(line + '\n')
+    sys.stdout.write('\n')
+    sys.stderr.write('NOTE: {} readings, added 0 / 0 edges to chart\n'.format(len(results)))
+    return 0
+
+
+def load_types(fixtures):
+    with open(os.path.join(fixtures, 'types.json')) as f:
+        return json.load(f)
+
+
+def typifier_output(fixtures, derivation, types):
+    """Return the typifier output for derivation: its types, drawn from
+    the recorded type counts seeded by the digest of the derivation,
+    followed by its json tree."""
+    key = digest(derivation)
+    path = os.path.join(fixtures, 'typifier', key + '.json')
+
+    if os.path.exists(path):
+        with open(path) as f:
+            recorded = json.load(f)
+    else:
+        recorded = {'tree': {'label': 'unknown', 'shortlabel': '?', 'rule': False,
+                             'from': 0, 'to': 0, 'lexident': '', 'daughters': []},
+                    'size': 1000}
+
+    rng = random.Random(key)
+    names = rng.choices(types['names'], weights=types['counts'], k=recorded['size'])
+    return '\n'.join(names) + '\n\n' + json.dumps(recorded['tree']) + '\n'
+
+
+def typifier(fixtures, args):
+    """Write the types and json tree of the derivation on stdin."""
+    derivation = sys.stdin.read().strip()
+    sys.stdout.write(typifier_output(fixtures, derivation, load_types(fixtures)))
+    return 0
+
+
+def parse_query(query):
+    """Split a tsql query into the selected fields and a list of
+    (field, operator, value) conditions joined by 'and'."""
+    words = query.split()
+    if not words or words[0] != 'select':
+        raise ValueError("unsupported query: {}".format(query))
+
+    fields = []
+    rest = words[1:]
+    while rest and rest[0] not in ('from', 'where'):
+        fields.append(rest.pop(0))
+    if rest and rest[0] == 'from':
+        rest = rest[2:]
+
+    conditions = []
+    if rest and rest[0] == 'where':
+        for clause in ' '.join(rest[1:]).split(' and '):
+            match = CONDITION_RE.match(clause)
+            if match is None:
+                raise ValueError("unsupported condition: {}".format(clause))
+            field, op, value = match.groups()
+            try:
+                value = int(value)
+            except ValueError:
+                value = value.strip('"')
+            conditions.append((field, op, value))
+    return fields, conditions
+
+
+def tsdb(fixtures, args):
+    """Answer a select query against the records of the profile given by
+    -home, which are those recorded for the profile of the same name."""
+    profile = os.path.basename(os.path.normpath(option(args, '-home', '')))
+    query = option(args, '-query', '')
+    path = os.path.join(fixtures, 'tsdb', profile + '.json')
+
+    if not os.path.exists(path):
+        sys.stderr.write("invalid profile `{}'\n".format(profile))
+        return 1
+
+    try:
+        fields, conditions = parse_query(query)
+    except ValueError as e:
+        sys.stderr.write(str(e) + '\n')
+        return 1
+
+    with open(path) as f:
+        records = json.load(f)
+
+    for field in fields + [c[0] for c in conditions]:
+        if records and field not in records[0]:
+            sys.stderr.write("unknown attribute `{}'\n".format(field))
+            return 1
+
+    # fields of items alone yield one row per item, as tsdb does
+    per_result = any(f in RESULT_FIELDS for f in fields + [c[0] for c in conditions])
+    seen = set()
+    out = []
+
+    for record in records:
+        if not all(OPERATORS[op](record[field], value)
+                   for field, op, value in conditions):
+            continue
+        if not per_result:
+            if record['i-id'] in seen:
+                continue
+            seen.add(record['i-id'])
+        out.append(' | '.join(str(record[f]) for f in fields))
+
+    sys.stdout.write('\n'.join(out) + ('\n' if out else ''))
+    return 0
+
+
+PROGRAMS = {
+    'ace': ace,
+    'typifier': typifier,
+    'tsdb': tsdb,
+}
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in PROGRAMS:
+        sys.stderr.write("usage: standins.py ace|typifier|tsdb FIXTURES ARGS...\n")
+        return 2
+    return PROGRAMS[sys.argv[1]](sys.argv[2], sys.argv[3:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
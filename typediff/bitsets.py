@@ -0,0 +1,124 @@
+from itertools import chain
+
+import numpy as np
+
+from . import timing
+from .delphin import get_symbols
+
+
+"""Word-parallel set algebra over the types used by large sets of items.
+
+Each item is represented by a row of bits, one for each type id in the
+grammar's symbol table, packed into 64 bit words. Unions,
+intersections and differences of the types used across sets of items
+are then computed with bitwise operations over whole words, and
+per-type item counts are computed column-wise across the matrix.
+"""
+
+
+WORD = np.uint64
+WORD_BITS = 64
+
+
+class TypeBitsets:
+    """An items x types bit matrix for a list of items, whose readings'
+    type ids come from the symbol table of the supplied grammar."""
+
+    def __init__(self, items, grammar, all_readings=False):
+        self.symbols = get_symbols(grammar)
+        rows = []
+
+        for item in items:
+            readings = item.readings if all_readings else item.readings[:1]
+            rows.append(set(chain.from_iterable(r.type_ids for r in readings)))
+
+        self.width = len(self.symbols)
+        words = -(-self.width // WORD_BITS)
+        bits = np.zeros((len(rows), words*WORD_BITS), dtype=bool)
+
+        for i, ids in enumerate(rows):
+            bits[i, list(ids)] = True
+
+        # packbits is big-endian within each byte, so unpacking the
+        # bytes of the words again restores the original bit order
+        self.matrix = np.packbits(bits, axis=1).view(WORD)
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def union(self, rows):
+        """Bitset of the types used by any of the items in rows."""
+        return np.bitwise_or.reduce(self.matrix[rows], axis=0,
+                                    initial=WORD(0))
+
+    def intersection(self, rows):
+        """Bitset of the types used by every item in rows."""
+        return np.bitwise_and.reduce(self.matrix[rows], axis=0,
+                                     initial=~WORD(0))
+
+    def counts(self, rows):
+        """Array of the number of items in rows that use each type."""
+        selected = self.matrix[rows]
+        bits = np.unpackbits(selected.view(np.uint8), axis=1, count=self.width)
+        return bits.sum(axis=0)
+
+    def at_least(self, rows, k):
+        """Bitset of the types used by at least k of the items in rows."""
+        return self.pack(self.counts(rows) >= k)
+
+    def pack(self, flags):
+        """Convert an array of per-type booleans into a bitset."""
+        bits = np.zeros(self.matrix.shape[1]*WORD_BITS, dtype=bool)
+        bits[:len(flags)] = flags
+        return np.packbits(bits).view(WORD)
+
+    def ids(self, bitset):
+        """Array of the type ids set in a bitset."""
+        return np.flatnonzero(np.unpackbits(bitset.view(np.uint8), count=self.width))
+
+    def names(self, ids):
+        return [self.symbols.name(i) for i in ids]
+
+
+@timing.span('diff')
+def diff_bitsets(pos_items, neg_items, opts):
+    """Perform the difference, intersection or union of the types used by
+    the positive and negative items, as specified by the d, i and u
+    attributes of opts. A type belongs to the positive types if it is
+    used by at least opts.min_pos positive items (by default any), and
+    to the negative types if it is used by more than opts.max_neg
+    negative items (by default none). Returns the bit matrix, the
+    resulting type ids and the per-type item counts for the positive
+    and negative items."""
+    bitsets = TypeBitsets(list(pos_items) + list(neg_items), opts.grammar,
+                          all_readings=bool(opts.all))
+    pos_rows = np.arange(len(pos_items))
+    neg_rows = np.arange(len(pos_items), len(bitsets))
+    pos_counts = bitsets.counts(pos_rows)
+    neg_counts = bitsets.counts(neg_rows)
+    min_pos = opts.min_pos or 1
+    max_neg = opts.max_neg or 0
+
+    if min_pos > 1:
+        pos_types = bitsets.pack(pos_counts >= min_pos)
+    else:
+        pos_types = bitsets.union(pos_rows)
+
+    if max_neg > 0:
+        neg_types = bitsets.pack(neg_counts > max_neg)
+    else:
+        neg_types = bitsets.union(neg_rows)
+
+    if len(neg_rows) == 0:
+        result = pos_types
+    elif len(pos_rows) == 0:
+        result = neg_types
+    elif opts.i:
+        result = pos_types & neg_types
+    elif opts.u:
+        result = pos_types | neg_types
+    else:
+        result = pos_types & ~neg_types
+
+    ids = bitsets.ids(result)
+    return bitsets, ids, pos_counts[ids], neg_counts[ids]
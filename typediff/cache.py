@@ -0,0 +1,169 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from . import metrics
+
+
+"""A size-bounded cache of processed results, such as the items of
+gold profiles, which are static and expensive to reprocess.
+
+Entries are strings, such as the JSON serialization of the items, which
+are kept encoded in memory in least-recently-used order. When a cache
+directory is configured, entries are also written to disk, so that they
+are shared with other processes and survive restarts, and entries
+evicted from memory can be reloaded from there. Nothing read from the
+directory is unpickled, so entries cannot run code in the server. The
+disk cache is bounded separately, evicting the least recently used
+files.
+"""
+
+
+DIGESTS = {}
+
+
+def file_digest(path):
+    """Return a SHA-256 digest of a file's contents. Digests are
+    remembered for as long as the file's size and modification time
+    are unchanged, as grammar images are large."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    key = (path, stat.st_size, stat.st_mtime)
+    if key not in DIGESTS:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                digest.update(chunk)
+        DIGESTS[key] = digest.hexdigest()
+    return DIGESTS[key]
+
+
+def cache_key(*parts):
+    """Convert a sequence of JSON serializable values into a key."""
+    return hashlib.sha1(json.dumps(parts).encode('utf8')).hexdigest()
+
+
+class ResultCache:
+    """An LRU cache of string values, bounded to max_bytes in memory and
+    max_disk_bytes on disk in cache_dir, if one is supplied. If the cache
+    is named, its hits and misses are counted in the server metrics."""
+
+    def __init__(self, max_bytes, cache_dir=None, max_disk_bytes=None, name=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, key):
+        """Return the string cached for key, or None if there is none."""
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+
+        if data is None:
+            data = self._read(key)
+            if data is not None:
+                self._remember(key, data)
+
+        if data is None:
+            with self.lock:
+                self.misses += 1
+            if self.name is not None:
+                metrics.inc('cache_misses_total', cache=self.name)
+            return None
+
+        with self.lock:
+            self.hits += 1
+        if self.name is not None:
+            metrics.inc('cache_hits_total', cache=self.name)
+        return data.decode('utf8')
+
+    def put(self, key, value):
+        data = value.encode('utf8')
+        self._remember(key, data)
+        self._write(key, data)
+
+    def _remember(self, key, data):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            if len(data) > self.max_bytes:
+                return
+
+            self.entries[key] = data
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                _key, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def _read(self, key):
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # record the use for disk eviction
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def _write(self, key, data):
+        if self.cache_dir is None:
+            return
+        # write atomically so that other processes never see partial files
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        self._evict_disk()
+
+    def _evict_disk(self):
+        if self.max_disk_bytes is None:
+            return
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pickle'):
+                # left by versions which pickled entries
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+            elif entry.name.endswith('.json'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _mtime, size, _path in files)
+        for _mtime, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
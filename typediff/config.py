@@ -10,6 +10,42 @@ ACEBIN = os.path.join(ROOT_PATH, 'bin', 'ace')
 TYPIFIERBIN = os.path.join(ROOT_PATH, 'bin', 'typifier')
 DUMPHIERARCHYBIN = os.path.join(ROOT_PATH, 'bin', 'dumphierarchy')
 LOGPATH = os.path.join('ace.log')
+JSONPATH = os.path.join(ROOT_PATH, '..', 'www', 'json')
+JOBSPATH = os.path.join('jobs.sqlite')
+JOBWORKERS = 2
+
+# Processed gold profile items are cached in memory, up to CACHEMEMORY
+# bytes, and on disk in CACHEPATH (if not None), up to CACHEDISK bytes.
+CACHEPATH = os.path.join('cache')
+CACHEMEMORY = 256 * 2**20
+CACHEDISK = 4 * 2**30
+
+# Identical requests arriving together are coalesced, waiting on lock
+# files in LOCKPATH. Parsed sentences are shared for FLIGHTTTL seconds.
+LOCKPATH = os.path.join('locks')
+FLIGHTTTL = 60
+
+# At most PROCESSLIMIT ACE, typifier and tsdb processes are run at once
+# across all server processes, with at most PROCESSQUEUE more waiting up
+# to PROCESSWAIT seconds for a slot, beyond which requests are refused
+# as busy. Requests are stopped after REQUESTDEADLINE seconds.
+PROCESSLIMIT = os.cpu_count() or 1
+PROCESSQUEUE = 32
+PROCESSWAIT = 30
+REQUESTDEADLINE = 170
+
+# The time taken by each stage of processing a request is appended to
+# TIMINGPATH as JSON lines, if not None.
+TIMINGPATH = None
+
+# The time taken to reconstruct each derivation is recorded in COSTPATH,
+# if not None, to improve the estimates used to schedule reconstructions
+# in later runs.
+COSTPATH = None
+
+# Metrics for /metrics are shared between server processes through
+# files in METRICSPATH. If None, each process reports its own.
+METRICSPATH = os.path.join('metrics')
 
 # The order types are to be displayed in the output list and their
 # color value for terminal output and web interface output
@@ -46,6 +82,20 @@ PARAMS = [
     'ACEBIN',
     'JSONPATH',
     'LOGPATH',
+    'JOBSPATH',
+    'JOBWORKERS',
+    'CACHEPATH',
+    'CACHEMEMORY',
+    'CACHEDISK',
+    'LOCKPATH',
+    'FLIGHTTTL',
+    'PROCESSLIMIT',
+    'PROCESSQUEUE',
+    'PROCESSWAIT',
+    'REQUESTDEADLINE',
+    'TIMINGPATH',
+    'METRICSPATH',
+    'COSTPATH',
 ]
 
 for param in PARAMS:
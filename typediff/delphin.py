@@ -9,9 +9,21 @@ import itertools
 import pickle
 import json
 import time
-
-from collections import Counter, defaultdict
-from subprocess import Popen, PIPE
+import hashlib
+import threading
+
+from array import array
+from itertools import chain
+from collections import Counter, defaultdict, deque
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, Future
+import contextvars
+from contextlib import contextmanager
+
+from . import limits
+from . import timing
+from . import metrics
+from . import schedule
 
 try:
     from lxml import etree
@@ -28,6 +40,16 @@ TSDBHOME = None
 ACEBIN = None
 LOGONREGPATH = None
 
+# typifier processes run concurrently while ACE is still parsing
+TYPIFIER_WORKERS = os.cpu_count() or 1
+TYPIFIER_POOL = None
+
+# number of inputs parsed concurrently
+PARSE_WORKERS = os.cpu_count() or 1
+
+# the typifier outputs shared within the current batch, if any
+TYPIFIER_SHARE = contextvars.ContextVar('typifier_share', default=None)
+
 
 class dotdict(dict):
     """dot.notation access to dictionary attributes"""
@@ -154,6 +176,9 @@ class DerivationError(Exception):
     def __init__(self, msg):
         self.msg = msg
 
+    def __str__(self):
+        return self.msg
+
 
 class TypeNotFoundError(Exception):
     def __init__(self, t):
@@ -185,6 +210,57 @@ class TypeStats:
         self.counts += counts
 
 
+class SymbolTable:
+    """Maps the type names of a grammar onto dense integer ids, assigned
+    in the order the names are first interned. Tables are shared by the
+    threads processing readings, so new names are assigned ids under a
+    lock."""
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self.lock = threading.Lock()
+
+    def intern(self, name):
+        """Return the id of a name, assigning it a new id if unseen."""
+        try:
+            return self.ids[name]
+        except KeyError:
+            with self.lock:
+                i = self.ids.get(name)
+                if i is None:
+                    # the name is appended first, so that its id is
+                    # never seen before it can be looked up
+                    i = len(self.names)
+                    self.names.append(name)
+                    self.ids[name] = i
+                return i
+
+    def name(self, i):
+        return self.names[i]
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __len__(self):
+        return len(self.names)
+
+
+SYMBOL_TABLES = {}
+SYMBOL_TABLES_LOCK = threading.Lock()
+
+
+def get_symbols(grammar):
+    """Return the symbol table shared by all users of a grammar, which
+    may be either a Grammar object or an alias."""
+    alias = getattr(grammar, 'alias', grammar)
+    try:
+        return SYMBOL_TABLES[alias]
+    except KeyError:
+        with SYMBOL_TABLES_LOCK:
+            return SYMBOL_TABLES.setdefault(alias, SymbolTable())
+
+
 class Treebank:
     def __init__(self, params):
         for param, val in params.items():
@@ -196,6 +272,63 @@ class Profile:
             setattr(self, param, val)       
 
 
+# Named sets of fields that items and their readings can be serialized
+# with. 'web' is what the web interface needs to display an item, while
+# 'summary' and 'types-only' omit the derivation trees and MRSs, which
+# can be fetched on demand.
+READING_FIELDS = {
+    'summary': ('iid', 'resultid'),
+    'types-only': ('iid', 'resultid', 'types', 'supers'),
+    'web': ('iid', 'resultid', 'types', 'supers', 'tree', 'mrs'),
+    'full': ('iid', 'resultid', 'types', 'supers', 'tree', 'mrs', 'tokens',
+             'subtrees', 'lex_entries', 'rules', 'root_condition', 'err',
+             'typifier_time'),
+}
+
+ITEM_FIELDS = {
+    'summary': ('input', 'type'),
+    'types-only': ('input', 'type'),
+    'web': ('input', 'type'),
+    'full': ('input', 'type', 'stderr', 'yy_input'),
+}
+
+
+def reading_dict(reading, fields='full'):
+    """Build a dict of the named set of fields of a Reading."""
+    data = {}
+    for field in READING_FIELDS[fields]:
+        if field == 'types':
+            data[field] = reading.types
+        elif field == 'tree':
+            data[field] = getattr(reading, 'json_tree', None)
+        else:
+            data[field] = getattr(reading, field, None)
+    return data
+
+
+def item_dict(item, fields='full'):
+    """Build a dict of the named set of fields of a Fragment or
+    ProfileItem and its readings."""
+    data = {field: getattr(item, field, None) for field in ITEM_FIELDS[fields]}
+    data['grammar'] = item.grammar.alias
+    data['readings'] = [reading_dict(r, fields) for r in item.readings]
+    return data
+
+
+def dump_items(items):
+    """Serialize Fragments or ProfileItems with all of their fields as
+    JSON, so that they can be stored independently of the classes they
+    were built with."""
+    return json.dumps([item_dict(x, 'full') for x in items], cls=JSONEncoder)
+
+
+def load_items(text, grammar):
+    """Rebuild the Fragments or ProfileItems serialized by dump_items."""
+    classes = {'profile': ProfileItem, 'fragment': Fragment}
+    return [classes[data['type']].from_dict(data, grammar)
+            for data in json.loads(text)]
+
+
 class JSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, set):
@@ -203,19 +336,11 @@ class JSONEncoder(json.JSONEncoder):
         if isinstance(obj, (Treebank, Token, Profile, TypeStats)):
             return obj.__dict__
         if isinstance(obj, Reading):
-            data = obj.__dict__
-            data['tree'] = data['json_tree']
-            del data['json_tree']
-            del data['grammar']
-            return data
+            return reading_dict(obj)
         if isinstance(obj, Tree):
             return obj.ptb()
         if isinstance(obj, (Fragment, ProfileItem)):
-            data = obj.__dict__
-            data['grammar'] = data['grammar'].alias
-            del data['log_lines']
-            del data['logpath']
-            return data
+            return item_dict(obj)
         if hasattr(obj, 'json'):
             return obj.json()
         return json.JSONEncoder.default(self, obj)
@@ -233,8 +358,9 @@ class Item:
         self.write_log()
         
     def load_supers(self, hierarchy):
-        for reading in self.readings:
-            reading.supers = get_supers(reading.types, hierarchy)
+        with timing.span('supers'):
+            for reading in self.readings:
+                reading.supers = get_supers(reading.type_names(), hierarchy)
 
     def write_log(self):
         if self.logpath is None:
@@ -253,7 +379,7 @@ class Item:
     
     @property
     def types(self):
-        return set(chain.from_iterable(x.types for x in self.readings))
+        return set(chain.from_iterable(x.type_names() for x in self.readings))
 
 
 class ProfileItem(Item):
@@ -269,11 +395,18 @@ class ProfileItem(Item):
         self.type = "profile" 
         self.post_init()
 
+    @classmethod
+    def from_dict(cls, data, grammar):
+        """Rebuild a ProfileItem from a dict of its 'full' fields made by
+        item_dict and decoded from JSON."""
+        readings = [Reading.from_dict(r, grammar) for r in data['readings']]
+        return cls(data['input'], grammar, readings)
+
         
 class Fragment(Item):
     def __init__(self, text, grammar, ace_path=None, dat_path=None, count=None, 
                  tnt=False, typifier=None, fragments=False, logpath=None, 
-                 cache=False):
+                 cache=False, parse=True, stats_only=False):
         super().__init__()
         self.input = text
         self.grammar = grammar
@@ -286,44 +419,84 @@ class Fragment(Item):
         if ace_path is None:
             ace_path = ACEBIN
 
+        self.readings = []
+        self.stderr = None
         self.post_init()
         self.preprocess()
-        self.parse(ace_path, self.grammar.dat_path, count, fragments, tnt,
-                   typifier, cache)
-
-    def parse(self, ace_path, dat_path, count, fragments, tnt, typifier, cache):
-        if self.yy_input:
-            input_str = self.yy_input
-            yy_input = True
-        else:
-            input_str = self.input
-            yy_input = False
-        try:
-            out, err = ace_parse(input_str, ace_path, self.grammar, count,
-                                 yy_input=yy_input, fragments=fragments, tnt=tnt)
-        except AceError as error:
-            self.log_lines.append(error.msg + '\n\n' + input_str)
-            self.write_log()
-            raise error
 
-        self.log_lines.append(out)
-        self.stderr = err
-        lines = out.strip().splitlines()
-        status = lines[0]
-        readings = lines[1:]
+        if parse:
+            self.parse(ace_path, self.grammar.dat_path, count, fragments, tnt,
+                       typifier, cache, stats_only=stats_only)
+
+    @classmethod
+    def from_dict(cls, data, grammar):
+        """Rebuild a Fragment from a dict of its 'full' fields made by
+        item_dict and decoded from JSON, without parsing it again."""
+        item = cls.__new__(cls)
+        Item.__init__(item)
+        item.input = data['input']
+        item.grammar = grammar
+        item.logpath = None
+        item.type = data['type']
+        item.stderr = data['stderr']
+        item.yy_input = data['yy_input']
+        item.readings = [Reading.from_dict(r, grammar) for r in data['readings']]
+        return item
 
-        self.readings = []
-        for i, reading in enumerate(readings):
-            mrs, derivation = reading.split(';', 1)
-            r = Reading(
+    @property
+    def ace_input(self):
+        """The input string for ACE and whether it is in YY mode."""
+        if self.yy_input:
+            return self.yy_input, True
+        return self.input, False
+
+    def parse(self, ace_path, dat_path, count, fragments, tnt, typifier, cache,
+              stats_only=False):
+        input_str, yy_input = self.ace_input
+
+        # Readings are reconstructed by the typifier in a pool of threads
+        # as soon as ACE outputs them, rather than after it has finished
+        pool = get_typifier_pool()
+        futures = []
+        lines = []
+        status = None
+
+        def make_reading(resultid, line):
+            mrs, derivation = line.split(';', 1)
+            return Reading(
                 derivation.strip(),
-                resultid=i,
+                resultid=resultid,
                 grammar=self.grammar, 
                 mrs=mrs.strip(),
                 typifier=typifier, 
-                cache=cache
+                cache=cache,
+                stats_only=stats_only
             )
-            self.readings.append(r)
+
+        try:
+            output = AceStream(input_str, ace_path, self.grammar, count,
+                                yy_input=yy_input, fragments=fragments, tnt=tnt)
+            for line in output:
+                lines.append(line)
+                if not line.strip():
+                    continue
+                if status is None:
+                    status = line
+                else:
+                    futures.append(pool.submit(contextvars.copy_context().run,
+                                               make_reading, len(futures), line))
+            self.stderr = output.err
+            self.log_lines.append(''.join(lines))
+            self.readings = [future.result() for future in futures]
+        except AceError as error:
+            self.log_lines.append(error.msg + '\n\n' + input_str)
+            self.write_log()
+            raise error
+        finally:
+            # don't leave jobs queued on the shared pool after an error,
+            # timeout or BusyError; finished futures are unaffected
+            for future in futures:
+                future.cancel()
 
     def preprocess(self):
         self.yy_input = None
@@ -342,7 +515,8 @@ class Fragment(Item):
 class Reading:
     def __init__(self, derivation, iid=None, resultid=None, grammar=None, 
                  mrs=None, ptokens=None, dat_path=None, 
-                 typifier=None, cache=False, pspans=[]):
+                 typifier=None, cache=False, pspans=[], typifier_output=None,
+                 stats_only=False):
         self.iid = iid
         self.resultid = resultid
         self.mrs = mrs
@@ -368,11 +542,15 @@ class Reading:
         else:
             cache_derivations = False
             
-        self.tree = parse_derivation(derivation, cache=cache_derivations)
+        with timing.span('derivation'):
+            self.tree = parse_derivation(derivation, cache=cache_derivations)
 
         self.lex_entries = Counter()
         self.rules = Counter()
-        self.types = Counter()       
+        self.symbols = get_symbols(self.grammar)
+        self.type_ids = array('I')
+        self.type_counts = array('I')
+        self.typifier_time = 0
         self.supers = [] 
         self._lextypes = None
         self.tokens = []
@@ -398,10 +576,36 @@ class Reading:
                 # only reconstruct matching phenomenon spans
                 for subtree in self.subtrees:
                     self._reconstruct(subtree.derivation, typifier)
+            elif typifier_output is not None:
+                # the tree was reconstructed for an identical derivation
+                self.add_typifier_output(*typifier_output)
             else:
                 # reconstruct entire tree
                 self._reconstruct(derivation, typifier)
 
+        if stats_only:
+            self.release()
+
+    def release(self):
+        """Release everything but the counts of the reading: its tree,
+        tokens, subtrees, json tree and MRS, for when only its statistics
+        are needed. The links from the nodes of the tree to their parents
+        are broken, so that it is freed straight away rather than by the
+        cyclic garbage collector."""
+        stack = [self.tree] if self.tree is not None else []
+        while stack:
+            node = stack.pop()
+            node.parent = None
+            if type(node) is Tree:
+                stack.extend(node.children)
+
+        self.tree = None
+        self.tokens = []
+        self.subtrees = []
+        self.json_tree = None
+        self.mrs = None
+        self.err = None
+
     def _process_tree(self, pspans, lextypes):
         """Extracts tokens and aligns any spans to derivations"""
         if self.tree.start == -1:
@@ -496,35 +700,95 @@ class Reading:
         its complete AVM and extract all type names. This C program can be 
         found in src/typifier.c
 
-        This sets two instance variables: 
-            self.types     -- all type names found within the complete AVM 
-            self.json_tree -- a json representation of the derivation tree
-                              (somewhat unrelated, but happens to be 
-                              returned from the typifier program which had
-                              this functionality grafted onto it.) 
+        This sets three instance variables: 
+            self.type_ids    -- ids in the grammar's symbol table of all 
+                                type names found within the complete AVM 
+            self.type_counts -- the number of occurrences of each type id
+            self.json_tree   -- a json representation of the derivation tree
+                                (somewhat unrelated, but happens to be 
+                                returned from the typifier program which had
+                                this functionality grafted onto it.) 
+
+        Within sharing_typifier, the output for identical derivations
+        is only computed once.
         """
-        env = dict(os.environ)
-        env['LC_ALL'] = 'en_US.UTF-8'
-        args = [typifier_path, self.grammar.dat_path]
-        process= Popen(args, stdout=PIPE, stdin=PIPE, stderr=PIPE, env=env, close_fds=True)
-        out, err = process.communicate(input=derivation.encode('utf8'))
-        out = out.decode('utf8')
-        err = err.decode('utf8')
+        share = TYPIFIER_SHARE.get()
+        if share is None:
+            out, err, seconds = typify(derivation, typifier_path, self.grammar.dat_path)
+        else:
+            out, err, seconds = share.run(derivation, typifier_path, self.grammar.dat_path)
+        self.typifier_time += seconds
+        self.add_typifier_output(out, err)
 
-        if process.returncode != 0:
-            raise AceError('typifier', err)
+    def typifier_command(self, typifier_path):
+        """Return the arguments and environment to run the typifier with."""
+        return typifier_command(typifier_path, self.grammar.dat_path)
 
+    def add_typifier_output(self, out, err):
+        """Add the types and the json tree from the output of a
+        successful typifier run."""
         types, tree = out.split('\n\n')
         self.err = err
         types = [t for t in types.split() if not t.startswith('"') or 
                  (t.endswith('_rel"') and not t.endswith('unknown_rel"'))]
-        self.types.update(types)
+        self._add_types(types)
 
         # ACE escapes single quotes with a backslash. The json decoder
         # does not accept this as valid JSON.
         tree = tree.replace("\\'", "'").strip()
         self.json_tree = json.loads(tree)
 
+    def __getstate__(self):
+        # type ids are only meaningful within the symbol table of this
+        # process, so pickle the type names instead
+        state = dict(self.__dict__)
+        names = [self.symbols.name(i) for i in self.type_ids]
+        state['type_ids'] = names
+        del state['symbols']
+        return state
+
+    def __setstate__(self, state):
+        names = state.pop('type_ids')
+        self.__dict__.update(state)
+        self.symbols = get_symbols(self.grammar)
+        self._set_types(names, self.type_counts)
+
+    @classmethod
+    def from_dict(cls, data, grammar):
+        """Rebuild a Reading from a dict of its 'full' fields made by
+        reading_dict and decoded from JSON. Its derivation tree is only
+        available as its json tree, and its tokens and subtrees as they
+        were encoded."""
+        reading = cls.__new__(cls)
+        for field in READING_FIELDS['full']:
+            if field not in ('types', 'tree'):
+                setattr(reading, field, data[field])
+        reading.grammar = grammar
+        reading.symbols = get_symbols(grammar)
+        reading.tree = None
+        reading.json_tree = data['tree']
+        reading.lex_entries = Counter(data['lex_entries'])
+        reading.rules = Counter(data['rules'])
+        reading._lextypes = None
+        reading._set_types(list(data['types']), list(data['types'].values()))
+        return reading
+
+    def _set_types(self, names, counts):
+        """Set the type id and count arrays of the reading from type
+        names and their counts."""
+        pairs = sorted(zip((self.symbols.intern(n) for n in names), counts))
+        self.type_ids = array('I', (i for i, _count in pairs))
+        self.type_counts = array('I', (count for _i, count in pairs))
+
+    def _add_types(self, names):
+        """Add occurrences of type names to the reading's compact type
+        id and count arrays."""
+        counts = Counter(dict(zip(self.type_ids, self.type_counts)))
+        counts.update(self.symbols.intern(name) for name in names)
+        ids = sorted(counts)
+        self.type_ids = array('I', ids)
+        self.type_counts = array('I', (counts[i] for i in ids))
+
     def _lookup_lextypes(self):
         """
         Consult the Grammar to convert all lex entries into their
@@ -539,17 +803,25 @@ class Reading:
             except(LexLookupError) as e:
                 sys.stderr.write(e.msg)
 
+    def _derivation_tree(self):
+        """The derivation tree of the reading, which readings rebuilt by
+        from_dict or released in stats-only mode do not have."""
+        if self.tree is None:
+            raise DerivationError('The derivation tree of this reading is '
+                                  'not available.')
+        return self.tree
+
     def ptb(self):
-        return self.tree.ptb()
+        return self._derivation_tree().ptb()
 
     def latex(self):
-        return self.tree.latex()
+        return self._derivation_tree().latex()
 
     def pprint(self, **kwargs):
-        return self.tree.pprint(**kwargs)
+        return self._derivation_tree().pprint(**kwargs)
 
     def draw(self):
-        return self.tree.draw()
+        return self._derivation_tree().draw()
 
     @property
     def input(self):
@@ -558,7 +830,21 @@ class Reading:
 
     @property
     def derivation(self):
-        return self.tree.derivation
+        return self._derivation_tree().derivation
+
+    @property
+    def types(self):
+        """A Counter of the names of the types used by this reading. It is
+        built on each access, so type_names is cheaper where the counts
+        are not needed or are iterated once."""
+        names = self.symbols.names
+        return Counter({names[i]: c for i, c in zip(self.type_ids, self.type_counts)})
+
+    def type_names(self):
+        """The names of the types used by this reading, in the order of
+        type_counts."""
+        names = self.symbols.names
+        return [names[i] for i in self.type_ids]
 
     @property
     def lextypes(self):
@@ -822,6 +1108,16 @@ class TypeHierarchy:
         for c in xtype.children:
             self.find_depths(c, depth+1)
 
+    def intern_names(self, symbols):
+        """Share the type names of this hierarchy with those of a
+        grammar's symbol table, recording each type's id."""
+        types = {}
+        for t in self.types.values():
+            t.id = symbols.intern(t.name)
+            t.name = symbols.name(t.id)
+            types[t.name] = t
+        self.types = types
+
     def get_supers(self, type_names):
         """Given a list of types, return the set of all super types."""
         supers = set()
@@ -1089,8 +1385,9 @@ def parse_error(string, match, expecting):
     raise DerivationError(msg) 
 
 
-def ace_parse(input_str, ace_path, grammar, count, yy_input=False,
-              fragments=False, tnt=False, short_labels=False):
+def ace_command(grammar, ace_path, count, yy_input=False, fragments=False,
+                tnt=False, short_labels=False):
+    """Return the arguments and environment to run ACE with."""
     env = dict(os.environ)
     #env['LC_ALL'] = 'en_US.UTF-8'
     #env['LANG'] = 'en_US.UTF-8'
@@ -1130,12 +1427,20 @@ def ace_parse(input_str, ace_path, grammar, count, yy_input=False,
             args.append('-r')
             args.append('root_strict root_informal root_bridge')
 
-    process = Popen(args, stdout=PIPE, stderr=PIPE, stdin=PIPE, env=env)
-    out, err = process.communicate(input=input_str.encode('utf8'))
+    return args, env
+
+
+def ace_parse(input_str, ace_path, grammar, count, yy_input=False,
+              fragments=False, tnt=False, short_labels=False):
+    args, env = ace_command(grammar, ace_path, count, yy_input=yy_input,
+                            fragments=fragments, tnt=tnt,
+                            short_labels=short_labels)
+    with timing.span('ace'):
+        returncode, out, err = limits.communicate(args, input_str.encode('utf8'), env)
     out = out.decode('utf8')
     err = err.decode('utf8')
 
-    if process.returncode != 0 or out.startswith('SKIP'):
+    if returncode != 0 or out.startswith('SKIP'):
         ace_error_str = ''.join([out, err])
         
         raise AceError('ACE', ace_error_str, input=input_str)
@@ -1143,10 +1448,151 @@ def ace_parse(input_str, ace_path, grammar, count, yy_input=False,
     return out, err
 
 
-def load_hierarchy(xmlfile_path, save_pickle=False):
+class AceStream:
+    """Like ace_parse, but an iterator over the lines of ACE's output as
+    ACE writes them. Its stderr is available from the err attribute
+    once the iterator is exhausted. Raises AceError under the same
+    conditions as ace_parse."""
+
+    def __init__(self, input_str, ace_path, grammar, count, yy_input=False,
+                 fragments=False, tnt=False, short_labels=False):
+        self.input_str = input_str
+        self.args, self.env = ace_command(grammar, ace_path, count,
+                                          yy_input=yy_input,
+                                          fragments=fragments, tnt=tnt,
+                                          short_labels=short_labels)
+        self.err = None
+
+    def __iter__(self):
+        lines = []
+        err_chunks = []
+
+        with timing.span('ace'), limits.running(self.args, env=self.env) as process:
+            # drain stderr in the background so that ACE cannot block on it
+            reader = Thread(target=lambda: err_chunks.append(process.stderr.read()))
+            reader.start()
+
+            try:
+                process.stdin.write(self.input_str.encode('utf8'))
+                process.stdin.close()
+
+                for line in process.stdout:
+                    line = line.decode('utf8')
+                    lines.append(line)
+                    yield line
+            finally:
+                process.stdout.close()
+                process.wait()
+                reader.join()
+
+        self.err = b''.join(err_chunks).decode('utf8')
+
+        if process.returncode != 0 or ''.join(lines).startswith('SKIP'):
+            ace_error_str = ''.join(lines + [self.err])
+            raise AceError('ACE', ace_error_str, input=self.input_str)
+
+
+def typifier_command(typifier_path, dat_path):
+    """Return the arguments and environment to run the typifier with."""
+    env = dict(os.environ)
+    env['LC_ALL'] = 'en_US.UTF-8'
+    return [typifier_path, dat_path], env
+
+
+def typify(derivation, typifier_path, dat_path):
+    """Run the typifier on a derivation, returning its output, error
+    output and the seconds it took."""
+    args, env = typifier_command(typifier_path, dat_path)
+    start = time.time()
+    with timing.span('typifier'):
+        returncode, out, err = limits.communicate(args, derivation.encode('utf8'), env)
+    out = out.decode('utf8')
+    err = err.decode('utf8')
+
+    if returncode != 0:
+        raise AceError('typifier', err)
+    return out, err, time.time() - start
+
+
+class TypifierShare:
+    """The typifier outputs of the derivations reconstructed within a
+    batch, keyed by a digest of the derivation, so that identical
+    derivations are only reconstructed once. Readings of a derivation
+    already being reconstructed wait for its output."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.outputs = {}
+        self.unique = 0
+        self.reused = 0
+
+    def run(self, derivation, typifier_path, dat_path):
+        key = (typifier_path, dat_path,
+               hashlib.sha1(derivation.encode('utf8')).digest())
+        with self.lock:
+            future = self.outputs.get(key)
+            owner = future is None
+            if owner:
+                future = self.outputs[key] = Future()
+                self.unique += 1
+            else:
+                self.reused += 1
+
+        if not owner:
+            out, err, _seconds = future.result()
+            return out, err, 0
+
+        try:
+            output = typify(derivation, typifier_path, dat_path)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        future.set_result(output)
+        return output
+
+
+@contextmanager
+def sharing_typifier():
+    """Context manager within which the typifier outputs of Readings
+    are shared between identical derivations, including in threads
+    started through map_ordered and the typifier pool. The numbers of
+    derivations reconstructed and reused are counted on leaving. Nested
+    uses share the outermost batch."""
+    if TYPIFIER_SHARE.get() is not None:
+        yield TYPIFIER_SHARE.get()
+        return
+
+    share = TypifierShare()
+    token = TYPIFIER_SHARE.set(share)
+    try:
+        yield share
+    finally:
+        TYPIFIER_SHARE.reset(token)
+        count_derivations(share.unique, share.reused)
+
+
+def count_derivations(unique, reused):
+    """Count derivations reconstructed and those reused from identical
+    derivations, in the run summary and metrics."""
+    timing.count('derivations reconstructed', unique)
+    timing.count('derivations reused', reused)
+    metrics.inc('derivations_total', unique, reconstruction='unique')
+    metrics.inc('derivations_total', reused, reconstruction='reused')
+
+
+def get_typifier_pool():
+    """Return the thread pool used to run the typifier on readings."""
+    global TYPIFIER_POOL
+    if TYPIFIER_POOL is None:
+        TYPIFIER_POOL = ThreadPoolExecutor(TYPIFIER_WORKERS)
+    return TYPIFIER_POOL
+
+
+def load_hierarchy(xmlfile_path, save_pickle=False, symbols=None):
     """Load the pickled version of the hierarchy. If there is none,
     load the hierarchy and also save a pickle of it if save_pickle is
-    True.""" 
+    True. If a symbol table is supplied, the hierarchy's type names are
+    interned in it.""" 
     root = os.path.splitext(xmlfile_path)[0]
     try:
         with open(root+'.pickle', 'rb') as f:
@@ -1156,6 +1602,9 @@ def load_hierarchy(xmlfile_path, save_pickle=False):
         if save_pickle:
             sys.setrecursionlimit(10000)
             pickle.dump(hierarchy, open(root+'.pickle', 'wb'))
+
+    if symbols is not None:
+        hierarchy.intern_names(symbols)
     return hierarchy
 
 
@@ -1232,12 +1681,12 @@ def tsdb_query(query, profile):
     env = dict(os.environ)
     env['LC_ALL'] = 'en_US.UTF-8'
     args = ['tsdb', '-home', profile, '-query', query]
-    process= Popen(args, stdout=PIPE, stderr=PIPE, env=env, close_fds=True)
-    out, err = process.communicate()
+    with timing.span('tsdb'):
+        returncode, out, err = limits.communicate(args, env=env)
     out = out.decode('utf8')
     err = err.decode('utf8')
 
-    if process.returncode != 0:
+    if returncode != 0:
         raise TsdbError(err)
     
     return out
@@ -1257,14 +1706,176 @@ def get_profile_ids(*paths):
 
 def get_profile_results(paths, best=1, gold=False, grammar=None, 
                         lextypes=False, typifier=None, condition=None,
-                        pspans=None, cache=False, logpath=None):
+                        pspans=None, cache=False, logpath=None, workers=None,
+                        stats_only=False):
     """Return Readings from across a series of profiles. This assumes
     unique i-ids across all profiles. Returns a dictionary which maps
     i-ids onto lists of Reading sorted by result-id (ie decreasing
-    order of confidence according to the parse selection model)."""
+    order of confidence according to the parse selection model).
+
+    If a typifier is given, each distinct derivation across the profiles
+    is reconstructed once, by workers threads (by default
+    TYPIFIER_WORKERS), largest derivations first, as scheduled by
+    schedule.run_scheduled, and its output is shared by the Readings of
+    every result with that derivation. If stats_only is True, the
+    Readings only keep their counts, as with Reading.release."""
+    if workers is None:
+        workers = TYPIFIER_WORKERS
+    query = profile_query(best=best, gold=gold, condition=condition,
+                          pspans=pspans)
+    annotations = profile_annotations(paths, pspans)
     results_dict = defaultdict(list) 
+
+    # the results of all the profiles are gathered first, so that
+    # derivations shared by overlapping profiles are only reconstructed once
+    results = []
+    for path in paths:
+        results.extend(split_result(r) for r in tsdb_query(query, path).splitlines())
+
+    readings = profile_readings(results, annotations, grammar=grammar,
+                                typifier=typifier, cache=cache,
+                                workers=workers, stats_only=stats_only)
+
+    for result, reading in zip(results, readings):
+        if reading is not None:
+            results_dict[(result[0], result[5])].append(reading)
+
+    profile_items = []
+    for (iid, iinput), readings in results_dict.items():
+        item = ProfileItem(iinput, grammar, readings, logpath=logpath)
+        profile_items.append(item)
+
+    return profile_items
+
+
+def profile_readings(results, annotations, grammar=None, typifier=None,
+                     cache=False, workers=1, stats_only=False):
+    """Return the Readings of results split by split_result, with None
+    for those which could not be reconstructed, which are reported."""
+    def make_reading(result, typifier_output=None):
+        try:
+            return profile_reading(result, annotations, grammar=grammar,
+                                   typifier=typifier, cache=cache,
+                                   typifier_output=typifier_output,
+                                   stats_only=stats_only)
+        except AceError as e:
+            sys.stderr.write(e.msg)
+            return None
+
+    if typifier is None:
+        return [make_reading(result) for result in results]
+
+    if annotations:
+        # only the subtrees of phenomenon spans are reconstructed
+        with sharing_typifier():
+            return [make_reading(result) for result in results]
+
+    # results with the same derivation are built from one reconstruction
+    groups = defaultdict(list)
+    for i, result in enumerate(results):
+        groups[result[4]].append(i)
+    derivations = list(groups)
+
+    def reconstruct(derivation):
+        try:
+            return typify(derivation, typifier, grammar.dat_path)
+        except AceError as e:
+            return e
+
+    readings = [None] * len(results)
+    for d, output in schedule.run_scheduled(reconstruct, derivations, workers):
+        for n, i in enumerate(groups[derivations[d]]):
+            if isinstance(output, AceError):
+                sys.stderr.write(output.msg)
+                continue
+            out, err, seconds = output
+            readings[i] = make_reading(results[i], (out, err))
+            if readings[i] is not None and n == 0:
+                readings[i].typifier_time = seconds
+
+    count_derivations(len(derivations), len(results) - len(derivations))
+    return readings
+
+
+def iter_profile_results(paths, best=1, gold=False, grammar=None, 
+                         lextypes=False, typifier=None, condition=None,
+                         pspans=None, cache=False, logpath=None, stats_only=False):
+    """Like get_profile_results, but yields each ProfileItem as soon as
+    its Readings have been built. This assumes that tsdb returns the
+    readings of each item contiguously."""
+    readings = iter_profile_readings(paths, best=best, gold=gold,
+                                     grammar=grammar, typifier=typifier,
+                                     condition=condition, pspans=pspans,
+                                     cache=cache, stats_only=stats_only)
+    for (iid, iinput), group in itertools.groupby(readings, key=lambda x:x[0]):
+        readings = [reading for _key, reading in group]
+        yield ProfileItem(iinput, grammar, readings, logpath=logpath)
+
+
+def profile_annotations(paths, pspans=None):
+    """Return a dictionary mapping i-ids onto the (start, end) character
+    spans annotated with the phenomenon pspans, if not None."""
     annotations = defaultdict(list)
-   
+
+    if pspans is not None:
+        ipquery = 'select i-id ip-author where p-id = {}'.format(pspans)
+
+        for path in paths:
+            results = tsdb_query(ipquery, path)
+            for result in results.splitlines():
+                bits = result.split('|')
+                iid = int(bits[0])
+                start, end = (int(x) for x in bits[1].split('-'))
+                annotations[iid].append((start, end))
+
+    return annotations
+
+
+def profile_reading(result, annotations, grammar=None, typifier=None, cache=False,
+                    typifier_output=None, stats_only=False):
+    """Build the Reading of a result split by split_result."""
+    iid, resultid, mrs, ptokens, derivation, iinput = result
+    return Reading(
+        derivation,
+        iid=iid,
+        resultid=resultid,
+        mrs=mrs,
+        grammar=grammar,
+        ptokens=ptokens,
+        typifier=typifier,
+        pspans=annotations[iid], 
+        cache=cache,
+        typifier_output=typifier_output,
+        stats_only=stats_only
+    )
+
+
+def iter_profile_readings(paths, best=1, gold=False, grammar=None,
+                          typifier=None, condition=None, pspans=None,
+                          cache=False, stats_only=False):
+    """Yield ((i-id, i-input), Reading) pairs for the readings found across
+    a series of profiles, in the order returned by tsdb. Readings which
+    could not be reconstructed are reported and skipped."""
+    query = profile_query(best=best, gold=gold, condition=condition,
+                          pspans=pspans)
+    annotations = profile_annotations(paths, pspans)
+
+    for path in paths:
+        results = tsdb_query(query, path)
+        for result in results.splitlines():
+            result = split_result(result)
+            try:
+                reading = profile_reading(result, annotations, grammar=grammar,
+                                          typifier=typifier, cache=cache,
+                                          stats_only=stats_only)
+            except AceError as e:
+                sys.stderr.write(e.msg)
+            else:
+                yield (result[0], result[5]), reading
+
+
+def profile_query(best=1, gold=False, condition=None, pspans=None):
+    """Return the tsdb query for the readings of a profile."""
     if gold:
         # This is for querying a thinned profile, where we can simply
         # return all all readings. Note though that we can still find
@@ -1289,68 +1900,64 @@ def get_profile_results(paths, best=1, gold=False, grammar=None,
 
     if pspans is not None:
         query += ' and p-id = {}'.format(pspans)
-        ipquery = 'select i-id ip-author where p-id = {}'.format(pspans)
 
-        for path in paths:
-            results = tsdb_query(ipquery, path)
-            for result in results.splitlines():
-                bits = result.split('|')
-                iid = int(bits[0])
-                start, end = (int(x) for x in bits[1].split('-'))
-                annotations[iid].append((start, end))
+    return query
 
-    for path in paths:
-        results = tsdb_query(query, path)
-        readings = []
-        for result in results.splitlines():
-            bits = result.split(' | ', 5)
-            iid = int(bits[0].strip())
-            resultid = int(bits[1].strip())
-            mrs = bits[2].strip()
-            ptokens = bits[3].strip()
-            derivation = bits[4].strip()
-            iinput = bits[5].strip()
-            try:
-                reading = Reading(
-                    derivation,
-                    iid=iid,
-                    resultid=resultid,
-                    mrs=mrs,
-                    grammar=grammar,
-                    ptokens=ptokens,
-                    typifier=typifier,
-                    pspans=annotations[iid], 
-                    cache=cache
-                )
-                results_dict[(iid, iinput)].append(reading)
-            except AceError as e:
-                sys.stderr.write(e.msg)
 
-    profile_items = []
-    for (iid, iinput), readings in results_dict.items():
-        item = ProfileItem(iinput, grammar, readings, logpath=logpath)
-        profile_items.append(item)
+def split_result(result):
+    """Split a line of the output of a profile_query into the i-id,
+    result-id, mrs, p-tokens, derivation and i-input."""
+    bits = [x.strip() for x in result.split(' | ', 5)]
+    return (int(bits[0]), int(bits[1])) + tuple(bits[2:])
 
-    return profile_items
+
+def map_ordered(func, values, workers=None):
+    """Apply func to each of values in a pool of threads, which suits
+    functions that mostly wait on subprocesses, yielding the results in
+    the order of values. At most twice as many values as there are
+    workers are processed ahead of the result being yielded. Exceptions
+    raised by func are raised when their result is reached."""
+    if workers is None:
+        workers = PARSE_WORKERS
+    pending = deque()
+
+    with ThreadPoolExecutor(workers) as pool:
+        try:
+            for value in values:
+                # run func in a copy of the current context, so that it
+                # inherits the deadline of the request, if any
+                pending.append(pool.submit(contextvars.copy_context().run,
+                                           func, value))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
 
 
 def get_text_results(lines, grammar, best=1, ace_path=None, lextypes=True,
-                     typifier=None, cache=False, fragments=False):
-    results_dict = defaultdict(list)
-    for i, line in enumerate(lines):
-        f = Fragment(line, grammar, count=best, typifier=typifier, cache=cache,
-                     ace_path=ace_path, fragments=fragments)
+                     typifier=None, cache=False, fragments=False, workers=None,
+                     stats_only=False):
+    def parse(line):
+        return Fragment(line, grammar, count=best, typifier=typifier,
+                        cache=cache, ace_path=ace_path, fragments=fragments,
+                        stats_only=stats_only)
 
-        for reading in f.readings:
-            results_dict[i].append(reading)
+    results_dict = defaultdict(list)
+    with sharing_typifier():
+        for i, f in enumerate(map_ordered(parse, lines, workers)):
+            for reading in f.readings:
+                results_dict[i].append(reading)
 
     return results_dict
 
 
-def get_short_label_results(lines, grammar, best=1, fragments=False, ace_path=None):
+def get_short_label_results(lines, grammar, best=1, fragments=False, ace_path=None,
+                            workers=None):
     """Return list of parse results with short label derivation results."""
-    results = defaultdict(list)
-    for i, line in enumerate(lines):
+    def parse(line):
         # We use ace_parse rather than Fragments, because the Fragment class
         # assumes that derivations will be full derivations with token
         # information, whereas the short label output generated by ACE with
@@ -1361,12 +1968,18 @@ def get_short_label_results(lines, grammar, best=1, fragments=False, ace_path=No
             out_lines = out.strip().splitlines()
             status = out_lines[0]
             readings = out_lines[1:]
+            derivations = []
             
             for reading in readings:
                 mrs, derivation = reading.split(';', 1)
-                results[i].append(derivation.strip())
+                derivations.append(derivation.strip())
+            return derivations
         except AceError as error:
-            results[i] = ['FAILURE: {}'.format(error.input.strip())]
+            return ['FAILURE: {}'.format(error.input.strip())]
+
+    results = defaultdict(list)
+    for i, derivations in enumerate(map_ordered(parse, lines, workers)):
+        results[i].extend(derivations)
     return results
 
 
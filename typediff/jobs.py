@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import traceback
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from . import config
+from . import limits
+from . import metrics
+from .delphin import JSONEncoder
+
+
+"""A local background job subsystem for long running typediff requests.
+
+Jobs are run in a pool of worker processes, so that heavy comparisons
+do not occupy a web server worker for their whole duration. The state
+of each job, its progress counters and its result are kept in a SQLite
+job table, which is shared between all processes using the same
+database path, so that any server process can report on a job and
+results can be fetched again after a client reconnects. Each unfinished
+job records the pid of its owner, the process whose pool it is queued in
+or the worker running it, so that jobs lost when their owner exits are
+reported as failed rather than staying unfinished forever.
+"""
+
+
+SCHEMA = """
+create table if not exists jobs (
+    id text primary key,
+    kind text not null,
+    params text not null,
+    status text not null,
+    created real not null,
+    started real,
+    finished real,
+    items integer not null default 0,
+    typifier_time real not null default 0,
+    result text,
+    error text,
+    owner integer
+)
+"""
+
+# job statuses
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+FINISHED = (DONE, FAILED, CANCELLED)
+
+EXECUTOR = None
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobNotFoundError(Exception):
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.msg = "No job with id {}.".format(job_id)
+
+    def __str__(self):
+        return self.msg
+
+
+def connect(db_path=None):
+    db = sqlite3.connect(db_path or config.JOBSPATH, timeout=30)
+    db.row_factory = sqlite3.Row
+    db.execute('pragma journal_mode=wal')
+    db.execute(SCHEMA)
+    columns = [row['name'] for row in db.execute('pragma table_info(jobs)')]
+    if 'owner' not in columns:
+        # job tables created before owners were recorded
+        db.execute('alter table jobs add column owner integer')
+    return db
+
+
+@contextmanager
+def transaction(db_path=None):
+    """Connect to the job table, committing any changes on exit."""
+    db = connect(db_path)
+    try:
+        with db:
+            yield db
+    finally:
+        db.close()
+
+
+def get_executor():
+    """The worker pool of this process, created on first use. Workers are
+    spawned rather than forked, as forking a multi-threaded server process
+    could copy locks held by its other threads into them."""
+    global EXECUTOR
+    if EXECUTOR is None:
+        EXECUTOR = ProcessPoolExecutor(
+            max_workers=config.JOBWORKERS,
+            mp_context=multiprocessing.get_context('spawn'))
+    return EXECUTOR
+
+
+def submit(func, kind, params, db_path=None):
+    """Queue func to be run with the request parameters params in the
+    worker pool, returning the new job's id. func must be a module level
+    function taking the parameters and a Job, so that it can be pickled
+    and passed to the worker processes."""
+    db_path = db_path or config.JOBSPATH
+    job_id = uuid.uuid4().hex
+
+    with transaction(db_path) as db:
+        db.execute('insert into jobs (id, kind, params, status, created, owner) '
+                   'values (?, ?, ?, ?, ?, ?)',
+                   (job_id, kind, json.dumps(params), QUEUED, time.time(),
+                    os.getpid()))
+
+    future = get_executor().submit(run_job, func, job_id, db_path)
+    future.add_done_callback(lambda f: job_done(f, job_id, db_path))
+    return job_id
+
+
+def job_done(future, job_id, db_path):
+    """Record the failure of a job which could not be run, for instance
+    because its parameters could not be pickled or a worker died."""
+    global EXECUTOR
+    error = future.exception()
+    if error is None:
+        return
+    if isinstance(error, BrokenProcessPool):
+        # a broken pool refuses any further jobs, so start a new one
+        EXECUTOR = None
+    fail(job_id, 'The job could not be run: {}'.format(error), db_path)
+
+
+def fail(job_id, error, db_path=None):
+    """Mark a job that has not yet finished as failed."""
+    with transaction(db_path) as db:
+        db.execute('update jobs set status = ?, finished = ?, error = ? '
+                   'where id = ? and status in (?, ?)',
+                   (FAILED, time.time(), error, job_id, QUEUED, RUNNING))
+
+
+def status(job_id, db_path=None):
+    """Return a dictionary describing the status and progress of a job.
+    Unfinished jobs whose owner has exited are marked as failed."""
+    with transaction(db_path) as db:
+        row = db.execute('select id, kind, status, created, started, finished, '
+                         'items, typifier_time, error, owner from jobs '
+                         'where id = ?', (job_id,)).fetchone()
+    if row is None:
+        raise JobNotFoundError(job_id)
+
+    data = dict(row)
+    owner = data.pop('owner')
+    if data['status'] not in FINISHED and owner and not limits.alive(owner):
+        fail(job_id, 'The process running the job exited.', db_path)
+        return status(job_id, db_path)
+    return data
+
+
+def result(job_id, db_path=None):
+    """Return the JSON encoded result of a job, or None if it has not
+    finished successfully."""
+    with transaction(db_path) as db:
+        row = db.execute('select status, result from jobs where id = ?',
+                         (job_id,)).fetchone()
+    if row is None:
+        raise JobNotFoundError(job_id)
+    return row['result'] if row['status'] == DONE else None
+
+
+def cancel(job_id, db_path=None):
+    """Cancel a job that has not yet finished. Running jobs stop the next
+    time they report progress. Returns whether the job was cancelled."""
+    with transaction(db_path) as db:
+        cursor = db.execute('update jobs set status = ?, finished = ? '
+                            'where id = ? and status in (?, ?)',
+                            (CANCELLED, time.time(), job_id, QUEUED, RUNNING))
+    if cursor.rowcount == 0:
+        status(job_id, db_path)
+        return False
+    return True
+
+
+class Job:
+    """Handle passed to job functions for reporting progress."""
+
+    def __init__(self, job_id, db_path):
+        self.id = job_id
+        self.db_path = db_path
+        self.items = 0
+        self.typifier_time = 0
+
+    def progress(self, item=None):
+        """Record that an item has been processed, raising JobCancelled if
+        the job has been cancelled in the meantime."""
+        if item is not None:
+            self.items += 1
+            self.typifier_time += sum(r.typifier_time for r in item.readings)
+
+        with transaction(self.db_path) as db:
+            db.execute('update jobs set items = ?, typifier_time = ? where id = ?',
+                       (self.items, self.typifier_time, self.id))
+            row = db.execute('select status from jobs where id = ?',
+                             (self.id,)).fetchone()
+
+        if row['status'] == CANCELLED:
+            raise JobCancelled()
+
+
+def run_job(func, job_id, db_path):
+    """Run a job in a worker process, recording its outcome."""
+    with transaction(db_path) as db:
+        cursor = db.execute('update jobs set status = ?, started = ?, owner = ? '
+                            'where id = ? and status = ?',
+                            (RUNNING, time.time(), os.getpid(), job_id, QUEUED))
+        if cursor.rowcount == 0:
+            # cancelled before it started
+            return
+        row = db.execute('select params from jobs where id = ?',
+                         (job_id,)).fetchone()
+
+    job = Job(job_id, db_path)
+
+    try:
+        data = func(json.loads(row['params']), job)
+        outcome = (DONE, json.dumps(data, cls=JSONEncoder), None)
+    except JobCancelled:
+        return
+    except Exception as e:
+        sys.stderr.write(traceback.format_exc())
+        outcome = (FAILED, None, getattr(e, 'msg', str(e)))
+    finally:
+        # the worker's subprocess and typifier metrics would otherwise
+        # only be saved when it exits
+        metrics.save(force=True)
+
+    with transaction(db_path) as db:
+        db.execute('update jobs set status = ?, finished = ?, result = ?, '
+                   'error = ? where id = ? and status = ?',
+                   (outcome[0], time.time(), outcome[1], outcome[2], job_id,
+                    RUNNING))
@@ -0,0 +1,255 @@
+import os
+import time
+import fcntl
+import threading
+import contextvars
+from contextlib import contextmanager
+from subprocess import Popen, PIPE, TimeoutExpired
+
+from . import timing
+from . import metrics
+
+
+"""Admission control for the ACE, typifier and tsdb processes run on
+behalf of requests.
+
+Each process must hold one of a fixed number of slots, which are lock
+files shared by all server processes, so that a burst of requests
+cannot start more grammar processes than the machine can hold. A
+bounded number of processes may queue for a slot; beyond that, or if
+no slot becomes free within the wait time, BusyError is raised so the
+request can be refused and retried later. Requests can also be given
+a deadline, after which their processes are killed and Timeout is
+raised.
+
+Limits are off until configure is called, as in the web server, so the
+command line tools are not affected by them.
+"""
+
+
+SLOTS = None
+QUEUE = None
+WAIT = None
+RETRY_AFTER = 10
+LOCK_DIR = None
+
+DEADLINE = contextvars.ContextVar('deadline', default=None)
+PATIENT = contextvars.ContextVar('patient', default=False)
+
+
+class BusyError(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        self.msg = "The server is busy, please retry after {} seconds.".format(
+            retry_after)
+
+    def __str__(self):
+        return self.msg
+
+
+class Timeout(Exception):
+    def __init__(self, prog):
+        self.msg = "{} was stopped as the request took too long.".format(prog)
+
+    def __str__(self):
+        return self.msg
+
+
+def configure(slots, queue, wait, lock_dir, retry_after=RETRY_AFTER):
+    """Allow at most slots processes to run at once and queue at most
+    queue more, for at most wait seconds each, coordinating with other
+    processes using lock files in lock_dir."""
+    global SLOTS, QUEUE, WAIT, LOCK_DIR, RETRY_AFTER
+    os.makedirs(lock_dir, exist_ok=True)
+    SLOTS, QUEUE, WAIT, LOCK_DIR = slots, queue, wait, lock_dir
+    RETRY_AFTER = retry_after
+
+
+@contextmanager
+def deadline(seconds):
+    """Context manager giving the work done within it seconds to finish.
+    The deadline is inherited by work started through map_ordered and
+    the typifier pool in delphin."""
+    token = DEADLINE.set(time.time() + seconds if seconds else None)
+    try:
+        yield
+    finally:
+        DEADLINE.reset(token)
+
+
+@contextmanager
+def patient():
+    """Context manager for work, such as background jobs, that should
+    wait for as long as it takes to get a process slot rather than be
+    refused when the server is busy."""
+    token = PATIENT.set(True)
+    try:
+        yield
+    finally:
+        PATIENT.reset(token)
+
+
+def remaining():
+    """Seconds left before the current deadline, or None."""
+    end = DEADLINE.get()
+    return None if end is None else max(end - time.time(), 0)
+
+
+def lock_path(prefix, i):
+    return os.path.join(LOCK_DIR, '{}-{}.lock'.format(prefix, i))
+
+
+def try_lock(prefix, count):
+    """Lock one of count lock files, returning the open file or None if
+    they are all locked. The pid of the holder is written to the file,
+    so that usage can count the files held without locking them."""
+    for i in range(count):
+        f = open(lock_path(prefix, i), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            continue
+        f.truncate(0)
+        f.write('{}\n'.format(os.getpid()))
+        f.flush()
+        return f
+    return None
+
+
+def unlock(f):
+    """Clear the holder of a lock file returned by try_lock and release
+    it."""
+    f.truncate(0)
+    f.close()
+
+
+def held(path):
+    """Whether the lock file at path names a live holder."""
+    try:
+        with open(path) as f:
+            pid = int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return False
+    # the holder may have died without clearing the file
+    return bool(pid) and alive(pid)
+
+
+def alive(pid):
+    """Whether a process with the given pid is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextmanager
+def slot(prog):
+    """Context manager holding a process slot while prog runs."""
+    if SLOTS is None:
+        yield
+        return
+
+    if PATIENT.get():
+        queued = None
+    else:
+        queued = try_lock('queue', QUEUE)
+        if queued is None:
+            raise BusyError(RETRY_AFTER)
+
+    try:
+        left = remaining()
+        wait = WAIT if left is None else min(WAIT, left)
+        give_up = None if queued is None else time.time() + wait
+        delay = 0.01
+        slot_file = try_lock('slot', SLOTS)
+
+        if slot_file is None:
+            with timing.span('wait'):
+                while slot_file is None:
+                    if give_up is not None and time.time() >= give_up:
+                        if remaining() == 0:
+                            raise Timeout(prog)
+                        raise BusyError(RETRY_AFTER)
+                    time.sleep(delay)
+                    delay = min(delay * 2, 0.25)
+                    slot_file = try_lock('slot', SLOTS)
+    finally:
+        if queued is not None:
+            unlock(queued)
+
+    try:
+        yield
+    finally:
+        unlock(slot_file)
+
+
+def usage():
+    """Return the number of process slots in use and the number of
+    processes queued for one, across all server processes. The holders
+    recorded in the lock files are counted rather than taking the locks,
+    which would turn away requests trying to take them meanwhile."""
+    if SLOTS is None:
+        return 0, 0
+
+    def count(prefix, n):
+        return sum(held(lock_path(prefix, i)) for i in range(n))
+
+    return count('slot', SLOTS), count('queue', QUEUE)
+
+
+def record(args, start):
+    program = os.path.basename(args[0])
+    metrics.inc('subprocess_starts_total', program=program)
+    metrics.observe('subprocess_seconds', time.time() - start, program=program)
+
+
+def communicate(args, input=None, env=None):
+    """Run the command args with the bytes input in a process slot,
+    returning its return code, stdout and stderr. Raises Timeout if the
+    current deadline passes first, killing the process."""
+    with slot(args[0]):
+        start = time.time()
+        process = Popen(args, stdout=PIPE, stdin=PIPE, stderr=PIPE, env=env,
+                        close_fds=True)
+        try:
+            out, err = process.communicate(input=input, timeout=remaining())
+        except TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise Timeout(args[0])
+        finally:
+            record(args, start)
+    return process.returncode, out, err
+
+
+@contextmanager
+def running(args, env=None):
+    """Context manager for a process run with args in a process slot,
+    yielding the Popen object for the caller to interact with. The
+    process is killed if the current deadline passes, in which case
+    Timeout is raised on leaving the context."""
+    with slot(args[0]):
+        start = time.time()
+        process = Popen(args, stdout=PIPE, stderr=PIPE, stdin=PIPE, env=env)
+        killed = threading.Event()
+
+        def kill():
+            killed.set()
+            process.kill()
+
+        left = remaining()
+        timer = threading.Timer(left, kill) if left is not None else None
+        if timer is not None:
+            timer.start()
+        try:
+            yield process
+        finally:
+            record(args, start)
+            if timer is not None:
+                timer.cancel()
+            if killed.is_set():
+                raise Timeout(args[0])
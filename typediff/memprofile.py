@@ -0,0 +1,168 @@
+import gc
+import sys
+import time
+import resource
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+
+"""Memory profiling of command line runs over large profiles and
+treebanks, to find out what is using memory when a run grows too large.
+
+When profiling is started with profiling, Python's allocations are
+traced with tracemalloc and a snapshot is taken at each stage boundary
+marked with stage, which does nothing otherwise. For each stage, the
+report gives the memory traced and the peak resident set size so far,
+the number and size of instances of the classes that make up most of
+the memory of processed profiles, and the source lines that allocated
+the most memory since the previous stage. The sizes of instances are
+shallow: an object and its attribute dictionary, but not the objects
+it refers to, which are counted under their own classes.
+"""
+
+
+PROFILER = None
+
+# number of allocation sites to report for each stage
+TOP = 10
+
+FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+    tracemalloc.Filter(False, __file__),
+)
+
+
+def tracked_classes():
+    from .delphin import Reading, Tree, Token
+    return (Reading, Tree, Token, Counter)
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """The peak resident set size in bytes of this process, or of its
+    largest child process."""
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def class_totals(classes):
+    """Count the instances of classes among the objects tracked by the
+    garbage collector, returning a dict mapping class names to (count,
+    bytes) pairs."""
+    totals = {cls.__name__: [0, 0] for cls in classes}
+
+    for obj in gc.get_objects():
+        for cls in classes:
+            if isinstance(obj, cls):
+                size = sys.getsizeof(obj)
+                try:
+                    size += sys.getsizeof(vars(obj))
+                except TypeError:
+                    pass
+                totals[cls.__name__][0] += 1
+                totals[cls.__name__][1] += size
+                break
+    return {name: tuple(total) for name, total in totals.items()}
+
+
+def size_str(size):
+    if abs(size) < 2**20:
+        return '{:.1f} KiB'.format(size / 2**10)
+    return '{:.1f} MiB'.format(size / 2**20)
+
+
+class MemProfiler:
+    def __init__(self, label, top=TOP):
+        self.label = label
+        self.top = top
+        self.start = time.time()
+        self.stages = []
+        self.previous = None
+
+    def stage(self, name):
+        """Take a snapshot at the end of the stage name."""
+        # so that unreachable cycles, such as trees linked to their
+        # parents, are not counted
+        gc.collect()
+        snapshot = tracemalloc.take_snapshot().filter_traces(FILTERS)
+        if self.previous is None:
+            sites = snapshot.statistics('lineno')
+        else:
+            sites = snapshot.compare_to(self.previous, 'lineno')
+        self.previous = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        self.stages.append({
+            'stage': name,
+            'elapsed': time.time() - self.start,
+            'traced': current,
+            'traced_peak': peak,
+            'rss_peak': peak_rss(),
+            'classes': class_totals(tracked_classes()),
+            'sites': [stat for stat in sites
+                      if getattr(stat, 'size_diff', stat.size) > 0][:self.top],
+        })
+
+    def report(self):
+        """Format the stages recorded as a text report."""
+        lines = ['Memory profile of {}'.format(self.label)]
+
+        for stage in self.stages:
+            lines.append('')
+            lines.append('== {} (after {:.1f}s)'.format(stage['stage'], stage['elapsed']))
+            lines.append('traced {}, traced peak {}, peak RSS {}'.format(
+                size_str(stage['traced']), size_str(stage['traced_peak']), size_str(stage['rss_peak'])))
+            lines.append('objects:')
+            for name, (count, size) in stage['classes'].items():
+                lines.append('  {:<10}{:>12,} {:>14}'.format(name, count, size_str(size)))
+            lines.append('top allocation sites since the previous stage:')
+            for stat in stage['sites']:
+                frame = stat.traceback[0]
+                change = getattr(stat, 'size_diff', stat.size)
+                lines.append('  {:>14} {:>10,} blocks  {}:{}'.format(
+                    '+' + size_str(change), stat.count, frame.filename, frame.lineno))
+
+        lines.append('')
+        lines.append('peak RSS {}, largest child process peak RSS {}'.format(
+            size_str(peak_rss()), size_str(peak_rss(resource.RUSAGE_CHILDREN))))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, output):
+        """Write the report to output, a path or '-' for stderr."""
+        text = self.report()
+        if output == '-':
+            sys.stderr.write(text)
+        else:
+            with open(output, 'w') as f:
+                f.write(text)
+
+
+@contextmanager
+def profiling(label, output=None):
+    """Context manager profiling the memory used within it, writing the
+    report to output on leaving. If output is None, nothing is profiled
+    and None is yielded."""
+    global PROFILER
+    if output is None:
+        yield None
+        return
+
+    tracemalloc.start()
+    PROFILER = MemProfiler(label)
+    try:
+        yield PROFILER
+    finally:
+        PROFILER.stage('end')
+        PROFILER.write(output)
+        PROFILER = None
+        tracemalloc.stop()
+
+
+def stage(name):
+    """Mark the end of the stage name, if memory is being profiled."""
+    if PROFILER is not None:
+        PROFILER.stage(name)
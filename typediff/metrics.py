@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import fcntl
+import atexit
+import tempfile
+import threading
+from collections import defaultdict
+
+from . import limits
+
+
+"""Counters and histograms describing the work done by the server,
+such as the latency of ACE, typifier and tsdb processes, cache hit
+rates, items per request and response sizes, exposed in the Prometheus
+text format.
+
+Each process keeps its metrics in memory and saves them to a file of
+its own in a shared directory, if one has been set with configure, so
+that the metrics of all server processes can be added together when
+they are exported. Files are named by the pid and start time of their
+process, so that a reused pid does not overwrite them. When metrics are
+collected, the files of processes that have exited are added to a file
+of retired totals and removed, so counts are not lost when a process is
+recycled but files do not accumulate.
+"""
+
+
+PREFIX = 'typediff_'
+
+# histogram bucket upper bounds, by metric name
+BUCKETS = {
+    'subprocess_seconds': (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+    'request_items': (1, 2, 5, 10, 20, 50, 100, 500, 1000, 5000, 10000),
+    'response_bytes': (1e3, 1e4, 1e5, 1e6, 1e7, 1e8),
+}
+
+HELP = {
+    'subprocess_starts_total': 'ACE, typifier and tsdb processes started.',
+    'subprocess_seconds': 'Run time of ACE, typifier and tsdb processes.',
+    'cache_hits_total': 'Result cache lookups that found an entry.',
+    'cache_misses_total': 'Result cache lookups that found no entry.',
+    'requests_total': 'Requests handled, by endpoint and status code.',
+    'busy_total': 'Requests refused because the server was busy.',
+    'request_items': 'Items processed per request.',
+    'response_bytes': 'Size of responses.',
+    'derivations_total': 'Derivations reconstructed, or reused from an identical derivation.',
+}
+
+# the seconds between saves, other than forced ones
+SAVE_INTERVAL = 10
+
+RETIRED = 'retired.json'
+
+METRICS_DIR = None
+COUNTERS = defaultdict(float)
+HISTOGRAMS = {}
+LOCK = threading.Lock()
+# the pid and start time of this process, and when it last saved
+PROCESS = None
+SAVED = 0
+
+
+def configure(metrics_dir):
+    """Save and export metrics shared with other processes through
+    files in metrics_dir. The metrics are also saved at exit."""
+    global METRICS_DIR
+    os.makedirs(metrics_dir, exist_ok=True)
+    METRICS_DIR = metrics_dir
+    atexit.register(save, force=True)
+
+
+def key(name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+
+def inc(name, value=1, **labels):
+    """Increment the counter name with labels by value."""
+    with LOCK:
+        COUNTERS[key(name, labels)] += value
+
+
+def observe(name, value, **labels):
+    """Add value to the histogram name with labels."""
+    bounds = BUCKETS[name]
+    with LOCK:
+        histogram = HISTOGRAMS.setdefault(
+            key(name, labels), {'buckets': [0] * len(bounds), 'sum': 0, 'count': 0})
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def snapshot():
+    with LOCK:
+        return {
+            'counters': dict(COUNTERS),
+            'histograms': {k: {'buckets': list(h['buckets']), 'sum': h['sum'],
+                               'count': h['count']}
+                           for k, h in HISTOGRAMS.items()},
+        }
+
+
+def process_file():
+    """The name of the metrics file of this process."""
+    global PROCESS
+    if PROCESS is None or PROCESS[0] != os.getpid():
+        PROCESS = (os.getpid(), int(time.time() * 1000))
+    return '{}-{}.json'.format(*PROCESS)
+
+
+def file_pid(name):
+    """The pid of the process a metrics file belongs to, or None if it is
+    not the file of a process."""
+    pid, _sep, start = name[:-len('.json')].partition('-')
+    if pid.isdigit() and start.isdigit():
+        return int(pid)
+    return None
+
+
+def save(force=False):
+    """Save the metrics of this process to its file, atomically, unless
+    they were saved less than SAVE_INTERVAL seconds ago and force is
+    False."""
+    global SAVED
+    if METRICS_DIR is None:
+        return
+    if not force and time.time() - SAVED < SAVE_INTERVAL:
+        return
+    SAVED = time.time()
+    write_json(os.path.join(METRICS_DIR, process_file()), snapshot())
+
+
+def write_json(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(json.dumps(data))
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def add(total, data):
+    """Add the metrics data of a process to total."""
+    for k, value in data['counters'].items():
+        total['counters'][k] = total['counters'].get(k, 0) + value
+    for k, h in data['histograms'].items():
+        if k not in total['histograms']:
+            total['histograms'][k] = h
+            continue
+        histogram = total['histograms'][k]
+        histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'],
+                                                      h['buckets'])]
+        histogram['sum'] += h['sum']
+        histogram['count'] += h['count']
+
+
+def retire(names):
+    """Add the metrics files of processes that have exited to the retired
+    totals and remove them, under a lock so that no file is added twice."""
+    with open(os.path.join(METRICS_DIR, 'retired.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        retired_path = os.path.join(METRICS_DIR, RETIRED)
+        retired = read_json(retired_path) or {'counters': {}, 'histograms': {}}
+        paths = []
+        for name in names:
+            path = os.path.join(METRICS_DIR, name)
+            data = read_json(path)
+            if data is not None:
+                add(retired, data)
+                paths.append(path)
+        write_json(retired_path, retired)
+        for path in paths:
+            os.remove(path)
+
+
+def collect():
+    """Return the metrics of all processes added together."""
+    if METRICS_DIR is None:
+        return snapshot()
+
+    save(force=True)
+    names = [name for name in os.listdir(METRICS_DIR)
+             if name.endswith('.json') and file_pid(name) is not None]
+    dead = [name for name in names if not limits.alive(file_pid(name))]
+    if dead:
+        retire(dead)
+
+    total = {'counters': defaultdict(float), 'histograms': {}}
+    for name in [RETIRED] + [name for name in names if name not in dead]:
+        data = read_json(os.path.join(METRICS_DIR, name))
+        if data is not None:
+            add(total, data)
+
+    return total
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in pairs) + '}'
+
+
+def format_number(value):
+    return repr(int(value)) if float(value).is_integer() else repr(value)
+
+
+def exposition(gauges=()):
+    """Return the metrics of all processes in the Prometheus text
+    format. gauges is a sequence of (name, help, value) tuples to be
+    included, for values read at the time of export."""
+    data = collect()
+    series = defaultdict(list)
+    lines = []
+
+    for k, value in data['counters'].items():
+        name, labels = json.loads(k)
+        series[name].append(('counter', labels, value))
+    for k, h in data['histograms'].items():
+        name, labels = json.loads(k)
+        series[name].append(('histogram', labels, h))
+
+    for name in sorted(series):
+        kind = series[name][0][0]
+        lines.append('# HELP {}{} {}'.format(PREFIX, name, HELP.get(name, name)))
+        lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+
+        for _kind, labels, value in sorted(series[name], key=lambda x: x[1]):
+            if kind == 'counter':
+                lines.append('{}{}{} {}'.format(PREFIX, name, format_labels(labels),
+                                                format_number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS[name], value['buckets']):
+                cumulative += count
+                lines.append('{}{}_bucket{} {}'.format(
+                    PREFIX, name, format_labels(labels, [('le', format_number(bound))]),
+                    cumulative))
+            lines.append('{}{}_bucket{} {}'.format(
+                PREFIX, name, format_labels(labels, [('le', '+Inf')]), value['count']))
+            lines.append('{}{}_sum{} {}'.format(PREFIX, name, format_labels(labels),
+                                                format_number(value['sum'])))
+            lines.append('{}{}_count{} {}'.format(PREFIX, name, format_labels(labels),
+                                                  value['count']))
+
+    for name, help, value in gauges:
+        lines.append('# HELP {}{} {}'.format(PREFIX, name, help))
+        lines.append('# TYPE {}{} gauge'.format(PREFIX, name))
+        lines.append('{}{} {}'.format(PREFIX, name, format_number(value)))
+
+    return '\n'.join(lines) + '\n'
@@ -1,14 +1,26 @@
 import sys
 import os
 import argparse
+import io
+import csv
+import json
+import functools
 from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 from .delphin import (get_profile_ids, load_hierarchy, TypeNotFoundError,
                       get_profile_results, get_short_label_results,
                       get_text_results, AceError)
-from .config import TYPIFIERBIN, ACEBIN
+from .config import TYPIFIERBIN, ACEBIN, COSTPATH
 from .gram import get_grammar
-from .stats import counts2dist, kl_divergence, js_divergence
+from . import timing
+from . import memprofile
+from . import schedule
+from .stats import (counts2dist, kl_divergence, js_divergence, counts2matrix,
+                    js_divergence_matrix, cluster_order, normalize_rows,
+                    bootstrap_compare)
 
 """
 A flexible tool for converting and extracting information from
@@ -104,6 +116,27 @@ feature.""",
     'tsql': """An additional tsql constraint, eg 't-active = 1'.""",
     'pspans': """Restrict all results to pertain to derivation subspans
 corresponding this this p-id (phenomenon id).""",
+    'bootstrap': """Draw this many item-level bootstrap resamples of
+each set of profiles to report confidence intervals for the divergences
+and the features whose frequencies differ significantly.""",
+    'confidence': """Confidence level used for bootstrap intervals and
+significance. Default is 0.95.""",
+    'seed': """Random seed used for bootstrap resampling.""",
+    'top': """Maximum number of significantly differing features to
+report. Default is 20.""",
+    'format': """Output format of the divergence matrix. Default is csv.""",
+    'cluster': """Order the profiles in the divergence matrix using
+hierarchical clustering, so that similar profiles are adjacent.""",
+    'processes': """Number of worker processes used to extract counts
+from profiles. Defaults to the number of CPUs.""",
+    'timing': """Append the time taken by each stage of processing (tsdb,
+ACE, typifier, derivation parsing etc) to this path as JSON lines. Use
+- for standard error.""",
+    'memprofile': """Trace memory allocations and write a report of the
+memory used at the end of each stage to this path, including the top
+allocation sites, the memory held by readings, trees, tokens and
+counters, and the peak RSS. Use - for standard error. The worker
+processes of the matrix command are not traced.""",
 }
 
 
@@ -119,10 +152,16 @@ def argparser():
     ap.add_argument("--pspans", type=int, help=OPTSHELP['pspans'])
     ap.add_argument("--le", action='store_true', help=OPTSHELP['le'])
     ap.add_argument("--debug", action='store_true')
+    ap.add_argument("--timing", metavar="PATH", help=OPTSHELP['timing'])
+    ap.add_argument("--memprofile", metavar="PATH", help=OPTSHELP['memprofile'])
     subparsers = ap.add_subparsers(help='Command help:', dest='command')
 
     # this assumes paths argument is two sequences of paths separated by '@'
     ap1 = subparsers.add_parser('compare', help='Compare distribuion of attributes across sets of profiles.')
+    ap1.add_argument("--bootstrap", type=int, metavar="RESAMPLES", help=OPTSHELP['bootstrap'])
+    ap1.add_argument("--confidence", type=float, default=0.95, help=OPTSHELP['confidence'])
+    ap1.add_argument("--seed", type=int, help=OPTSHELP['seed'])
+    ap1.add_argument("--top", type=int, default=20, help=OPTSHELP['top'])
     ap1.add_argument("feature", choices=COUNT_FEATURES, metavar="FEATURE")
     ap1.add_argument("paths", nargs='+', metavar="PATHS")
 
@@ -141,6 +180,13 @@ def argparser():
     ap4 = subparsers.add_parser('draw', help='Draw the derivation with a GUI from NLTK.')
     ap4.add_argument("paths", nargs='*', metavar="PATHS")
 
+    ap5 = subparsers.add_parser('matrix', help='Pairwise JS divergence of attribute distributions across profiles.')
+    ap5.add_argument("--format", choices=('csv', 'json'), default='csv', help=OPTSHELP['format'])
+    ap5.add_argument("--cluster", action='store_true', help=OPTSHELP['cluster'])
+    ap5.add_argument("--processes", type=int, help=OPTSHELP['processes'])
+    ap5.add_argument("feature", choices=COUNT_FEATURES, metavar="FEATURE")
+    ap5.add_argument("paths", nargs='+', metavar="PROFILES")
+
     return ap
 
 
@@ -255,22 +301,29 @@ def update_reading_counts(reading, feature, counts, ancestor):
     elif feature == 'rules':
         counts.update(reading.rules)
     elif feature == 'types':
+        pairs = zip(reading.type_names(), reading.type_counts)
         if ancestor is None:
-            counts.update(reading.types)    
+            for t, count in pairs:
+                counts[t] += count
         else:
-            hierarchy = load_hierarchy(reading.grammar.types_path)
+            hierarchy = load_hierarchy(reading.grammar.types_path,
+                                       symbols=reading.symbols)
             try:
                 descendant_types = set(t.name for t in hierarchy[ancestor].descendants())
             except TypeNotFoundError as e:
                 sys.stderr.write(str(e))
                 sys.exit()
-            for t in reading.types:
+            for t, count in pairs:
                 if t in descendant_types:
-                    counts[t] += reading.types[t]
+                    counts[t] += count
     else:
         raise UnknownFeatureException(feature)
 
 
+def format_counts(counts):
+    return '\n'.join('{}    {}'.format(val,key) for key,val in counts.most_common()) 
+
+
 def collection_features(results, feature, ancestor=None):
     counts = Counter()
 
@@ -278,19 +331,60 @@ def collection_features(results, feature, ancestor=None):
         for reading in item:
             update_reading_counts(reading, feature, counts, ancestor)
 
-    return '\n'.join('{}    {}'.format(val,key) for key,val in counts.most_common()) 
+    return format_counts(counts)
+
+
+def count_profiles(grammar, arg):
+    """Count a feature across the readings of profiles. Profiles are
+    processed one at a time and their readings only keep their counts,
+    so that memory use does not grow with the size of the treebank."""
+    lextypes = not (arg.feature in NONTDL_FEATURES or arg.le)
+    typifier = TYPIFIERBIN if arg.feature == 'types' else None
+    remaining = arg.cutoff
+    counts = Counter()
 
+    for path in arg.paths:
+        if remaining is not None and remaining <= 0:
+            break
+        items = get_profile_results([path], best=arg.best, gold=arg.gold,
+                                    grammar=grammar, lextypes=lextypes,
+                                    typifier=typifier, pspans=arg.pspans,
+                                    condition=arg.tsql, stats_only=True)
+        if remaining is not None:
+            items = items[:remaining]
+            remaining -= len(items)
 
-def compare_trees(results_dictA, results_dictB, feature):
-    resultsA = list(results_dictA.values())
-    resultsB = list(results_dictB.values())
+        for item in items:
+            for reading in item.readings:
+                update_reading_counts(reading, arg.feature, counts, arg.descendants)
+        memprofile.stage(os.path.basename(os.path.normpath(path)))
+
+    return format_counts(counts)
+
+
+def item_counts(items, feature, best=1):
+    """Return a list with a Counter of the feature for each item."""
+    counters = []
+
+    for item in items:
+        counts = Counter()
+        for reading in item.readings[:best]:
+            update_reading_counts(reading, feature, counts, None)
+        counters.append(counts)
+
+    return counters
+
+
+def compare_trees(itemsA, itemsB, feature, best=1, bootstrap=None,
+                  confidence=0.95, seed=None, top=20):
+    countersA = item_counts(itemsA, feature, best)
+    countersB = item_counts(itemsB, feature, best)
     countsA = Counter()
     countsB = Counter()
 
-    for results, counts in ((resultsA, countsA), (resultsB, countsB)):
-        for item in results:
-            for reading in item:
-                update_reading_counts(reading, feature, counts)
+    for counters, counts in ((countersA, countsA), (countersB, countsB)):
+        for c in counters:
+            counts.update(c)
 
     dist1, dist2 = counts2dist(countsA, countsB)
     kl = kl_divergence(dist1, dist2)
@@ -301,21 +395,130 @@ def compare_trees(results_dictA, results_dictB, feature):
         "JS divergence of {} = {}".format(feature, js),
     ]
 
+    if bootstrap:
+        lines.extend(bootstrap_report(countersA, countersB, feature, bootstrap,
+                                      confidence, seed, top))
+
     return '\n'.join(lines)
 
 
+def bootstrap_report(countersA, countersB, feature, resamples, confidence,
+                     seed, top):
+    """Resample items from each set to produce confidence intervals for the
+    divergences and the features whose frequency differs significantly."""
+    counts, features = counts2matrix(countersA + countersB)
+    split = len(countersA)
+    matrixA, matrixB = counts[:split], counts[split:]
+    kls, jss, pvalues = bootstrap_compare(matrixA, matrixB, resamples, seed)
+    alpha = 1 - confidence
+    bounds = [100*alpha/2, 100*(1 - alpha/2)]
+    lines = []
+
+    for name, values in (('KL', kls), ('JS', jss)):
+        low, high = np.percentile(values, bounds)
+        string = "{} divergence {:.0%} CI over {} resamples = [{}, {}]"
+        lines.append(string.format(name, confidence, resamples, low, high))
+
+    distA, distB = normalize_rows(np.vstack([matrixA.sum(axis=0),
+                                             matrixB.sum(axis=0)]))
+    diffs = distA - distB
+    significant = np.flatnonzero(pvalues < alpha)
+    significant = sorted(significant, key=lambda i:abs(diffs[i]), reverse=True)
+    lines.append("Features of {} differing at p < {:g}: {}".format(
+        feature, alpha, len(significant)))
+
+    for i in significant[:top]:
+        lines.append("{:+.6f}    {:.4f}    {}".format(diffs[i], pvalues[i], features[i]))
+
+    return lines
+
+
 def compare(grammar, arg):
     split = arg.paths.index('@')
     pathsA = arg.paths[:split]
     pathsB = arg.paths[split+1:]
-    readingA = get_profile_results(pathsA, best=arg.best, gold=arg.gold, 
-                                   cutoff=arg.cutoff, grammar=grammar)
+    lextypes = arg.feature == 'lextypes'
+    typifier = TYPIFIERBIN if arg.feature == 'types' else None
+    resultsA = get_profile_results(pathsA, best=arg.best, gold=arg.gold, 
+                                   grammar=grammar, lextypes=lextypes,
+                                   typifier=typifier, condition=arg.tsql,
+                                   stats_only=True)
+    memprofile.stage('first profiles')
     resultsB = get_profile_results(pathsB, best=arg.best, gold=arg.gold,
-                                   cutoff=arg.cutoff, grammar=grammar)
+                                   grammar=grammar, lextypes=lextypes,
+                                   typifier=typifier, condition=arg.tsql,
+                                   stats_only=True)
+    memprofile.stage('second profiles')
+    return compare_trees(resultsA[:arg.cutoff], resultsB[:arg.cutoff],
+                         arg.feature, best=arg.best, bootstrap=arg.bootstrap,
+                         confidence=arg.confidence, seed=arg.seed, top=arg.top)
+
+
+def profile_counts(path, grammar, feature, best=1, gold=False, cutoff=None,
+                   condition=None):
+    """Extract the counts of a feature across the readings of a single
+    profile."""
+    typifier = TYPIFIERBIN if feature == 'types' else None
+    lextypes = feature == 'lextypes'
+    # profiles are already processed in parallel, so each one's readings
+    # are reconstructed one at a time
+    items = get_profile_results([path], best=best, gold=gold, grammar=grammar,
+                                lextypes=lextypes, typifier=typifier,
+                                condition=condition, workers=1, stats_only=True)
+    counts = Counter()
+
+    for item in items[:cutoff]:
+        for reading in item.readings[:best]:
+            update_reading_counts(reading, feature, counts, None)
+
+    return counts
+
 
-    # TODO: need to turn readingsA and readingsB into dictionaries
-    # of {iid:results}. have changed the return value of get_profile_results
-    return compare_trees(resultsA, resultsB, arg.feature)
+def matrix(grammar, arg):
+    """Compute the JS divergence of a feature's distribution between
+    every pair of profiles. Counts are extracted from each profile once,
+    in parallel, largest profiles first."""
+    extract = functools.partial(profile_counts, grammar=grammar,
+                                feature=arg.feature, best=arg.best,
+                                gold=arg.gold, cutoff=arg.cutoff,
+                                condition=arg.tsql)
+
+    # a worker is given the next profile as soon as it is free, so
+    # starting with the largest keeps the last few from running alone
+    order = sorted(range(len(arg.paths)), key=lambda i: -schedule.profile_size(arg.paths[i]))
+    counters = [None] * len(arg.paths)
+    with ProcessPoolExecutor(max_workers=arg.processes) as executor:
+        for i, counter in zip(order, executor.map(extract, [arg.paths[i] for i in order])):
+            counters[i] = counter
+
+    counts, features = counts2matrix(counters)
+    divergences = js_divergence_matrix(counts)
+    names = [os.path.basename(os.path.normpath(p)) for p in arg.paths]
+
+    if arg.cluster:
+        order = cluster_order(divergences)
+    else:
+        order = list(range(len(names)))
+
+    names = [names[i] for i in order]
+    divergences = divergences[order][:, order]
+
+    if arg.format == 'json':
+        data = {
+            'feature': arg.feature,
+            'features': len(features),
+            'profiles': names,
+            'divergence': divergences.tolist(),
+        }
+        return json.dumps(data, indent=2)
+
+    lines = [['profile'] + names]
+    for name, row in zip(names, divergences):
+        lines.append([name] + ['{:.6f}'.format(x) for x in row])
+
+    output = io.StringIO()
+    csv.writer(output, lineterminator='\n').writerows(lines)
+    return output.getvalue().rstrip('\n')
 
 
 def draw(results_dict):
@@ -332,6 +535,9 @@ def get_results(grammar, arg):
     lextypes = not (arg.feature in NONTDL_FEATURES or arg.le)
     cache = (arg.command == 'convert' and arg.feature == 'derivation')
 
+    # counting only needs the counts of each reading
+    stats_only = arg.command == 'count'
+
     if arg.command == 'count' and arg.feature == 'types':
         typifier = TYPIFIERBIN
     else:
@@ -348,7 +554,7 @@ def get_results(grammar, arg):
                 with open(path) as f:
                     lines.extend(f.readlines())
         if arg.cutoff is not None:
-            lines = lines[:cutoff]
+            lines = lines[:arg.cutoff]
             
         if arg.feature == "short-derivation":
             results = get_short_label_results(
@@ -358,12 +564,15 @@ def get_results(grammar, arg):
             results = get_text_results(
                 lines, grammar, best=arg.best, ace_path=ACEBIN,
                 lextypes=lextypes, typifier=typifier, fragments=arg.fragments,
-                cache=cache)
+                cache=cache, stats_only=stats_only)
     else:
-        results = get_profile_results(
-            arg.paths, best=arg.best, gold=arg.gold, cutoff=arg.cutoff, 
+        items = get_profile_results(
+            arg.paths, best=arg.best, gold=arg.gold,
             grammar=grammar, lextypes=lextypes, typifier=typifier,
-            pspans=arg.pspans, condition=arg.tsql, cache=cache)
+            pspans=arg.pspans, condition=arg.tsql, cache=cache,
+            stats_only=stats_only)
+        results = {item.readings[0].iid: item.readings
+                   for item in items[:arg.cutoff]}
     return results
 
 
@@ -389,21 +598,29 @@ def main():
         #else:
         #    grammar.read_tdl(speech=False)
     grammar.read_tdl(speech=False)
+    schedule.configure(COSTPATH)
         
     try:
         # Do the thing!
-        if arg.command == 'compare':
-            print(compare(grammar, arg))
-        elif arg.command in ('count', 'convert', 'draw'):
-            results = get_results(grammar, arg)
-            if arg.command == 'count':
-                 print(collection_features(list(results.values()), arg.feature, 
-                                           arg.descendants))
-            elif arg.command == 'convert':
-                print(convert_trees(results, arg.feature, arg.align, arg.paths, 
-                                    arg.failtok, arg.best, arg.backoff))
-            elif arg.command == 'draw':
-                draw(results)
+        with timing.recording(arg.command, output=arg.timing, enabled=False), \
+             memprofile.profiling(arg.command, output=arg.memprofile):
+            if arg.command == 'compare':
+                print(compare(grammar, arg))
+            elif arg.command == 'matrix':
+                print(matrix(grammar, arg))
+            elif arg.command == 'count' and len(arg.paths) > 0 and not arg.parse:
+                print(count_profiles(grammar, arg))
+            elif arg.command in ('count', 'convert', 'draw'):
+                results = get_results(grammar, arg)
+                memprofile.stage('results')
+                if arg.command == 'count':
+                     print(collection_features(list(results.values()), arg.feature, 
+                                               arg.descendants))
+                elif arg.command == 'convert':
+                    print(convert_trees(results, arg.feature, arg.align, arg.paths, 
+                                        arg.failtok, arg.best, arg.backoff))
+                elif arg.command == 'draw':
+                    draw(results)
     except AceError as e:
         print(e)
 
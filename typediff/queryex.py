@@ -27,9 +27,10 @@ def do_query(results, grammar, signature):
     found_items = set()
     
     for iid, readings in results.items():
+        types = readings[0].types
         hit = True
         for t in signature:
-            if t not in readings[0].types:
+            if t not in types:
                 hit = False
                 break
         if hit:
@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import fcntl
+import queue
+import atexit
+import hashlib
+import tempfile
+import threading
+import contextvars
+from collections import deque
+
+
+"""Cost-aware scheduling of derivation reconstruction.
+
+The time the typifier takes to reconstruct a derivation grows with the
+size of the derivation, so when the derivations of a profile are
+reconstructed by a pool of workers in the order tsdb returns them, a
+few large trees arriving last leave the other workers idle. Instead,
+the cost of each derivation is estimated from its number of nodes and
+the derivations are dealt to the workers largest first, each worker
+going to the one with the least estimated work so far. Each worker
+takes the largest of its own remaining derivations, and when it has
+none left steals the smallest remaining derivation of the worker with
+the most estimated work left.
+
+The time actually taken by each derivation is recorded in a CostModel,
+which fits the cost per node of later estimates and remembers the cost
+of derivations it has seen, up to MAX_KNOWN of them. If configure is
+given a path, the model is loaded from and saved to it, so that
+estimates improve across runs. The model is saved at most every
+SAVE_INTERVAL seconds and at exit, merging the costs recorded since the
+last save with those saved meanwhile by other processes.
+"""
+
+
+# the most derivations whose cost is remembered
+MAX_KNOWN = 100000
+
+# the least seconds between saves of a cost model
+SAVE_INTERVAL = 60
+
+COSTS = None
+
+
+def derivation_nodes(derivation):
+    """The number of nodes of a derivation string, counting its tokens,
+    without parsing it."""
+    return derivation.count('(')
+
+
+def derivation_key(derivation):
+    return hashlib.sha1(derivation.encode('utf8')).hexdigest()
+
+
+class CostModel:
+    """Estimates the seconds it takes to reconstruct a derivation, as a
+    linear function of its number of nodes fitted to the costs recorded,
+    or as its recorded cost if it has been seen before."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.known = {}
+        # sums for the least squares fit of seconds against nodes
+        self.n = 0
+        self.sx = self.sy = self.sxx = self.sxy = 0.0
+        # what has been recorded since the model was last saved
+        self.new_known = {}
+        self.new_fit = [0, 0.0, 0.0, 0.0, 0.0]
+        self.saved = time.time()
+
+        state = self.load()
+        if state is not None:
+            self.known = state['known']
+            self.n, self.sx, self.sy, self.sxx, self.sxy = state['fit']
+
+    def load(self):
+        """The state saved at the path of the model, or None."""
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return json.load(f)
+
+    def coefficients(self):
+        """The intercept and cost per node of the fit, or 0 and 1 until
+        there are enough costs to fit, which orders derivations by
+        size."""
+        denominator = self.n * self.sxx - self.sx * self.sx
+        if self.n < 2 or denominator <= 0:
+            return 0.0, 1.0
+        slope = (self.n * self.sxy - self.sx * self.sy) / denominator
+        intercept = (self.sy - slope * self.sx) / self.n
+        if slope <= 0:
+            return self.sy / self.n, 0.0
+        return intercept, slope
+
+    def estimate(self, derivation, nodes=None):
+        with self.lock:
+            intercept, slope = self.coefficients()
+            # recorded costs are only comparable with fitted estimates
+            cost = self.known.get(derivation_key(derivation)) if self.n > 1 else None
+            if cost is not None:
+                return cost
+        if nodes is None:
+            nodes = derivation_nodes(derivation)
+        return intercept + slope * nodes
+
+    def record(self, derivation, seconds, nodes=None):
+        if nodes is None:
+            nodes = derivation_nodes(derivation)
+        terms = (1, nodes, seconds, nodes * nodes, nodes * seconds)
+        with self.lock:
+            if len(self.known) < MAX_KNOWN:
+                key = derivation_key(derivation)
+                self.known[key] = self.new_known[key] = seconds
+            self.n += 1
+            self.sx += nodes
+            self.sy += seconds
+            self.sxx += nodes * nodes
+            self.sxy += nodes * seconds
+            self.new_fit = [a + b for a, b in zip(self.new_fit, terms)]
+
+    def save(self, force=False):
+        """Save the model to its path, if it has one and anything has
+        been recorded since it was last saved, at least SAVE_INTERVAL
+        seconds ago unless force is True. The costs recorded since then
+        are merged with those saved by other processes in the meantime,
+        under a lock, and the file is replaced atomically."""
+        if self.path is None:
+            return
+        with self.lock:
+            if not self.new_fit[0] or (not force and
+                                       time.time() - self.saved < SAVE_INTERVAL):
+                return
+            new_known, self.new_known = self.new_known, {}
+            new_fit, self.new_fit = self.new_fit, [0, 0.0, 0.0, 0.0, 0.0]
+            self.saved = time.time()
+
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self.load() or {'known': {}, 'fit': [0, 0.0, 0.0, 0.0, 0.0]}
+            known = state['known']
+            for key, seconds in new_known.items():
+                if key in known or len(known) < MAX_KNOWN:
+                    known[key] = seconds
+            fit = [a + b for a, b in zip(state['fit'], new_fit)]
+
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.',
+                                            suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'known': known, 'fit': fit}, f)
+            os.replace(tmp_path, self.path)
+
+        # adopt the costs recorded by other processes, along with any
+        # recorded by this one while saving
+        with self.lock:
+            known.update(self.new_known)
+            self.known = known
+            self.n, self.sx, self.sy, self.sxx, self.sxy = (
+                a + b for a, b in zip(fit, self.new_fit))
+
+
+def configure(path=None):
+    """Record costs in a model loaded from and saved to path, if not
+    None, rather than in memory only. Costs not yet saved are saved at
+    exit."""
+    global COSTS
+    COSTS = CostModel(path)
+    if path is not None:
+        atexit.register(COSTS.save, force=True)
+
+
+def get_costs():
+    global COSTS
+    if COSTS is None:
+        COSTS = CostModel()
+    return COSTS
+
+
+class Scheduler:
+    """Deals tasks to the deques of workers, largest estimated cost
+    first, and hands each worker its next task, stealing from the most
+    loaded worker when its own deque is empty."""
+
+    def __init__(self, tasks, costs, workers):
+        self.lock = threading.Lock()
+        self.deques = [deque() for _ in range(workers)]
+        self.loads = [0.0] * workers
+
+        for cost, task in sorted(zip(costs, tasks), key=lambda x: -x[0]):
+            worker = min(range(workers), key=self.loads.__getitem__)
+            self.deques[worker].append((cost, task))
+            self.loads[worker] += cost
+
+    def next(self, worker):
+        """The next task for worker, or None if there are none left."""
+        with self.lock:
+            own = self.deques[worker]
+            if own:
+                cost, task = own.popleft()
+                self.loads[worker] -= cost
+                return task
+
+            victim = max(range(len(self.deques)), key=self.loads.__getitem__)
+            if not self.deques[victim]:
+                return None
+            cost, task = self.deques[victim].pop()
+            self.loads[victim] -= cost
+            return task
+
+
+def run_scheduled(func, items, workers, derivation=None, costs=None):
+    """Apply func to each of items in a pool of workers threads, largest
+    estimated cost first, recording the time each takes in costs (by
+    default the shared CostModel). The derivation of each item is given
+    by the function derivation, or is the item itself if None. Yields
+    (index, result) pairs in the order they complete. If func raises an
+    exception, the remaining items are abandoned and the exception is
+    raised."""
+    if costs is None:
+        costs = get_costs()
+    if derivation is None:
+        derivations = items
+    else:
+        derivations = [derivation(item) for item in items]
+    workers = max(1, min(workers, len(items)))
+    estimates = [costs.estimate(d) for d in derivations]
+    scheduler = Scheduler(range(len(items)), estimates, workers)
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def work(worker):
+        while not stop.is_set():
+            i = scheduler.next(worker)
+            if i is None:
+                break
+            start = time.time()
+            try:
+                result = func(items[i])
+            except BaseException as e:
+                results.put((i, None, e))
+                break
+            costs.record(derivations[i], time.time() - start)
+            results.put((i, result, None))
+        results.put(None)
+
+    # run the workers in copies of the current context, so that they
+    # inherit the deadline and timing recorder of the request, if any
+    threads = [threading.Thread(target=contextvars.copy_context().run,
+                                args=(work, w), daemon=True)
+               for w in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    running = workers
+    try:
+        while running:
+            item = results.get()
+            if item is None:
+                running -= 1
+                continue
+            i, result, error = item
+            if error is not None:
+                raise error
+            yield i, result
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        costs.save()
+
+
+def map_scheduled(func, items, workers, derivation=None, costs=None):
+    """Like run_scheduled, but returns the list of results in the order
+    of items."""
+    results = [None] * len(items)
+    for i, result in run_scheduled(func, items, workers, derivation=derivation,
+                                   costs=costs):
+        results[i] = result
+    return results
+
+
+def profile_size(path):
+    """The total size of the files of a profile, as an estimate of the
+    cost of processing it."""
+    size = 0
+    for name in os.listdir(path):
+        filename = os.path.join(path, name)
+        if os.path.isfile(filename):
+            size += os.path.getsize(filename)
+    return size
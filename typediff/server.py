@@ -1,78 +1,321 @@
+import os
 import json
 import sys
 import csv
+import functools
 from datetime import datetime
 from collections import defaultdict
 
-from flask import Flask, request, jsonify
+import flask
+from flask import Flask, Response, request
+try:
+    # Flask 2.2 and later
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:
+    DefaultJSONProvider = None
 
-from .config import LOGONROOT, TREEBANKLIST, FANGORNPATH, PROFILELIST
+from .config import (LOGONROOT, TREEBANKLIST, FANGORNPATH, PROFILELIST,
+                     JSONPATH, CACHEPATH, CACHEMEMORY, CACHEDISK, LOCKPATH,
+                     FLIGHTTTL, PROCESSLIMIT, PROCESSQUEUE, PROCESSWAIT,
+                     REQUESTDEADLINE, TIMINGPATH, METRICSPATH, COSTPATH)
+from . import jobs
+from . import limits
+from . import schedule
+from . import timing
+from . import metrics
+from .cache import ResultCache, cache_key, file_digest
+from .singleflight import SingleFlight, request_key
 from .gram import get_grammar, get_grammars
 from .delphin import (init_paths, JSONEncoder, load_hierarchy, Treebank,
-                      dotdict, Profile, AceError)
+                      dotdict, Profile, AceError, TsdbError, get_symbols,
+                      item_dict, map_ordered, sharing_typifier, READING_FIELDS,
+                      dump_items, load_items)
 
 # set LOGONROOT environment variable in case it's not set
 init_paths(logonroot=LOGONROOT)
 
-from .typediff import typediff_web, process_sentences, process_profiles
+from .typediff import (typediff_web, typediff_compact, web_metadata,
+                       ranking_data, process_sentences, iter_profiles,
+                       load_treebank_stats, RANK_STATISTICS)
 
 
 app = Flask(__name__)
 app.json_encoder = JSONEncoder
 
+if DefaultJSONProvider is not None:
+    class JSONProvider(DefaultJSONProvider):
+        """Encodes responses with JSONEncoder, as Flask 2.2 and later
+        ignore app.json_encoder."""
+        default = staticmethod(JSONEncoder().default)
+
+    app.json = JSONProvider(app)
+
 PROFILES = {p['alias']: Profile(p) for p in PROFILELIST}
+TREEBANKS = {t['alias']: Treebank(t) for t in TREEBANKLIST}
+# the version of the results stored in the caches, to be increased
+# whenever the way items are stored changes, so that results stored by
+# older code are not used
+CACHE_VERSION = 2
 
-@app.route('/parse-types', methods=['POST'])
-def parse_types():
+PROFILE_CACHE = ResultCache(CACHEMEMORY, cache_dir=CACHEPATH,
+                            max_disk_bytes=CACHEDISK, name='profiles')
+PROFILE_FLIGHTS = SingleFlight(PROFILE_CACHE, lock_dir=LOCKPATH)
+
+# parsed sentences are only held for long enough to be shared with
+# identical requests that arrived while they were being parsed
+FLIGHTPATH = os.path.join(CACHEPATH, 'flights') if CACHEPATH else None
+SENTENCE_CACHE = ResultCache(CACHEMEMORY // 8, cache_dir=FLIGHTPATH,
+                             max_disk_bytes=CACHEDISK // 8, name='sentences')
+SENTENCE_FLIGHTS = SingleFlight(SENTENCE_CACHE, lock_dir=LOCKPATH,
+                                ttl=FLIGHTTTL)
+
+limits.configure(PROCESSLIMIT, PROCESSQUEUE, PROCESSWAIT, LOCKPATH)
+
+if METRICSPATH is not None:
+    metrics.configure(METRICSPATH)
+
+schedule.configure(COSTPATH)
+
+# request parameters that determine the items parsed for /parse-types
+SENTENCE_PARAMS = ('pos-items', 'neg-items', 'grammar-name', 'count',
+                   'tagger', 'fragments')
+
+# field sets of /process-profiles which need no more of a reading than its
+# counts, so that profiles can be processed with only those kept
+STATS_ONLY_FIELDS = ('summary', 'types-only')
+
+
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unknown'
+    metrics.inc('requests_total', endpoint=endpoint, status=response.status_code)
+    if response.content_length is not None:
+        metrics.observe('response_bytes', response.content_length,
+                        endpoint=endpoint)
+    metrics.save()
+    return response
+
+
+@app.errorhandler(limits.BusyError)
+def server_busy(error):
+    metrics.inc('busy_total')
+    response = jsonify({'success': False, 'busy': True, 'error': error.msg})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+@app.errorhandler(limits.Timeout)
+def request_timeout(error):
+    response = jsonify({'success': False, 'error': error.msg})
+    response.status_code = 504
+    return response
+
+
+def with_deadline(view):
+    """Decorator giving the ACE, typifier and tsdb processes run by a
+    request REQUESTDEADLINE seconds to finish."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with limits.deadline(REQUESTDEADLINE):
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def timed(view):
+    """Decorator recording the time taken by each stage of a request,
+    writing them to TIMINGPATH, if set, and including a summary in the
+    response if the request has debug=true."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        debug = request.values.get('debug') == 'true'
+        with timing.recording(request.path, output=TIMINGPATH, enabled=debug):
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def jsonify(data):
+    """Like flask.jsonify, but timing the encoding of the response and
+    adding the timing summary requested by the debug parameter."""
+    recorder = timing.current()
+    if recorder is not None and request.values.get('debug') == 'true':
+        data = dict(data, timing=recorder.summary())
+    with timing.span('json'):
+        return flask.jsonify(data)
+
+
+class FormError(Exception):
+    """Raised for invalid request parameters."""
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+@app.errorhandler(FormError)
+def form_error(error):
+    return jsonify({'success': False, 'error': error.msg})
+
+
+def int_param(form, name, default):
+    """The integer value of the parameter name of the request form, or
+    default if it is missing or empty."""
+    value = form.get(name, '').strip()
+    if value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise FormError(f'{name} must be an integer, not {value!r}.')
+
+
+def diff_opts(opts, form):
+    """Add the options for comparing and ranking types, as supplied with
+    the request form, to opts. Raises FormError if they are invalid."""
+    rank = form.get('rank', '')
+    operator = form.get('operator', 'difference')
+    opts.rank = rank if rank in RANK_STATISTICS else None
+    opts.min_pos = int_param(form, 'min-pos', 1)
+    opts.max_neg = int_param(form, 'max-neg', 0)
+    opts.fields = form.get('fields', 'web')
+    if opts.fields not in READING_FIELDS:
+        opts.fields = 'web'
+    opts.d = operator == 'difference'
+    opts.i = operator == 'intersection'
+    opts.u = operator == 'union'
+
+    if opts.rank == 'tfidf':
+        alias = form.get('treebank', opts.treebank)
+        if alias not in TREEBANKS:
+            raise FormError('Ranking by tfidf requires a treebank, '
+                            f'not {alias!r}.')
+        treebank = TREEBANKS[alias]
+        path = os.path.join(JSONPATH, treebank.json)
+        opts.tbstats = load_treebank_stats(path, trees=treebank.trees)
+
+
+def sentence_opts(form):
+    """Options for parsing sentences, as supplied with the request form."""
     opts = dotdict({
-        'count': int(request.form.get('count')),
-        'tnt': request.form.get('tagger') == 'tnt2D',
-        'grammar': get_grammar(request.form.get('grammar-name')),
-        'desc': request.form.get('load-descendants') == 'true',
-        'fragments': request.form.get('fragments') == 'true',
-        'supers': request.form.get('supers')
+        'count': int(form.get('count')),
+        'tnt': form.get('tagger') == 'tnt2D',
+        'grammar': get_grammar(form.get('grammar-name')),
+        'desc': form.get('load-descendants') == 'true',
+        'fragments': form.get('fragments') == 'true',
+        'supers': form.get('supers')
     })
+    diff_opts(opts, form)
+    return opts
+
 
+@app.route('/parse-types', methods=['POST'])
+@with_deadline
+@timed
+def parse_types():
+    opts = sentence_opts(request.form)
     pos_inputs = request.form.get('pos-items', '').strip().splitlines()
     neg_inputs = request.form.get('neg-items', '').strip().splitlines()
+    key = cache_key(CACHE_VERSION,
+                    request_key('parse-types', request.form, SENTENCE_PARAMS))
+
     try:
-        pos_items = process_sentences(pos_inputs, opts)
-        neg_items = process_sentences(neg_inputs, opts)
+        with SENTENCE_FLIGHTS.flight(key) as data:
+            if data is None:
+                # parse the positive and negative items together, so
+                # that they are all processed concurrently
+                items = process_sentences(pos_inputs + neg_inputs, opts)
+                SENTENCE_FLIGHTS.put(key, dump_items(items))
     except AceError as e:
         return jsonify({'success':False, 'error': e.msg})
 
+    if data is not None:
+        items = load_items(data, opts.grammar)
+    pos_items, neg_items = items[:len(pos_inputs)], items[len(pos_inputs):]
+
+    metrics.observe('request_items', len(pos_items) + len(neg_items),
+                    endpoint=request.path)
+
     data = typediff_web(pos_items, neg_items, opts)
     data['success'] = True
 
     return jsonify(data)
 
 
+def profile_queries(opts, form):
+    """Resolve the positive and negative profiles specified by the
+    request form into (polarity, query) pairs, setting the grammar and
+    treebank of opts."""
+    queries = []
+
+    for polarity in ('pos', 'neg'):
+        prof_name = form.get(f'{polarity}-profile', '')
+        prof_filter = form.get(f'{polarity}-profile-filter', '')
+
+        if prof_name != '':
+            prof = PROFILES[prof_name]
+            opts.grammar = get_grammar(prof.grammar)
+            opts.treebank = prof.treebank
+            queries.append((polarity, f'{prof.home}:{prof_filter}'))
+
+    return queries
+
+
+def profile_items(opts, form):
+    """Process the positive and negative profiles specified by the
+    request form, returning lists of their items."""
+    items = {'pos': [], 'neg': []}
+
+    for polarity, query in profile_queries(opts, form):
+        items[polarity] = list(cached_profile(query, opts))
+
+    return items['pos'], items['neg']
+
+
+def profile_cache_key(query, grammar, stats_only=False):
+    """The key of the items of a profile query in PROFILE_CACHE. Gold
+    profiles are static, so entries are keyed on the query and the
+    grammar image used to process them. Items processed in stats-only
+    mode are cached separately, as their readings lack trees and MRSs."""
+    parts = [CACHE_VERSION, query, file_digest(grammar.dat_path)]
+    if stats_only:
+        parts.append('stats-only')
+    return cache_key(*parts)
+
+
+def cached_profile(query, opts):
+    """Generate the items of a profile query, from PROFILE_CACHE if they
+    have been processed before, otherwise processing them and caching
+    them, serialized with all their fields, once they are all done.
+    Items being processed are generated as soon as each is ready, while
+    concurrent requests for the same query wait for them to finish and
+    use the cached result."""
+    key = profile_cache_key(query, opts.grammar, opts.stats_only)
+
+    with PROFILE_FLIGHTS.flight(key) as data:
+        if data is None:
+            items = []
+            for item in iter_profiles(query, opts):
+                items.append(item)
+                yield item
+            PROFILE_FLIGHTS.put(key, dump_items(items))
+            return
+
+    yield from load_items(data, opts.grammar)
+
+
 @app.route('/process-profiles', methods=['POST'])
+@with_deadline
+@timed
 def process_the_profiles():
-    pos_prof_name = request.form.get('pos-profile', '')
-    neg_prof_name = request.form.get('neg-profile', '')
-    pos_prof_filter = request.form.get('pos-profile-filter', '')
-    neg_prof_filter = request.form.get('neg-profile-filter', '')
-
-    pos_items, neg_items = [], []
-    
     opts = dotdict({
         'desc': request.form.get('load-descendants') == 'true',
+        'stats_only': request.form.get('fields') in STATS_ONLY_FIELDS,
     })
-    
-    if pos_prof_name != '':
-        prof = PROFILES[pos_prof_name]
-        query = f'{prof.home}:{pos_prof_filter}'
-        opts.grammar = get_grammar(prof.grammar)
-        opts.treebank = prof.treebank
-        pos_items = process_profiles(query, opts)
-
-    if neg_prof_name != '':
-        prof = PROFILES[neg_prof_name]
-        query = f'{prof.home}:{neg_prof_filter}'
-        opts.grammar = get_grammar(prof.grammar)
-        opts.treebank = prof.treebank
-        neg_items = process_profiles(query, opts)
+    pos_items, neg_items = profile_items(opts, request.form)
+    diff_opts(opts, request.form)
+    metrics.observe('request_items', len(pos_items) + len(neg_items),
+                    endpoint=request.path)
 
     # for now assume that both profiles will be parsed using the
     # same grammar version, so use whichever grammar was assigned
@@ -82,6 +325,253 @@ def process_the_profiles():
     return jsonify(data)
 
 
+@app.route('/process-profiles-stream', methods=['POST'])
+def stream_the_profiles():
+    """Streaming variant of /process-profiles. Sends newline-delimited
+    JSON records: a header with the typediff metadata, one record for
+    each item as soon as it has been processed and a final summary."""
+    opts = dotdict({
+        'desc': request.form.get('load-descendants') == 'true',
+        'stats_only': request.form.get('fields') in STATS_ONLY_FIELDS,
+    })
+    queries = profile_queries(opts, request.form)
+    diff_opts(opts, request.form)
+
+    debug = request.values.get('debug') == 'true'
+    path = request.path
+
+    def ndjson(record):
+        return json.dumps(record, cls=JSONEncoder) + '\n'
+
+    def generate():
+        with timing.recording(path, output=TIMINGPATH,
+                              enabled=debug) as recorder:
+            yield from stream(recorder)
+
+    def stream(recorder):
+        items = {'pos': [], 'neg': []}
+
+        if opts.grammar is None:
+            yield ndjson({'record': 'summary', 'success': False,
+                          'error': 'No profiles selected.'})
+            return
+
+        header = web_metadata(opts)
+        header['record'] = 'header'
+        yield ndjson(header)
+
+        try:
+            with limits.deadline(REQUESTDEADLINE):
+                for polarity, query in queries:
+                    for item in cached_profile(query, opts):
+                        items[polarity].append(item)
+                        yield ndjson({'record': 'item', 'polarity': polarity,
+                                      'item': item_dict(item, opts.fields)})
+        except (AceError, TsdbError, limits.BusyError, limits.Timeout) as e:
+            yield ndjson({'record': 'summary', 'success': False,
+                          'error': str(e)})
+            return
+
+        summary = {
+            'record': 'summary',
+            'success': True,
+            'pos-count': len(items['pos']),
+            'neg-count': len(items['neg']),
+        }
+        if opts.rank:
+            summary['ranking'] = ranking_data(items['pos'], items['neg'], opts)
+        if debug:
+            summary['timing'] = recorder.summary()
+        metrics.observe('request_items', len(items['pos']) + len(items['neg']),
+                        endpoint=path)
+        metrics.save()
+        yield ndjson(summary)
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/diff-profiles', methods=['POST'])
+@with_deadline
+@timed
+def diff_profiles():
+    """Like /process-profiles, but performs the diff server-side and
+    only returns the resulting types and their item counts."""
+    opts = dotdict({'stats_only': True})
+    pos_items, neg_items = profile_items(opts, request.form)
+    diff_opts(opts, request.form)
+    metrics.observe('request_items', len(pos_items) + len(neg_items),
+                    endpoint=request.path)
+    data = typediff_compact(pos_items, neg_items, opts)
+    data['success'] = True
+
+    return jsonify(data)
+
+
+@app.route('/item-detail', methods=['POST'])
+@with_deadline
+@timed
+def item_detail():
+    """Fetch a single item with the named set of fields, by default all
+    of them, so that derivation trees and MRSs omitted from the results
+    of other requests can be loaded on demand. Profile items are
+    identified by 'profile', 'profile-filter' and 'i-id', sentences by
+    'input' and the parsing options of /parse-types."""
+    fields = request.form.get('fields', 'full')
+    if fields not in READING_FIELDS:
+        return jsonify({'success': False, 'error': f'Unknown fields: {fields}'})
+
+    try:
+        if request.form.get('profile', '') != '':
+            item = find_profile_item(request.form)
+        else:
+            opts = sentence_opts(request.form)
+            item = process_sentences([request.form.get('input', '')], opts)[0]
+    except (AceError, TsdbError) as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+    if item is None:
+        return jsonify({'success': False, 'error': 'Item not found.'}), 404
+
+    return jsonify({'success': True, 'item': item_dict(item, fields)})
+
+
+def find_profile_item(form):
+    """Find the profile item specified by the request form, preferably
+    among the cached items of the query it was originally part of,
+    otherwise among those of a query for just that item, which are
+    processed and cached with all their fields if need be. Raises
+    FormError if the profile or i-id are invalid."""
+    alias = form.get('profile')
+    if alias not in PROFILES:
+        raise FormError(f'Unknown profile: {alias!r}.')
+    iid = int_param(form, 'i-id', None)
+    if iid is None:
+        raise FormError('An i-id is required.')
+
+    prof = PROFILES[alias]
+    opts = dotdict({'grammar': get_grammar(prof.grammar), 'stats_only': False})
+    query = f"{prof.home}:{form.get('profile-filter', '')}"
+    data = PROFILE_CACHE.get(profile_cache_key(query, opts.grammar))
+
+    # items processed in stats-only mode, as the web interface lists
+    # them, lack the trees and MRSs asked for here
+    if data is None:
+        items = list(cached_profile(f'{prof.home}:i-id = {iid}', opts))
+    else:
+        items = load_items(data, opts.grammar)
+
+    return next((x for x in items if str(x.best.iid) == str(iid)), None)
+
+
+def profiles_job(form, job):
+    """Background job equivalent of /process-profiles."""
+    opts = dotdict({
+        'desc': form.get('load-descendants') == 'true',
+        'stats_only': form.get('fields') in STATS_ONLY_FIELDS,
+    })
+    queries = profile_queries(opts, form)
+    diff_opts(opts, form)
+    items = {'pos': [], 'neg': []}
+
+    # jobs wait for grammar processes rather than being refused as busy
+    with limits.patient():
+        for polarity, query in queries:
+            for item in cached_profile(query, opts):
+                items[polarity].append(item)
+                job.progress(item)
+
+    data = typediff_web(items['pos'], items['neg'], opts)
+    data['success'] = True
+    return data
+
+
+def sentences_job(form, job):
+    """Background job equivalent of /parse-types."""
+    opts = sentence_opts(form)
+    items = {'pos': [], 'neg': []}
+
+    inputs = [(polarity, sentence) for polarity in ('pos', 'neg') for sentence
+              in form.get(f'{polarity}-items', '').strip().splitlines()]
+
+    def parse(input):
+        return process_sentences([input[1]], opts)[0]
+
+    try:
+        with limits.patient(), sharing_typifier():
+            for (polarity, _sentence), item in zip(inputs, map_ordered(parse, inputs)):
+                items[polarity].append(item)
+                job.progress(item)
+    except AceError as e:
+        return {'success': False, 'error': e.msg}
+
+    data = typediff_web(items['pos'], items['neg'], opts)
+    data['success'] = True
+    return data
+
+
+JOB_FUNCS = {
+    'process-profiles': profiles_job,
+    'parse-types': sentences_job,
+}
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Submit a /process-profiles or /parse-types request, as specified
+    by the 'job' parameter, to be run in the background."""
+    kind = request.form.get('job')
+    if kind not in JOB_FUNCS:
+        return jsonify({'success': False, 'error': f'Unknown job: {kind}'})
+    params = request.form.to_dict()
+    job_id = jobs.submit(JOB_FUNCS[kind], kind, params)
+    return jsonify({'success': True, 'job': job_id})
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    try:
+        data = jobs.status(job_id)
+    except jobs.JobNotFoundError as e:
+        return jsonify({'success': False, 'error': e.msg}), 404
+    data['success'] = True
+    return jsonify(data)
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    try:
+        result = jobs.result(job_id)
+    except jobs.JobNotFoundError as e:
+        return jsonify({'success': False, 'error': e.msg}), 404
+    if result is None:
+        data = jobs.status(job_id)
+        data['success'] = False
+        data['error'] = data['error'] or f"Job is {data['status']}."
+        return jsonify(data)
+    return Response(result, mimetype='application/json')
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    try:
+        cancelled = jobs.cancel(job_id)
+    except jobs.JobNotFoundError as e:
+        return jsonify({'success': False, 'error': e.msg}), 404
+    return jsonify({'success': True, 'cancelled': cancelled})
+
+
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+    """Metrics of all server processes in the Prometheus text format."""
+    slots, queued = limits.usage()
+    gauges = [
+        ('process_slots_busy', 'Process slots in use.', slots),
+        ('process_queue_depth', 'Processes waiting for a process slot.', queued),
+    ]
+    return Response(metrics.exposition(gauges),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/annotate', methods=['POST'])
 def annotate():
     name = request.form.get('name').lower().replace(' ', '_')
@@ -118,7 +608,7 @@ def find_supers():
     
     descendants = {} # {supertype: set of descendents}
     grammar = get_grammar(alias)
-    hierarchy = load_hierarchy(grammar.types_path)
+    hierarchy = load_hierarchy(grammar.types_path, symbols=get_symbols(grammar))
     types_to_supers = defaultdict(list)
 
     for s in supers:
@@ -0,0 +1,174 @@
+import os
+import time
+import fcntl
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from . import limits
+from .cache import cache_key
+
+
+"""Coalescing of identical concurrent computations.
+
+When several requests with the same parameters arrive at once, only
+the first performs the computation, while the others wait for it to
+finish and then share its result. Requests are serialized on a lock
+for their key, first between the threads of a process and then
+between processes with a lock file, and results are passed on through
+a store shared by all processes, such as a ResultCache with a cache
+directory. Waiting for a lock gives up with limits.Timeout when the
+deadline of the request passes.
+"""
+
+
+# what limits.Timeout reports as stopped when a wait times out
+WAITER = 'The wait for an identical request'
+
+
+class SingleFlight:
+    """Serializes computations with the same key, handing the result of
+    the first to those waiting on it through store, which must provide
+    get(key) and put(key, value) for string values, so results must be
+    strings too. If ttl is given, stored results are only shared for
+    that many seconds after being computed, otherwise the store acts as
+    a cache."""
+
+    def __init__(self, store, lock_dir=None, ttl=None):
+        self.store = store
+        self.lock_dir = lock_dir or tempfile.gettempdir()
+        self.ttl = ttl
+        self.locks = {}
+        self.mutex = threading.Lock()
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    @contextmanager
+    def flight(self, key):
+        """Context manager which yields the result for key if one is
+        available, possibly after waiting for another computation of it
+        to finish. Otherwise it yields None, and the caller should
+        compute the result and pass it to put before leaving the
+        context, while other callers with the same key wait. The locks
+        are held until the context is left."""
+        result = self.get(key)
+        if result is not None:
+            yield result
+            return
+
+        with self._thread_lock(key), self._file_lock(key):
+            yield self.get(key)
+
+    def do(self, key, func):
+        """Return the result of func(), sharing it with any identical
+        concurrent calls with the same key."""
+        with self.flight(key) as result:
+            if result is None:
+                result = func()
+                self.put(key, result)
+            return result
+
+    def get(self, key):
+        value = self.store.get(key)
+        if value is None or self.ttl is None:
+            return value
+        timestamp, result = value.split('\n', 1)
+        return result if time.time() - float(timestamp) <= self.ttl else None
+
+    def put(self, key, result):
+        if self.ttl is None:
+            self.store.put(key, result)
+        else:
+            self.store.put(key, '{}\n{}'.format(time.time(), result))
+
+    @contextmanager
+    def _thread_lock(self, key):
+        with self.mutex:
+            lock, users = self.locks.get(key, (threading.Lock(), 0))
+            self.locks[key] = (lock, users + 1)
+        try:
+            left = limits.remaining()
+            if not lock.acquire(timeout=-1 if left is None else left):
+                raise limits.Timeout(WAITER)
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            with self.mutex:
+                lock, users = self.locks[key]
+                if users == 1:
+                    del self.locks[key]
+                else:
+                    self.locks[key] = (lock, users - 1)
+
+    @contextmanager
+    def _file_lock(self, key):
+        # each key has its own lock file, which its holder removes when
+        # done so that they do not accumulate. A waiter which then gets
+        # the lock of the removed file tries again with a new one.
+        digest = hashlib.sha1(key.encode('utf8')).hexdigest()
+        path = os.path.join(self.lock_dir, 'flight-{}.lock'.format(digest))
+        left = limits.remaining()
+        give_up = None if left is None else time.time() + left
+
+        while True:
+            f = open(path, 'a')
+            try:
+                lock_file(f, give_up)
+                current = same_file(f, path)
+            except BaseException:
+                f.close()
+                raise
+            if current:
+                break
+            f.close()
+
+        try:
+            yield
+        finally:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            f.close()
+
+
+def lock_file(f, give_up=None):
+    """Take an exclusive lock on the open file f, raising limits.Timeout
+    if it is not available by the time give_up."""
+    if give_up is None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return
+
+    delay = 0.01
+    while True:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            if time.time() >= give_up:
+                raise limits.Timeout(WAITER)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.25)
+
+
+def same_file(f, path):
+    """Whether the open file f is still the file at path."""
+    try:
+        return os.stat(path).st_ino == os.fstat(f.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def request_key(endpoint, form, names):
+    """A key for a request to endpoint, from the values of the named
+    parameters of its form, with whitespace around input lines removed
+    so that trivially different requests are coalesced."""
+    params = [endpoint]
+
+    for name in sorted(names):
+        lines = form.get(name, '').strip().splitlines()
+        params.append('\n'.join(line.strip() for line in lines))
+
+    return cache_key(*params)
@@ -4,6 +4,9 @@ import math
 import itertools
 from collections import Counter
 
+import numpy as np
+from scipy import sparse
+
 """These functions assume that a probability distribution is
 represented by a sequence of values which form... a probability
 distribution. Functions that compare more than one distribution
@@ -13,11 +16,11 @@ require that the sequence have the same ordering of events.
 
 def counts2dist(*counters):
     """Converts a list of Counters into probability distributions."""
-    keys = set(itertools.chain.from_iterable(c.iterkeys() for c in counters))
+    keys = set(itertools.chain.from_iterable(c.keys() for c in counters))
     dists = []
 
     for c in counters:
-        tot = sum(c.itervalues())
+        tot = sum(c.values())
         dists.append([c[k]/tot for k in keys])
     
     return dists
@@ -47,8 +50,8 @@ def js_divergence2(dista, distb):
     """Calculates the Jenson Shannon Divergence of two probability
     distributions"""
     func = lambda x, y: 0 if x == 0 else x*math.log(x/y) 
-    AM = sum(func(a, 0.5*(a+b)) for a,b in itertools.izip(dista, distb))
-    BM = sum(func(b, 0.5*(a+b)) for a,b in itertools.izip(dista, distb))
+    AM = sum(func(a, 0.5*(a+b)) for a,b in zip(dista, distb))
+    BM = sum(func(b, 0.5*(a+b)) for a,b in zip(dista, distb))
     return 0.5*AM + 0.5*BM
 
 
@@ -62,4 +65,186 @@ def kl_divergence(dista, distb):
             return 0
         else:
             return b*math.log(b/a) 
-    return sum(func(a,b) for a,b in itertools.izip(dista, distb))
+    return sum(func(a,b) for a,b in zip(dista, distb))
+
+
+def counts2matrix(counters):
+    """Converts a list of Counters into a sparse matrix with one row per
+    Counter and one column per feature. Returns the matrix along with
+    the list of feature names corresponding to the columns."""
+    features = sorted(set(itertools.chain.from_iterable(counters)))
+    index = {f:i for i, f in enumerate(features)}
+    rows, cols, vals = [], [], []
+
+    for row, c in enumerate(counters):
+        for key, val in c.items():
+            rows.append(row)
+            cols.append(index[key])
+            vals.append(val)
+
+    shape = (len(counters), len(features))
+    matrix = sparse.csr_matrix((vals, (rows, cols)), shape=shape, dtype=float)
+    return matrix, features
+
+
+def xlogx(a):
+    """Elementwise a*log(a), with 0*log(0) taken to be 0."""
+    logs = np.zeros_like(a)
+    np.log(a, out=logs, where=a > 0)
+    return a * logs
+
+
+def normalize_rows(matrix):
+    """Converts a (sparse) matrix of counts into a dense array of row-wise
+    probability distributions. Rows summing to zero are left as zeros."""
+    dense = matrix.toarray() if sparse.issparse(matrix) else np.asarray(matrix, dtype=float)
+    totals = dense.sum(axis=-1, keepdims=True)
+    return np.divide(dense, totals, out=np.zeros_like(dense), where=totals > 0)
+
+
+def js_divergence_matrix(matrix, chunk_bytes=2**26):
+    """Calculates the pairwise Jenson Shannon Divergence between each of
+    the rows of a (sparse) matrix of counts. Pairs of rows are compared
+    in broadcast chunks of at most roughly chunk_bytes."""
+    dists = normalize_rows(matrix)
+    n, f = dists.shape
+    entropies = -xlogx(dists).sum(axis=1)
+    result = np.zeros((n, n))
+    step = max(1, chunk_bytes // max(1, 8*n*f))
+
+    for start in range(0, n, step):
+        stop = min(n, start + step)
+        mixtures = (dists[start:stop, None, :] + dists[None, :, :]) / 2
+        mix_entropies = -xlogx(mixtures).sum(axis=2)
+        result[start:stop] = mix_entropies - (entropies[start:stop, None] + entropies[None, :])/2
+
+    # clip negative values arising from floating point error
+    np.clip(result, 0, None, out=result)
+    np.fill_diagonal(result, 0)
+    return result
+
+
+def cluster_order(dist_matrix, method='average'):
+    """Return an ordering of the rows of a square distance matrix
+    produced by hierarchical clustering, such that similar rows are
+    adjacent."""
+    from scipy.cluster.hierarchy import linkage, leaves_list
+    from scipy.spatial.distance import squareform
+
+    if len(dist_matrix) < 3:
+        return list(range(len(dist_matrix)))
+
+    condensed = squareform(dist_matrix, checks=False)
+    return [int(i) for i in leaves_list(linkage(condensed, method=method))]
+
+
+def kl_divergence_rows(dista, distb):
+    """Row-wise version of kl_divergence for two arrays of
+    distributions, skipping events where either probability is zero."""
+    both = (dista > 0) & (distb > 0)
+    ratios = np.ones_like(distb)
+    np.divide(distb, dista, out=ratios, where=both)
+    return (distb * np.log(ratios)).sum(axis=-1)
+
+
+def js_divergence_rows(dista, distb):
+    """Row-wise Jenson Shannon Divergence of two arrays of
+    distributions."""
+    mixture = (dista + distb) / 2
+    return (-xlogx(mixture).sum(axis=-1) +
+            (xlogx(dista).sum(axis=-1) + xlogx(distb).sum(axis=-1))/2)
+
+
+def bootstrap_totals(matrix, resamples, rng, batch=100):
+    """Draw item-level bootstrap resamples from a (sparse) matrix of
+    per-item counts, yielding arrays of the summed counts for batches
+    of at most batch resamples. Each resample draws as many items, with
+    replacement, as there are rows in the matrix."""
+    n = matrix.shape[0]
+    matrix = sparse.csr_matrix(matrix)
+
+    for start in range(0, resamples, batch):
+        size = min(batch, resamples - start)
+        draws = rng.integers(0, n, size=(size, n))
+        offsets = np.arange(size)[:, None] * n
+        weights = np.bincount((draws + offsets).ravel(), minlength=size*n)
+        weights = sparse.csr_matrix(weights.reshape(size, n), dtype=float)
+        yield (weights @ matrix).toarray()
+
+
+def bootstrap_compare(matrixa, matrixb, resamples=1000, seed=None, batch=100):
+    """Bootstrap the KL and JS divergences between two collections of
+    items, given (sparse) matrices of per-item counts with the same
+    columns. Returns the divergences for each resample along with
+    per-feature two-sided p-values for the difference in the feature's
+    relative frequency between the two collections. If either collection
+    has no items there is nothing to resample, and the divergences and
+    p-values are all NaN."""
+    if matrixa.shape[0] == 0 or matrixb.shape[0] == 0:
+        nans = np.full(resamples, np.nan)
+        return nans, nans.copy(), np.full(matrixa.shape[1], np.nan)
+
+    rng = np.random.default_rng(seed)
+    kls, jss = [], []
+    below = np.zeros(matrixa.shape[1])
+    above = np.zeros(matrixa.shape[1])
+    batches = zip(bootstrap_totals(matrixa, resamples, rng, batch),
+                  bootstrap_totals(matrixb, resamples, rng, batch))
+
+    for totalsa, totalsb in batches:
+        dista = normalize_rows(totalsa)
+        distb = normalize_rows(totalsb)
+        kls.append(kl_divergence_rows(dista, distb))
+        jss.append(js_divergence_rows(dista, distb))
+        diffs = dista - distb
+        below += (diffs <= 0).sum(axis=0)
+        above += (diffs >= 0).sum(axis=0)
+
+    pvalues = np.minimum(1, 2*np.minimum(below, above)/resamples)
+    return np.concatenate(kls), np.concatenate(jss), pvalues
+
+
+def log_likelihood_ratio(k1, n1, k2, n2):
+    """Vectorized log-likelihood ratio (G-squared) statistic for each
+    feature, where feature i was found in k1[i] of n1 items in the first
+    collection and k2[i] of n2 items in the second. The sign of each
+    score indicates whether the feature is over (positive) or under
+    (negative) represented in the first collection."""
+    k1 = np.asarray(k1, dtype=float)
+    k2 = np.asarray(k2, dtype=float)
+    observed = np.stack([k1, n1 - k1, k2, n2 - k2])
+    expected = _expected_counts(k1, n1, k2, n2)
+    ratios = np.ones_like(observed)
+    np.divide(observed, expected, out=ratios, where=observed > 0)
+    g2 = 2*(observed * np.log(ratios)).sum(axis=0)
+    return np.sign(k1/max(n1, 1) - k2/max(n2, 1)) * g2
+
+
+def chi_square(k1, n1, k2, n2):
+    """Vectorized Pearson chi-square statistic for each feature, with
+    arguments and sign as for log_likelihood_ratio."""
+    k1 = np.asarray(k1, dtype=float)
+    k2 = np.asarray(k2, dtype=float)
+    observed = np.stack([k1, n1 - k1, k2, n2 - k2])
+    expected = _expected_counts(k1, n1, k2, n2)
+    terms = np.zeros_like(observed)
+    np.divide((observed - expected)**2, expected, out=terms, where=expected > 0)
+    return np.sign(k1/max(n1, 1) - k2/max(n2, 1)) * terms.sum(axis=0)
+
+
+def _expected_counts(k1, n1, k2, n2):
+    """Expected cell counts of the 2x2 contingency tables under
+    independence, in the same order as the observed counts."""
+    total = n1 + n2
+    present = (k1 + k2) / max(total, 1)
+    return np.stack([n1*present, n1*(1 - present), n2*present, n2*(1 - present)])
+
+
+def tf_idf(counts, doc_freqs, docs):
+    """Vectorized tf-idf of each feature, given the feature's counts
+    in the collection of interest and the number of documents out of
+    docs it was found in, in a reference collection."""
+    counts = np.asarray(counts, dtype=float)
+    tf = counts / max(counts.sum(), 1)
+    idf = np.log(docs / (1 + np.asarray(doc_freqs, dtype=float)))
+    return tf * idf
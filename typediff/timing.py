@@ -0,0 +1,134 @@
+import sys
+import json
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+"""Lightweight timing of the stages of processing a request or a
+command line run, such as querying tsdb, parsing with ACE, parsing
+derivations and reconstructing them with the typifier.
+
+Stages are timed by wrapping them in span, which does nothing unless
+a Recorder has been started with recording. The recorder is shared by
+threads started through delphin.map_ordered and the typifier pool, so
+the spans of concurrent stages are all collected. Spans can be written
+out as JSON lines, one object per span, and summarised by stage.
+Counts, such as the number of derivations whose reconstruction was
+shared, are added with count and included in the summary.
+"""
+
+
+RECORDER = contextvars.ContextVar('recorder', default=None)
+
+
+class Recorder:
+    def __init__(self, label):
+        self.label = label
+        self.run = uuid.uuid4().hex[:12]
+        self.start = time.time()
+        self.spans = []
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, start, duration, fields):
+        record = {'span': name, 'start': round(start - self.start, 6),
+                  'duration': round(duration, 6)}
+        record.update(fields)
+        with self.lock:
+            self.spans.append(record)
+
+    def count(self, name, value):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def summary(self):
+        """The number of spans and their total duration for each stage,
+        along with the time elapsed since recording started and any
+        counts."""
+        stages = {}
+        with self.lock:
+            spans = list(self.spans)
+            counts = dict(self.counts)
+
+        for record in spans:
+            stage = stages.setdefault(record['span'], {'count': 0, 'seconds': 0})
+            stage['count'] += 1
+            stage['seconds'] += record['duration']
+
+        for stage in stages.values():
+            stage['seconds'] = round(stage['seconds'], 6)
+
+        summary = {'elapsed': round(time.time() - self.start, 6), 'stages': stages}
+        if counts:
+            summary['counts'] = counts
+        return summary
+
+    def write(self, output):
+        """Write the spans as JSON lines to output, a path or '-' for
+        stderr."""
+        lines = [json.dumps(dict(record, run=self.run, label=self.label))
+                 for record in self.spans]
+        lines.extend(json.dumps({'count': name, 'value': value, 'run': self.run,
+                                 'label': self.label})
+                     for name, value in self.counts.items())
+        if not lines:
+            return
+        text = '\n'.join(lines) + '\n'
+
+        if output == '-':
+            sys.stderr.write(text)
+        else:
+            with open(output, 'a') as f:
+                f.write(text)
+
+
+@contextmanager
+def recording(label, output=None, enabled=True):
+    """Context manager recording the spans within it, yielding the
+    Recorder. On leaving, the spans are written to output if one is
+    given. If neither output nor enabled is set, nothing is recorded
+    and None is yielded."""
+    if output is None and not enabled:
+        yield None
+        return
+
+    recorder = Recorder(label)
+    token = RECORDER.set(recorder)
+    try:
+        yield recorder
+    finally:
+        RECORDER.reset(token)
+        if output is not None:
+            recorder.write(output)
+
+
+@contextmanager
+def span(name, **fields):
+    """Context manager timing the stage name, with any extra fields to
+    be recorded with it."""
+    recorder = RECORDER.get()
+    if recorder is None:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        recorder.add(name, start, time.time() - start, fields)
+
+
+def count(name, value=1):
+    """Add value to the count name, such as the number of derivations
+    whose reconstruction was shared, if recording."""
+    recorder = RECORDER.get()
+    if recorder is not None:
+        recorder.count(name, value)
+
+
+def current():
+    """Return the active Recorder, or None."""
+    return RECORDER.get()
@@ -3,14 +3,23 @@ import os
 import argparse
 import pickle
 import json
+import time
+import datetime
+import tempfile
+import hashlib
+import copy
 
 from subprocess import Popen, PIPE
 from collections import Counter, defaultdict
 
 from .delphin import (TypeStats, tsdb_query, TsdbError, AceError, AceError,
-                      load_hierarchy, JSONEncoder)
-from .config import TYPIFIERBIN
+                      load_hierarchy, JSONEncoder, get_symbols, TYPIFIER_WORKERS,
+                      count_derivations)
+from .config import TYPIFIERBIN, COSTPATH
 from .gram import get_grammar
+from . import timing
+from . import memprofile
+from . import schedule
 
 
 """This script is for working with type statistics from DELPH-IN
@@ -29,6 +38,12 @@ BLACKLIST = set()
 ERG_SPEECH_PROFILES = set(['vm6', 'vm13', 'vm13', 'vm31', 'vm32', 'ecpa',
                            'ecoc', 'ecos', 'ecpr'])
 
+# seconds between checkpoints of the statistics collected while indexing
+CHECKPOINT_INTERVAL = 300
+
+# seconds between reports of the progress of indexing
+PROGRESS_INTERVAL = 10
+
 
 class Usage(Exception):
     def __init__(self, msg):
@@ -38,6 +53,14 @@ class Usage(Exception):
         return "Argument parsing error: {}".format(self.msg)
 
 
+class MergeError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return "Merge error: {}".format(self.msg)
+
+
 def argparser():
     argparser = argparse.ArgumentParser()
     subparsers = argparser.add_subparsers(dest="command")
@@ -47,6 +70,28 @@ def argparser():
     iparser.add_argument("grammar", metavar="GRAMMAR_ALIAS")
     iparser.add_argument("treebank", metavar="NAME_OF_TREEBANK")
     iparser.add_argument("--multi", action='store_true')
+    iparser.add_argument("--timing", metavar="PATH",
+                         help='append the time taken by each stage to PATH as JSON lines')
+    iparser.add_argument("--memprofile", metavar="PATH",
+                         help='write a report of the memory used after each profile to PATH')
+    iparser.add_argument("--resume", action='store_true',
+                         help='continue from the last checkpoint of an interrupted run')
+    iparser.add_argument("--checkpoint-interval", type=int, default=CHECKPOINT_INTERVAL,
+                         metavar="SECONDS",
+                         help='seconds between checkpoints, or 0 to disable them')
+    iparser.add_argument("--shard", type=parse_shard, metavar="K/N",
+                         help='only index the Kth of N shards of the items, writing partial statistics for merge')
+    iparser.add_argument("--postings", action='store_true',
+                         help='with --shard, also collect the items each type occurs in')
+    iparser.add_argument("--workers", type=int, default=TYPIFIER_WORKERS,
+                         help='number of typifier processes to run at once (default: %(default)s)')
+
+    mparser = subparsers.add_parser('merge', help='merge the partial statistics of the shards of a treebank')
+    mparser.add_argument("paths", nargs='+', metavar="PARTIAL")
+    mparser.add_argument("--output", nargs='+', choices=('json', 'txt'), default=[],
+                         metavar="OUTPUT_TYPE", help='also produce json and/or txt output')
+    mparser.add_argument("--postings", action='store_true',
+                         help='also write the items each type occurs in as json')
 
     oparser = subparsers.add_parser('output', help='produce output based on a previously generated index')
     oparser.add_argument("type", choices=('json', 'txt'), metavar="OUTPUT_TYPE")
@@ -54,74 +99,444 @@ def argparser():
     return argparser
 
 
-def index(profiles, treebank, in_grammar):
-    stats_dict = defaultdict(TypeStats)
-    trees = 0
+class Progress:
+    """Reports the number of trees indexed, the rate of indexing and an
+    estimate of the time left, at most every interval seconds. The
+    number of results of profiles not yet queried is estimated from
+    those that have been."""
+
+    def __init__(self, profiles, interval=PROGRESS_INTERVAL):
+        self.profiles = profiles
+        self.interval = interval
+        self.start = self.last = time.time()
+        self.work = 0
+        self.started = 0
+        self.results = 0
+        self.profile = None
+        self.position = 0
+        self.length = 0
+        self.unique = 0
+        self.reused = 0
+
+    def shared(self, unique, reused):
+        """Count the distinct derivations to be reconstructed and the
+        trees which reuse one of them."""
+        self.unique += unique
+        self.reused += reused
+        count_derivations(unique, reused)
+
+    def next_profile(self, profile, length):
+        self.started += 1
+        self.results += length
+        self.profile = profile
+        self.position = 0
+        self.length = length
+
+    def update(self, trees, worked=True):
+        self.position += 1
+        if worked:
+            self.work += 1
+        if time.time() - self.last >= self.interval:
+            self.report(trees)
+
+    def report(self, trees):
+        now = self.last = time.time()
+        rate = self.work / (now - self.start) if now > self.start else 0
+        left = self.length - self.position
+        left += (self.profiles - self.started) * self.results / max(self.started, 1)
+        eta = datetime.timedelta(seconds=int(left / rate)) if rate else '?'
+        print("indexed {} trees ({} {}/{}: {}/{}), {:.1f} trees/s, ETA {}".format(
+            trees, self.profile, self.started, self.profiles, self.position,
+            self.length, rate, eta), flush=True)
+
+
+def index_name(grammar, treebank, shard=None):
+    """The prefix of the files written when indexing treebank with
+    grammar, or one shard of it."""
+    name = '{}--{}'.format(grammar.alias, treebank.replace(' ', '_'))
+    if shard is not None:
+        name += '--shard-{}-of-{}'.format(*shard)
+    return name
+
+
+def parse_shard(value):
+    """Parse a shard given as k/N, the kth of N shards."""
+    try:
+        k, n = (int(x) for x in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected k/N, got {}".format(value))
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError("expected 1 <= k <= N, got {}".format(value))
+    return k, n
+
+
+def in_shard(shard, profile, iid):
+    """Whether the item iid of profile belongs to shard. Items are
+    assigned by the digest of the profile's name and the i-id, so the
+    assignment is the same on every machine."""
+    k, n = shard
+    key = '{}/{}'.format(profile, iid).encode('utf8')
+    return int(hashlib.sha1(key).hexdigest(), 16) % n == k - 1
+
+
+def save_atomic(path, data, dump=pickle.dump, mode='wb'):
+    """Write data to path with dump, replacing any existing file only
+    once it has been written in full."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    suffix='.tmp')
+    with os.fdopen(fd, mode) as f:
+        dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def file_hash(filename, digest=None):
+    digest = hashlib.sha1() if digest is None else digest
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest
+
+
+def profile_hash(path):
+    """A digest of the names and contents of the files of a profile."""
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(path)):
+        filename = os.path.join(path, name)
+        if not os.path.isfile(filename):
+            continue
+        digest.update(name.encode('utf8') + b'\0')
+        file_hash(filename, digest)
+    return digest.hexdigest()
+
+
+def grammar_hash(grammar):
+    """A digest of the compiled grammar, which partial statistics are
+    only valid for."""
+    try:
+        return file_hash(grammar.dat_path).hexdigest()
+    except OSError:
+        return None
+
+
+def load_manifest(directory, grammar):
+    """Load the manifest of the partial statistics in directory, mapping
+    the path of each profile indexed onto its hash, partial statistics
+    file, number of trees and failures, and whether postings were
+    collected. Partial statistics of a different build of the grammar
+    are discarded."""
+    path = os.path.join(directory, 'manifest.json')
+    digest = grammar_hash(grammar)
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest['grammar'] == digest:
+            return manifest
+    return {'grammar': digest, 'profiles': {}}
+
+
+def save_manifest(directory, manifest):
+    save_atomic(os.path.join(directory, 'manifest.json'), manifest,
+                dump=lambda data, f: json.dump(data, f, indent=2), mode='w')
+
+
+def by_name(symbols, by_id):
+    return {symbols.name(i): v for i, v in by_id.items()}
+
+
+def by_id(symbols, by_name, factory):
+    d = defaultdict(factory)
+    for name, v in by_name.items():
+        d[symbols.intern(name)] = v
+    return d
+
+
+class ProfileIndex:
+    """The statistics of the types of the trees of one profile indexed
+    so far, keyed by type id, and, if postings are collected, the i-ids
+    of the trees each type occurs in."""
+
+    def __init__(self, symbols, key, digest, postings=False):
+        self.symbols = symbols
+        self.key = key
+        self.digest = digest
+        self.stats = defaultdict(TypeStats)
+        self.postings = defaultdict(list) if postings else None
+        self.trees = 0
+        self.done = set()
+
+    def add(self, iid, counts):
+        for name, count in counts.items():
+            i = self.symbols.intern(name)
+            self.stats[i].update(count)
+            if self.postings is not None:
+                self.postings[i].append(iid)
+        self.done.add(iid)
+        self.trees += 1
+
+    def partial(self):
+        """The statistics and postings keyed by type name."""
+        return {
+            'stats': by_name(self.symbols, self.stats),
+            'postings': None if self.postings is None else by_name(self.symbols, self.postings),
+        }
+
+    def save(self, path):
+        """Atomically checkpoint the index to path."""
+        state = self.partial()
+        state.update(profile=self.key, hash=self.digest, trees=self.trees, done=self.done)
+        save_atomic(path, state)
+
+    @classmethod
+    def load(cls, path, symbols):
+        """Load an index checkpointed to path."""
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+
+        index = cls(symbols, state['profile'], state['hash'])
+        index.stats = by_id(symbols, state['stats'], TypeStats)
+        if state['postings'] is not None:
+            index.postings = by_id(symbols, state['postings'], list)
+        index.trees = state['trees']
+        index.done = state['done']
+        return index
+
+
+def index_profile(path, grammar, progress, index, base=0, checkpoint=None,
+                  checkpoint_interval=CHECKPOINT_INTERVAL, shard=None,
+                  workers=1):
+    """Add the types of the active trees of the profile at path to index,
+    a ProfileIndex, which may be a checkpoint to continue from. Returns
+    the failures, or None if the profile could not be queried. The index
+    is checkpointed to checkpoint every checkpoint_interval seconds. If
+    shard is given, only the items in the shard are indexed. The trees
+    are reconstructed by workers threads, largest first."""
+    profile = os.path.basename(path)
     failures = []
 
+    def save():
+        if checkpoint_interval:
+            index.save(checkpoint)
 
-    for path in profiles:
-        grammar = in_grammar
-        items_seen = set()
-        print("processing {}".format(path))
-        profile = os.path.basename(path) 
+    try:
+        # for treebanked profiles:
+        out = tsdb_query('select i-id derivation where t-active > 0', path)
+        # for non-treebanked profiles
+        # out = tsdb_query('select i-id derivation where readings > 0', path)
+    except TsdbError as e:
+        with open('tsdb_errors.txt', 'a', encoding='utf8') as f:
+            f.write(str(e) + '\n')
 
-        if profile in ERG_SPEECH_PROFILES:
-            # let's just  ignore them for now
-            continue
-            alias = grammar.alias+'-speech'
-            grammar = get_grammar(alias)
+        sys.stderr.write(str(e)+'\n')
+        return None
 
-        try:
-            # for treebanked profiles:
-            out = tsdb_query('select i-id derivation where t-active > 0', path)
-            # for non-treebanked profiles
-            # out = tsdb_query('select i-id derivation where readings > 0', path)
-        except TsdbError as e:
-            with open('tsdb_errors.txt', 'a', encoding='utf8') as f:
-                f.write(str(e) + '\n')
-
-            sys.stderr.write(str(e)+'\n')
-            continue
+    results = out.strip().split('\n') if out != '' else []
+    progress.next_profile(profile, len(results))
+    pending = []
+
+    for result in results:
+        iid, derivation = result.split(' | ')
 
-        if out == '':
+        if (iid in index.done or iid in BLACKLIST or
+                (shard is not None and not in_shard(shard, profile, iid))):
+            progress.update(base + index.trees, worked=False)
             continue
+        pending.append((iid, derivation))
+    del out, results
+
+    # each distinct derivation is only reconstructed once, and its types
+    # are added for every tree with that derivation
+    derivations = []
+    owners = []
+    uses = Counter()
+    seen = {}
+    for _iid, derivation in pending:
+        if derivation not in seen:
+            seen[derivation] = len(derivations)
+            derivations.append(derivation)
+        owners.append(seen[derivation])
+        uses[seen[derivation]] += 1
+    del seen
+    progress.shared(len(derivations), len(pending) - len(derivations))
+
+    def typify(derivation):
+        assert grammar is not None
+        try:
+            return get_types(derivation, grammar)
+        except AceError as e:
+            return e
+
+    # reconstructions finish in the order they are scheduled in, but are
+    # added to the index in the order of the profile, so that the index
+    # is the same however many workers there are
+    finished = {}
+    position = 0
+    last_save = time.time()
+
+    try:
+        for d, counts in schedule.run_scheduled(typify, derivations, workers):
+            # only the counts of a tree are kept once it is reconstructed
+            finished[d] = counts
+            derivations[d] = None
+
+            while position < len(pending) and owners[position] in finished:
+                iid, _derivation = pending[position]
+                pending[position] = None
+                d = owners[position]
+                counts = finished[d]
+                uses[d] -= 1
+                if not uses[d]:
+                    del finished[d]
+                position += 1
+
+                if iid in index.done:
+                    # another active tree of the same item was added
+                    progress.update(base + index.trees, worked=False)
+                    continue
+                elif isinstance(counts, AceError):
+                    error = copy.copy(counts)
+                    error.other_data = [iid, path]
+                    failures.append(error)
+                    with open('ace_errors.txt', 'a', encoding='utf8') as f:
+                        f.write(str(error) + '\n')
+                    sys.stderr.write(str(error) + '\n')
+                else:
+                    index.add(iid, counts)
+
+                progress.update(base + index.trees)
+                if checkpoint_interval and time.time() - last_save >= checkpoint_interval:
+                    save()
+                    last_save = time.time()
+    except KeyboardInterrupt:
+        save()
+        print("interrupted, run with --resume to continue from {}".format(checkpoint))
+        raise
+
+    progress.report(base + index.trees)
+    return failures
+
+
+def index(profiles, treebank, in_grammar, resume=False,
+          checkpoint_interval=CHECKPOINT_INTERVAL, shard=None, postings=False,
+          workers=1):
+    """Index the types of the active trees of profiles. The statistics
+    of each profile are saved to a partials directory along with a
+    manifest of the hashes of the profiles' contents, so that only
+    profiles which are new or have changed since the last run are
+    indexed again before the statistics of all profiles are merged.
+    The statistics of the profile being indexed are checkpointed every
+    checkpoint_interval seconds, unless it is 0. If resume is True,
+    indexing continues from the last checkpoint.
+
+    If shard, a (k, N) pair, is given, only the items in the kth of N
+    shards are indexed, and the statistics are written to a partial
+    file to be combined with those of the other shards by merge. If
+    postings is True, the i-ids of the trees each type occurs in are
+    also collected. The trees of each profile are reconstructed by
+    workers threads, scheduled by their estimated cost."""
+    symbols = get_symbols(in_grammar)
+    name = index_name(in_grammar, treebank, shard)
+    directory = name + '.partials'
+    checkpoint = name + '.checkpoint'
+    os.makedirs(directory, exist_ok=True)
+    manifest = load_manifest(directory, in_grammar)
+
+    state = None
+    if resume and os.path.exists(checkpoint):
+        state = ProfileIndex.load(checkpoint, symbols)
+        print("resuming from {} with {} trees".format(checkpoint, state.trees))
+
+    def is_stale(path, digest):
+        entry = manifest['profiles'].get(os.path.abspath(path))
+        return (entry is None or entry['hash'] != digest or
+                (postings and not entry['postings']))
+
+    # let's just ignore the speech profiles for now
+    profiles = [p for p in profiles if os.path.basename(p) not in ERG_SPEECH_PROFILES]
+    digests = [profile_hash(path) for path in profiles]
+    stale = set(path for path, digest in zip(profiles, digests) if is_stale(path, digest))
+    print("{} of {} profiles to index".format(len(stale), len(profiles)))
+
+    progress = Progress(len(stale))
+    stats_dict = defaultdict(TypeStats)
+    postings_dict = defaultdict(list) if postings else None
+    trees = 0
+    failures = []
+    # failures recorded for the profiles which are not indexed again
+    reused_failures = 0
 
-        results = out.strip().split('\n')
-        for result in results:
-            iid, derivation = result.split(' | ')
+    for path, digest in zip(profiles, digests):
+        key = os.path.abspath(path)
+        profile = os.path.basename(path)
 
-            if iid in items_seen or iid in BLACKLIST:
-                continue
-                
-            try:
-                assert grammar is not None
-                counts = get_types(derivation, grammar)
-                for name, count in counts.items():
-                    stats_dict[name].update(count)
-            except AceError as e:
-                e.other_data.append(iid)
-                e.other_data.append(path)
-                failures.append(e)
-                with open('ace_errors.txt', 'a', encoding='utf8') as f:
-                    f.write(str(e) + '\n')
-                sys.stderr.write(str(e) + '\n')
+        if path in stale:
+            print("processing {}".format(path))
+            if state is not None and (state.key, state.digest) == (key, digest):
+                profile_index = state
             else:
-                items_seen.add(iid)
-                trees += 1
-                print(trees, iid)
-
-    print("Processed {} trees".format(trees))
-
-    treebank_str = treebank.replace(' ', '_')
-    filename = '{}--{}--{}.pickle'.format(grammar.alias, treebank_str, trees)
+                profile_index = ProfileIndex(symbols, key, digest, postings=postings)
+            profile_failures = index_profile(
+                path, in_grammar, progress, profile_index, base=trees,
+                checkpoint=checkpoint, checkpoint_interval=checkpoint_interval,
+                shard=shard, workers=workers)
+            if profile_failures is None:
+                continue
 
-    with open(filename, 'wb') as f:
-        pickle.dump(stats_dict, f)
+            filename = '{}-{}.pickle'.format(
+                profile, hashlib.sha1(key.encode('utf8')).hexdigest()[:8])
+            save_atomic(os.path.join(directory, filename), profile_index.partial())
+            manifest['profiles'][key] = {
+                'hash': digest,
+                'file': filename,
+                'trees': profile_index.trees,
+                'failures': len(profile_failures),
+                'postings': profile_index.postings is not None,
+            }
+            save_manifest(directory, manifest)
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+            failures.extend(profile_failures)
+            memprofile.stage(profile)
+
+        entry = manifest['profiles'][key]
+        if path not in stale:
+            reused_failures += entry['failures']
+        with open(os.path.join(directory, entry['file']), 'rb') as f:
+            partial = pickle.load(f)
+        for type_name, t in partial['stats'].items():
+            merged = stats_dict[symbols.intern(type_name)]
+            merged.items += t.items
+            merged.counts += t.counts
+        if postings:
+            for type_name, iids in partial['postings'].items():
+                postings_dict[symbols.intern(type_name)].extend((profile, iid) for iid in iids)
+        trees += entry['trees']
 
-    num_failures = len(failures)
+    print("Processed {} trees".format(trees))
+    if progress.unique:
+        print("Reconstructed {} distinct derivations, reused for {} more trees".format(
+            progress.unique, progress.reused))
+
+    if shard is None:
+        filename = '{}--{}.pickle'.format(name, trees)
+        with open(filename, 'wb') as f:
+            pickle.dump(by_name(symbols, stats_dict), f)
+    else:
+        filename = name + '.pickle'
+        save_atomic(filename, {
+            'grammar': in_grammar.alias,
+            'treebank': treebank,
+            'shard': shard,
+            'trees': trees,
+            'stats': by_name(symbols, stats_dict),
+            'postings': by_name(symbols, postings_dict) if postings else None,
+        })
+        print("Wrote {}".format(filename))
+
+    num_failures = len(failures) + reused_failures
     if num_failures > 0: 
         print("Failed to reconstruct {} trees".format(num_failures))
+
+    if failures:
         print("See type-stats-errors.txt for details.")
 
         with open('type-stats-errors.txt', 'w', encoding='utf8') as f:
@@ -129,12 +544,80 @@ def index(profiles, treebank, in_grammar):
             f.write(errors_str)
 
 
+def merge(paths, output_types=(), postings=False):
+    """Combine the partial statistics written by index for each shard of
+    a treebank into the statistics of the whole treebank, written as by
+    an unsharded index, and then output in each of output_types. If
+    postings is True, the postings collected by the shards are also
+    written, as JSON mapping each type onto the [profile, i-id] pairs of
+    the trees it occurs in."""
+    partials = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            partials.append(pickle.load(f))
+
+    if not partials:
+        raise MergeError("no partial statistics to merge")
+
+    first = partials[0]
+    shards = set()
+    for path, partial in zip(paths, partials):
+        for field in ('grammar', 'treebank'):
+            if partial[field] != first[field]:
+                raise MergeError("{} is of {} {}, not {}".format(
+                    path, field, partial[field], first[field]))
+        k, n = partial['shard']
+        if n != first['shard'][1]:
+            raise MergeError("{} is one of {} shards, not {}".format(path, n, first['shard'][1]))
+        if k in shards:
+            raise MergeError("shard {}/{} is given more than once".format(k, n))
+        if postings and partial['postings'] is None:
+            raise MergeError("{} was indexed without --postings".format(path))
+        shards.add(k)
+
+    n = first['shard'][1]
+    missing = sorted(set(range(1, n + 1)) - shards)
+    if missing:
+        sys.stderr.write("Warning: merging without shards {} of {}\n".format(
+            ', '.join(str(k) for k in missing), n))
+
+    stats = {}
+    postings_dict = {}
+    trees = 0
+    for partial in partials:
+        for type_name, t in partial['stats'].items():
+            merged = stats.setdefault(type_name, TypeStats())
+            merged.items += t.items
+            merged.counts += t.counts
+        if postings:
+            for type_name, pairs in partial['postings'].items():
+                postings_dict.setdefault(type_name, []).extend(pairs)
+        trees += partial['trees']
+
+    treebank_str = first['treebank'].replace(' ', '_')
+    filename = '{}--{}--{}.pickle'.format(first['grammar'], treebank_str, trees)
+    with open(filename, 'wb') as f:
+        pickle.dump(stats, f)
+    print("Merged {} shards of {} trees into {}".format(len(partials), trees, filename))
+
+    if postings:
+        postings_filename = '{}--{}--{}--postings.json'.format(
+            first['grammar'], treebank_str, trees)
+        with open(postings_filename, 'w') as f:
+            json.dump({type_name: sorted(pairs, key=lambda p: (p[0], int(p[1])))
+                       for type_name, pairs in postings_dict.items()}, f)
+
+    for output_type in output_types:
+        output(filename, output_type)
+
+
 def get_types(derivation_string, grammar):
     env = dict(os.environ)
     env['LC_ALL'] = 'en_US.UTF-8'
     args = [TYPIFIERBIN, grammar.dat_path]
-    process= Popen(args, stdout=PIPE, stdin=PIPE, stderr=PIPE, env=env)
-    out, err = process.communicate(input=derivation_string.encode('utf8'))
+    with timing.span('typifier'):
+        process= Popen(args, stdout=PIPE, stdin=PIPE, stderr=PIPE, env=env)
+        out, err = process.communicate(input=derivation_string.encode('utf8'))
     out = out.decode('utf8')
     err = err.decode('utf8')
 
@@ -159,7 +642,7 @@ def output(pickle_path, output_type):
     metadata = {'grammar' : grammar_name, 'treebank' : treebank, 'trees' : trees}
 
     grammar = get_grammar(grammar_name)
-    hierarchy = load_hierarchy(grammar.types_path)
+    hierarchy = load_hierarchy(grammar.types_path, symbols=get_symbols(grammar))
     signs = [x.name for x in hierarchy['sign'].descendants() 
              if not x.name.startswith('glb')]
  
@@ -187,7 +670,7 @@ def txt_output(types, type_stats, metadata, kind):
     lines = []
 
     key_func = lambda x:0 if x not in type_stats else type_stats[x].items
-    types.sort(reverse=True, key=key_func)
+    types = sorted(types, reverse=True, key=key_func)
                 
     for name in types:
         try:
@@ -211,10 +694,14 @@ def txt_output(types, type_stats, metadata, kind):
                     
 
 def main():
-    arg = argparser().parse_args()
+    parser = argparser()
+    arg = parser.parse_args()
     profiles = []
 
     if arg.command == 'index':
+        if arg.postings and arg.shard is None:
+            parser.error("--postings requires --shard")
+
         if arg.multi:
             for name in os.listdir(arg.profile):
                 path = os.path.join(arg.profile, name)
@@ -231,7 +718,18 @@ def main():
                 profiles.append(arg.profile)
 
         grammar = get_grammar(arg.grammar)
-        index(profiles, arg.treebank, grammar)
+        schedule.configure(COSTPATH)
+        with timing.recording('type-stats', output=arg.timing, enabled=False), \
+             memprofile.profiling('type-stats', output=arg.memprofile):
+            index(profiles, arg.treebank, grammar, resume=arg.resume,
+                  checkpoint_interval=arg.checkpoint_interval,
+                  shard=arg.shard, postings=arg.postings, workers=arg.workers)
+
+    elif arg.command == 'merge':
+        try:
+            merge(arg.paths, output_types=arg.output, postings=arg.postings)
+        except MergeError as e:
+            sys.exit(str(e))
 
     elif arg.command == 'output':
         output(arg.path, arg.type)
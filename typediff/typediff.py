@@ -5,10 +5,18 @@ import json
 import pickle
 import functools
 from itertools import chain
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
 
 from . import delphin
 from . import config
 from . import gram
+from . import timing
+from . import memprofile
+from .stats import log_likelihood_ratio, chi_square, tf_idf
+from .bitsets import diff_bitsets
 
 
 """typediff.py
@@ -54,6 +62,36 @@ The remainder of the options are only relevant to the command line mode:
 --raw
   Don't sort and colorize the list of types.
 
+--rank STATISTIC
+  Rank the resulting types by an association statistic, one of llr
+  (log-likelihood ratio), chi2 (chi-square) or tfidf (tf-idf against
+  the treebank statistics supplied with --tbstats). When ranking, a
+  type counts as a positive type if it is present in at least
+  --min-pos positive items and as a negative type if it is present in
+  more than --max-neg negative items.
+
+--min-pos K
+  Minimum number of positive items a type must be found in. Default 1.
+
+--max-neg M
+  Maximum number of negative items a type can be found in before it
+  is considered a negative type. Default 0.
+
+--tbstats PATH
+  Path to a pickle or json file of treebank type statistics, as
+  produced by type-stats. Required for tfidf ranking.
+
+--timing PATH
+  Append the time taken by each stage of processing (ACE, typifier,
+  derivation parsing, diffing etc) to PATH as JSON lines. Use - for
+  standard error.
+
+--memprofile PATH
+  Trace memory allocations and write a report of the memory used after
+  processing the positive and negative items to PATH, including the top
+  allocation sites, the memory held by readings, trees, tokens and
+  counters, and the peak RSS. Use - for standard error.
+
 """
 
 
@@ -62,6 +100,9 @@ The remainder of the options are only relevant to the command line mode:
 # update various config files to reflect LOGONROOT variable 
 
 
+RANK_STATISTICS = ('llr', 'chi2', 'tfidf')
+
+
 def argparser():
     argparser = argparse.ArgumentParser()
     argparser.add_argument("grammar", metavar="GRAMMAR NAME")
@@ -72,6 +113,12 @@ def argparser():
     argparser.add_argument("--supers", action='store_true')
     argparser.add_argument("--profiles", action='store_true')
     argparser.add_argument("--raw", action='store_true')
+    argparser.add_argument("--rank", choices=RANK_STATISTICS)
+    argparser.add_argument("--min-pos", type=int, default=1)
+    argparser.add_argument("--max-neg", type=int, default=0)
+    argparser.add_argument("--tbstats")
+    argparser.add_argument("--timing", metavar="PATH")
+    argparser.add_argument("--memprofile", metavar="PATH")
     group = argparser.add_mutually_exclusive_group(required=False)
     group.add_argument("-i", action='store_true')
     group.add_argument("-d", action='store_true')
@@ -119,19 +166,17 @@ def pretty_print_types(types, hierarchy):
         return 1000
 
     types.sort(key=keyfunc)
-    output = []
-
-    for t in types:
-        for ds, col in kinds:
-            if t.lstrip('^') in ds:
-                output.append(str(ColorText(t, col)))
-                break
-        else:
-            output.append(t)
-    
+    output = [colorize_type(t, kinds) for t in types]
     return '\n'.join(output)
 
 
+def colorize_type(t, kinds):
+    for ds, col in kinds:
+        if t.lstrip('^') in ds:
+            return str(ColorText(t, col))
+    return t
+
+
 def compare_types(pos_types, neg_types, arg):
     if arg.d:
         types = pos_types - neg_types
@@ -144,8 +189,10 @@ def compare_types(pos_types, neg_types, arg):
 
 
 @functools.lru_cache(maxsize=32)
+@timing.span('hierarchy')
 def get_hierarchy(grammar):
-    return delphin.load_hierarchy(grammar.types_path)
+    return delphin.load_hierarchy(grammar.types_path,
+                                  symbols=delphin.get_symbols(grammar))
 
 
 @functools.lru_cache(maxsize=32)
@@ -160,63 +207,219 @@ def load_descendants(grammar):
     return descendants
 
 
+def item_type_counts(item, all_readings=False):
+    """Return a Counter of the type ids used by an item's best reading, or
+    by all of its readings if all_readings is True."""
+    readings = item.readings if all_readings else item.readings[:1]
+    counts = Counter()
+
+    for reading in readings:
+        counts.update(dict(zip(reading.type_ids, reading.type_counts)))
+    return counts
+
+
+def item_type_matrix(item_counts, columns):
+    """Build a sparse items x types count matrix from the type id counts
+    of each item, as returned by item_type_counts, where columns maps
+    the type ids onto their columns."""
+    rows, cols, vals = [], [], []
+
+    for row, counts in enumerate(item_counts):
+        for i, count in counts.items():
+            rows.append(row)
+            cols.append(columns[i])
+            vals.append(count)
+
+    shape = (len(item_counts), len(columns))
+    return sparse.csr_matrix((vals, (rows, cols)), shape=shape)
+
+
+def load_treebank_stats(path, trees=None):
+    """Load treebank type statistics from a pickle or json file produced
+    by type-stats, returning a dictionary mapping type names onto the
+    number of trees they were found in, as well as the number of trees
+    in the treebank. If trees is not given, it is taken from the
+    filename, which is expected to be of the form
+    GRAMMAR--TREEBANK--TREES."""
+    if path.endswith('.json'):
+        with open(path) as f:
+            stats = {name: t['items'] for name, t in json.load(f).items()}
+    else:
+        with open(path, 'rb') as f:
+            stats = {name: t.items for name, t in pickle.load(f).items()}
+
+    if trees is None:
+        root = os.path.splitext(os.path.basename(path))[0]
+        trees = int(root.split('--')[2])
+
+    return stats, trees
+
+
+@timing.span('rank')
+def rank_types(pos_items, neg_items, opts):
+    """Rank the types of the positive and negative items by an
+    association statistic. Types are selected by applying the
+    difference, intersection or union operation to the sets of positive
+    types (found in at least opts.min_pos positive items) and negative
+    types (found in more than opts.max_neg negative items). Returns a
+    list of (type, score, positive items, negative items) tuples,
+    sorted by decreasing score."""
+    all_readings = bool(opts.all)
+    pos_counts = [item_type_counts(x, all_readings) for x in pos_items]
+    neg_counts = [item_type_counts(x, all_readings) for x in neg_items]
+
+    # the matrices only have columns for the types used by the items, as
+    # the symbol table holds every type this process has seen
+    ids = sorted(set(chain.from_iterable(pos_counts + neg_counts)))
+    symbols = delphin.get_symbols(opts.grammar).names
+    names = [symbols[i] for i in ids]
+    columns = {i: col for col, i in enumerate(ids)}
+    pos_matrix = item_type_matrix(pos_counts, columns)
+    neg_matrix = item_type_matrix(neg_counts, columns)
+
+    # the number of items each type was found in
+    pos_freqs = np.asarray((pos_matrix > 0).sum(axis=0)).ravel()
+    neg_freqs = np.asarray((neg_matrix > 0).sum(axis=0)).ravel()
+    min_pos = 1 if opts.min_pos is None else opts.min_pos
+    max_neg = 0 if opts.max_neg is None else opts.max_neg
+
+    if opts.rank == 'llr':
+        scores = log_likelihood_ratio(pos_freqs, len(pos_items),
+                                      neg_freqs, len(neg_items))
+    elif opts.rank == 'chi2':
+        scores = chi_square(pos_freqs, len(pos_items),
+                            neg_freqs, len(neg_items))
+    elif opts.rank == 'tfidf':
+        stats, trees = opts.tbstats
+        doc_freqs = np.array([stats.get(name, 0) for name in names])
+        counts = np.asarray(pos_matrix.sum(axis=0)).ravel()
+        scores = tf_idf(counts, doc_freqs, trees)
+    else:
+        raise ValueError("Unknown ranking statistic: {}".format(opts.rank))
+
+    present = pos_freqs + neg_freqs > 0
+    pos_types = set(np.flatnonzero(present & (pos_freqs >= min_pos)))
+    neg_types = set(np.flatnonzero(present & (neg_freqs > max_neg)))
+
+    if len(neg_items) == 0:
+        selected = pos_types
+    elif len(pos_items) == 0:
+        selected = neg_types
+    else:
+        selected = compare_types(pos_types, neg_types, opts)
+
+    ranked = sorted(selected, key=lambda i:scores[i], reverse=True)
+    return [(names[i], float(scores[i]), int(pos_freqs[i]), int(neg_freqs[i]))
+            for i in ranked]
+
+
 def type_data():
     return {t:{'rank':i+1, 'col':rgba}
             for i, (t, rgba, _col) in enumerate(config.TYPES)}
 
 
-def typediff_web(pos_items, neg_items, opts):
-    data = {
-        'pos-items' : pos_items,
-        'neg-items' : neg_items,
+def web_metadata(opts):
+    """The data describing a web typediff that does not depend on the
+    items being compared."""
+    return {
         'descendants' : load_descendants(opts.grammar) if opts.desc else False,
         'typeData': type_data(),
         'grammar': opts.grammar.alias,
         'treebank': opts.treebank,
     }
 
+
+def typediff_web(pos_items, neg_items, opts):
     if opts.supers:
         hierarchy = get_hierarchy(opts.grammar)
         for item in chain(pos_items, neg_items):
             item.load_supers(hierarchy)
+
+    fields = opts.fields or 'web'
+    data = {
+        'pos-items' : [delphin.item_dict(x, fields) for x in pos_items],
+        'neg-items' : [delphin.item_dict(x, fields) for x in neg_items],
+    }
+    data.update(web_metadata(opts))
+
+    if opts.rank:
+        data['ranking'] = ranking_data(pos_items, neg_items, opts)
                 
     return data
 
 
+def ranking_data(pos_items, neg_items, opts):
+    return [{'type': name, 'score': score, 'pos': pos, 'neg': neg}
+            for name, score, pos, neg in rank_types(pos_items, neg_items, opts)]
+
+
+def typediff_compact(pos_items, neg_items, opts):
+    """Perform the type diff server-side, returning only the names of
+    the resulting types and their per-type item counts rather than the
+    items themselves. Type ids are not returned, as they are only
+    meaningful within the process that assigned them."""
+    bitsets, ids, pos_counts, neg_counts = diff_bitsets(pos_items, neg_items, opts)
+    return {
+        'typeNames': bitsets.names(ids),
+        'posCounts': pos_counts.tolist(),
+        'negCounts': neg_counts.tolist(),
+        'posItems': len(pos_items),
+        'negItems': len(neg_items),
+        'typeData': type_data(),
+        'grammar': opts.grammar.alias,
+        'treebank': opts.treebank,
+    }
+
+
 def typediff(pos_items, neg_items, opts):
     """pos_items and neg_items are lists of either Fragment or Reading objects"""
     # currently assuming that the Reading objects are only coming from gold
     # profiles, therefore only one per item. otherwise we'd need to be using s
     # list of Reading objects or probably could be defining an ProfileItem
     # class that emulates the relevant interface to Fragment
-    tfunc = lambda x:x.types.keys() if opts.all else x.best.types.keys()
-    pos_types = set(chain.from_iterable(tfunc(x) for x in pos_items))
-    neg_types = set(chain.from_iterable(tfunc(x) for x in neg_items))
+    if opts.rank:
+        return ranked_output(rank_types(pos_items, neg_items, opts), opts)
+
+    bitsets, ids, _pos_counts, _neg_counts = diff_bitsets(pos_items, neg_items, opts)
+    typelist = bitsets.names(ids)
 
-    if len(pos_types) + len(neg_types) > 1:
-        typelist = list(compare_types(pos_types, neg_types, opts))
-    else:
-        typelist = list(max(pos_types, neg_types))
-        
     if opts.raw:
         return '\n'.join(typelist)
 
-    hierarchy = delphin.load_hierarchy(opts.grammar.types_path)    
+    hierarchy = get_hierarchy(opts.grammar)
         
     if opts.supers:
-        for group in (pos, neg):
+        for group in (pos_items, neg_items):
             for item in group:
                 item.load_supers(hierarchy)     
     
-        sfunc = lambda x:x.supers
-        pos_supers = set(chain.from_iterable(sfunc(x) for x in pos))
-        neg_supers = set(chain.from_iterable(sfunc(x) for x in neg))
+        sfunc = lambda x:x.best.supers
+        pos_supers = set(chain.from_iterable(sfunc(x) for x in pos_items))
+        neg_supers = set(chain.from_iterable(sfunc(x) for x in neg_items))
         supers = compare_types(pos_supers, neg_supers, opts)
         typelist.extend('^'+t for t in supers)
 
     return pretty_print_types(typelist, hierarchy)
 
 
+def ranked_output(ranking, opts):
+    """Format the output of rank_types for the terminal."""
+    if opts.raw:
+        return '\n'.join(name for name, _score, _pos, _neg in ranking)
+
+    hierarchy = get_hierarchy(opts.grammar)
+    kinds = [(set(t.name for t in hierarchy[s].descendants()), col)
+             for s, _rgba, col in config.TYPES if s != 'other']
+    lines = []
+
+    for name, score, pos, neg in ranking:
+        line = "{:12.4f}{:>8}{:>8}    {}".format(score, pos, neg,
+                                               colorize_type(name, kinds))
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+
 def process_sentences(inputs, opts):
     def process(sentence):
         return delphin.Fragment(
@@ -224,19 +427,34 @@ def process_sentences(inputs, opts):
             opts.grammar,
             fragments=opts.fragments, 
             count=opts.count,
-            tnt=opts.get('tnt', False), 
+            tnt=getattr(opts, 'tnt', False),
             dat_path=opts.grammar.dat_path,  
             ace_path=config.ACEBIN,
             typifier=config.TYPIFIERBIN,
             logpath=config.LOGPATH
         )
 
-    return [process(i) for i in inputs]
+    # repeated sentences and readings share the reconstruction of
+    # identical derivations
+    with delphin.sharing_typifier():
+        return list(delphin.map_ordered(process, inputs))
+
+
+def parse_profile_query(query):
+    """Split a string of the form PROFILE_PATH:opt_tsql_query into the
+    profile path and the tsql condition, which may be None."""
+    sep = ':'
+    if query.find(sep) >= 0:
+        path, condition = query.split(sep)
+        condition = None if condition == '' else condition
+    else:
+        path = query
+        condition = None
+    return path, condition
 
 
 def process_profiles(queries, opts):
     # assume queries is a string of the form: PROFILE_PATH:opt_tsql_query
-    sep = ':'
     items = []
 
     # support both list of queries and single query
@@ -244,18 +462,31 @@ def process_profiles(queries, opts):
         queries = [queries]
         
     for query in queries:
-        if query.find(sep) >= 0:
-            path, condition = query.split(':')
-            condition = None if condition == '' else condition
-        else:
-            path = query
-            condition = None
+        path, condition = parse_profile_query(query)
         items.extend(process_gold_profile(
             path,
             condition=condition,
             grammar=opts.grammar,
         ))
     return items
+
+
+def iter_profiles(queries, opts):
+    """Like process_profiles, but yields each item as soon as it has
+    been processed."""
+    if isinstance(queries, str):
+        queries = [queries]
+
+    for query in queries:
+        path, condition = parse_profile_query(query)
+        yield from delphin.iter_profile_results(
+            [path],
+            gold=True,
+            grammar=opts.grammar,
+            condition=condition,
+            typifier=config.TYPIFIERBIN,
+            stats_only=bool(getattr(opts, 'stats_only', False))
+        )
     
 
 def process_gold_profile(path, condition=None, grammar=None):
@@ -275,6 +506,12 @@ def main():
     if '@' in arg.sentences and not (arg.u or arg.i or arg.d):
         arg.d = True
 
+    if arg.rank == 'tfidf':
+        if arg.tbstats is None:
+            sys.stderr.write("tfidf ranking requires the --tbstats option.\n")
+            return 1
+        arg.tbstats = load_treebank_stats(arg.tbstats)
+
     pos, neg = [], []
 
     # assign the inputs into pos and neg lists accordingly 
@@ -286,9 +523,14 @@ def main():
             stype.append(s)
 
     process_func = process_profiles if arg.profiles else process_sentences
-    pos_items = process_func(pos, arg)
-    neg_items = process_func(neg, arg)
-    result = typediff(pos_items, neg_items, arg)
+
+    with timing.recording('typediff', output=arg.timing, enabled=False), \
+         memprofile.profiling('typediff', output=arg.memprofile):
+        pos_items = process_func(pos, arg)
+        memprofile.stage('positive items')
+        neg_items = process_func(neg, arg)
+        memprofile.stage('negative items')
+        result = typediff(pos_items, neg_items, arg)
     print(result)
 
 
@@ -382,8 +382,15 @@ function processItems(callback) {
         'tagger': $("input[name=tagger]:checked").val(),
         'fragments': $('input[name=fragments]').prop('checked')
     };  
+
+    // trees and MRSs are fetched from /item-detail when an item is expanded
+    var detail = _.omit(data, 'pos-items', 'neg-items');
+    data.fields = 'types-only';
+
     var posting = $.post('/parse-types', data);
-    posting.done(processPostData, function(data){
+    posting.done(function(data){
+        processPostData(data, {pos: detail, neg: detail});
+    }, function(data){
         if (data.success && callback)
             callback();
     });
@@ -412,12 +419,15 @@ function processProfiles(savedProfiles) {
         'neg-profile': negProfile,
         'pos-profile-filter': posFilter, 
         'neg-profile-filter': negFilter,
-        'load-descendants': !Boolean(DESCENDANTS[grammar]) 
+        'load-descendants': !Boolean(DESCENDANTS[grammar]),
+        'fields': 'types-only'
+    };
+    var details = {
+        pos: {'profile': posProfile, 'profile-filter': posFilter},
+        neg: {'profile': negProfile, 'profile-filter': negFilter}
     };
 
-    var posting = $.post('/process-profiles', data);
-
-    posting.done(function(data){
+    var onHeader = function(data){
 
         if (posProfile)
             POSPROFILES.push(`${posProfile}:${posFilter}`);
@@ -428,20 +438,75 @@ function processProfiles(savedProfiles) {
             $('#grammar-input').val(data.grammar);
             $('#treebank-input').val(data.treebank);
         }
-            
-    }, processPostData);
+    };
+
+    if (window.fetch && window.TextDecoder && window.ReadableStream) {
+        streamProfiles(data, details, onHeader);
+    } else {
+        var posting = $.post('/process-profiles', data);
+        posting.done(onHeader, function(data){
+            processPostData(data, details);
+        });
+    }
+}
+
+
+function streamProfiles(data, details, onHeader) {
+    // Fetches items from /process-profiles-stream, which returns one JSON
+    // record per line, rendering each item as soon as it arrives.
+    var decoder = new TextDecoder();
+    var buffer = '';
+
+    var handleRecord = function(record) {
+        if (record.record == 'header') {
+            if (record.descendants) DESCENDANTS[record.grammar] = record.descendants;
+            TYPEDATA = record.typeData;
+            onHeader(record);
+        } else if (record.record == 'item') {
+            processItemResults([record.item], record.polarity, details[record.polarity]);
+        } else if (record.success) {
+            $('#pos-input, #neg-input').val('');
+            setOperator();
+            // applyFilters calls doDiff even when there are no filters();
+            applyFilters();
+        } else {
+            $('#fail-box').html(record.error.replace(/\n/g, '<br/>'));
+            showStatusBox('#fail-box');
+            updateButtons();
+        }
+    };
+
+    var readChunk = function(reader) {
+        return reader.read().then(function(result) {
+            buffer += decoder.decode(result.value || new Uint8Array(), {stream: !result.done});
+            var lines = buffer.split('\n');
+            buffer = lines.pop();
+
+            for (var i = 0; i < lines.length; i++) {
+                if (lines[i].trim()) handleRecord(JSON.parse(lines[i]));
+            }
+
+            if (!result.done) return readChunk(reader);
+        });
+    };
+
+    fetch('/process-profiles-stream', {method: 'POST', body: new URLSearchParams(data)})
+        .then(function(response) { return readChunk(response.body.getReader()); })
+        .catch(function(error) {
+            handleRecord({record: 'summary', success: false, error: String(error)});
+        });
 }
 
 
-function processPostData(data) {
+function processPostData(data, details) {
     // handles results of both /parse-types and /process-profiles
 
     if (data.success) {
         if (data.descendants) DESCENDANTS[data.grammar] = data.descendants;
         
         TYPEDATA = data.typeData;
-        processItemResults(data['pos-items'], 'pos');
-        processItemResults(data['neg-items'], 'neg');
+        processItemResults(data['pos-items'], 'pos', details.pos);
+        processItemResults(data['neg-items'], 'neg', details.neg);
         $('#pos-input, #neg-input').val('');
         //$('#pos-profile-input, #neg-profile-input').val(null);
         //$('#pos-profile-filter, #neg-profile-filter').val('');
@@ -469,7 +534,9 @@ function setOperator(){
 }
 
 
-function processItemResults(newItems, type) {
+function processItemResults(newItems, type, detail) {
+    // detail is the part of the /item-detail request which is common to
+    // the new items, to which the input or i-id of each is added
     var template = $("#item-template").html();
     var items = getItems(type);
 
@@ -480,6 +547,13 @@ function processItemResults(newItems, type) {
             $item.addClass('profile');
         var readings = item.readings.length;
         var counter = incrCounter(type);
+
+        item.detail = $.extend({}, detail);
+        if (item.type == "profile")
+            item.detail['i-id'] = readings ? item.readings[0].iid : '';
+        else
+            item.detail['input'] = item.input;
+
         var id = type+'-item-'+counter;
         var $itemSection = $(['#',type,'-items'].join(''));
 
@@ -990,6 +1064,42 @@ function doDiff() {
 }
 
 
+function loadDetail($item) {
+    // Fetch the trees and MRSs of the readings of an item, which are left
+    // out of the lists of items, returning a promise which is resolved
+    // once they have been added to the item.
+    var item = getItem($item);
+
+    if (!item.readings.length || item.readings[0].tree !== undefined)
+        return $.Deferred().resolve().promise();
+
+    if (!$item.data('detail')) {
+        var data = $.extend({'fields': 'web'}, item.detail);
+        var posting = $.post('/item-detail', data).then(function(data) {
+            if (!data.success)
+                return $.Deferred().reject(data.error).promise();
+
+            for (var i=0; i < item.readings.length; i++) {
+                item.readings[i].tree = data.item.readings[i].tree;
+                item.readings[i].mrs = data.item.readings[i].mrs;
+            }
+        }, function(xhr) {
+            var error = (xhr.responseJSON && xhr.responseJSON.error) || xhr.statusText;
+            return $.Deferred().reject(error).promise();
+        });
+
+        posting.fail(function(error) {
+            $item.removeData('detail');
+            $('#fail-box').html(String(error).replace(/\n/g, '<br/>'));
+            showStatusBox('#fail-box');
+        });
+        $item.data('detail', posting);
+    }
+
+    return $item.data('detail');
+}
+
+
 function drawTrees($item) {
     var item = getItem($item);
 
@@ -1082,6 +1192,11 @@ function highlightSpans(type) {
         // span highlighting is based on the first active derivation.
         $derivation = $item.find('.derivation.active').first();
         var derivation = getDerivation($derivation);
+
+        // only items that have been expanded have their trees
+        if (!derivation.tree)
+            return;
+
         var trees = findTree(type, derivation.tree);
 
         // We only want to highlight the highest node of this type
@@ -1676,15 +1791,17 @@ function setItemHandlers($item) {
         else
             $treeBox.show();
 
-        // if we've already drawn the trees, return
-        if ($item.find('.svg-node').length != 0)
-            return;
+        loadDetail($item).done(function() {
+            // if we've already drawn the trees, return
+            if ($item.find('.svg-node').length != 0)
+                return;
 
-        drawTrees($item);
-        setTreeHandlers($item);
+            drawTrees($item);
+            setTreeHandlers($item);
 
-        // in case some of the types are already active
-        applyActiveHighlights('locked');
+            // in case some of the types are already active
+            applyActiveHighlights('locked');
+        });
     });
 
     $item.find('.actions .del').click(function(event) {